@@ -15,6 +15,7 @@ __author__ = 'Edward Hunter'
 from pyon.public import log
 
 import copy
+import numpy
 
 from interface.objects import StreamAlertType
 from interface.objects import DeviceStatusType
@@ -35,7 +36,17 @@ class AgentAlertManager(object):
         for aggregate_type in AggregateStatusType._str_map.keys():
             agent.aparam_aggstatus[aggregate_type] = DeviceStatusType.STATUS_UNKNOWN
         agent.aparam_set_aggstatus = self.aparam_set_aggstatus
-    
+
+        # Index of the alerts, rebuilt when the alerts change.
+        self._indexed_alerts = None
+        self._indexed_count = 0
+        self._interval_alerts = {}
+        self._stream_alerts = {}
+        self._other_alerts = []
+        self._alerts_by_type = {}
+        self._aggregated = False
+        self._other_statuses = []
+
     def process_alerts(self, **kwargs):
 
         log.debug("process_alerts: aparam_alerts=%s; kwargs=%s", self._agent.aparam_alerts, kwargs)
@@ -45,7 +56,153 @@ class AgentAlertManager(object):
 
         # update the aggreate status for this device
         self._process_aggregate_alerts()
-        
+
+    def process_stream_values(self, stream_name, values):
+        """
+        Evaluates the alerts for values sampled on a stream. Gives the same
+        alerts as calling process_alerts for each value, but interval alerts
+        are evaluated for all of the values of a value_id in one pass and the
+        aggregate status is only recomputed for the aggregate types of the
+        alerts that changed.
+        @param stream_name The stream the values were sampled on.
+        @param values A list of (value_id, values) pairs, or a dict, with the
+        values of each value_id in the order they were sampled.
+        """
+        self._index_alerts()
+        values = list(values.items() if isinstance(values, dict) else values)
+
+        # Alerts on the stream itself, late data for instance.
+        for a in self._stream_alerts.get(stream_name, []):
+            a.eval_alert(stream_name=stream_name)
+        changed = set([a._aggregate_type for (a, status) in self._other_statuses
+                       if a._status != status and a._aggregate_type])
+        if changed:
+            self._process_aggregate_alerts(changed)
+        if not self._aggregated:
+            values = self._aggregate_first_value(stream_name, values)
+
+        for (value_id, vals) in values:
+            alerts = self._interval_alerts.get((stream_name, value_id))
+            if alerts:
+                self._eval_interval_alerts(alerts, stream_name, value_id, vals)
+
+    def _aggregate_first_value(self, stream_name, values):
+        """
+        The aggregate status of every type is first set once the first value
+        is evaluated, like process_alerts does. Returns the values left.
+        """
+        for (n, (value_id, vals)) in enumerate(values):
+            if not isinstance(vals, (list, tuple, numpy.ndarray)):
+                vals = [vals]
+            if len(vals):
+                alerts = self._interval_alerts.get((stream_name, value_id))
+                if alerts:
+                    self._eval_interval_alerts(alerts, stream_name, value_id, vals[:1])
+                self._process_aggregate_alerts()
+                return [(value_id, vals[1:])] + values[n + 1:]
+        return values
+
+    def _index_alerts(self):
+        """
+        Indexes the interval alerts by (stream_name, value_id), the other
+        stream alerts by stream_name and every alert by aggregate type.
+        """
+        alerts = self._agent.aparam_alerts
+        if alerts is self._indexed_alerts and len(alerts) == self._indexed_count:
+            return
+
+        self._interval_alerts = {}
+        self._stream_alerts = {}
+        self._other_alerts = []
+        self._alerts_by_type = {}
+        for a in alerts:
+            if isinstance(a, IntervalAlert):
+                self._interval_alerts.setdefault((a._stream_name, a._value_id), []).append(a)
+            else:
+                self._other_alerts.append(a)
+                if isinstance(a, StreamAlert):
+                    self._stream_alerts.setdefault(a._stream_name, []).append(a)
+            if a._aggregate_type:
+                self._alerts_by_type.setdefault(a._aggregate_type, []).append(a)
+
+        self._indexed_alerts = alerts
+        self._indexed_count = len(alerts)
+        self._aggregated = False
+        self._other_statuses = []
+
+    def _eval_interval_alerts(self, alerts, stream_name, value_id, values):
+        """
+        Evaluates the interval alerts of a value_id for an array of values.
+        The status of every alert is computed for all of the values at once,
+        the alerts are then only updated at the values where one of them
+        changes, in order, so the published alerts and aggregate statuses are
+        those of evaluating the values one at a time.
+        """
+        if not isinstance(values, (list, tuple, numpy.ndarray)):
+            values = [values]
+        try:
+            arr = numpy.asarray(values, dtype=numpy.float64)
+            if arr.ndim != 1:
+                raise ValueError('Values are not scalars')
+        except (TypeError, ValueError):
+            self._eval_values_each(alerts, stream_name, value_id, values)
+            return
+
+        # Like eval_alert, skip the values that evaluate to false.
+        valid = arr != 0
+        if not isinstance(values, numpy.ndarray) or values.dtype.kind == 'O':
+            values = list(values)
+            if None in values:
+                valid &= numpy.array([v is not None for v in values])
+        positions = numpy.flatnonzero(valid)
+        if not positions.size:
+            return
+
+        status = numpy.array([a.in_bounds(arr[positions]) for a in alerts])
+        changes = numpy.empty(status.shape, dtype=bool)
+        changes[:, 1:] = status[:, 1:] != status[:, :-1]
+        changes[:, 0] = [bool(s) != a._status for (a, s) in zip(alerts, status[:, 0])]
+
+        # The alerts that don't change on the first value were still evaluated.
+        for (i, a) in enumerate(alerts):
+            if not changes[i, 0]:
+                a._prev_status = a._status
+
+        updated = []
+        for k in numpy.flatnonzero(changes.any(axis=0)):
+            value = values[positions[k]]
+            # The alerts updated at an earlier value didn't change since.
+            for i in updated:
+                alerts[i]._prev_status = alerts[i]._status
+            updated = numpy.flatnonzero(changes[:, k])
+            for i in updated:
+                alerts[i].update_status(value, value_id, bool(status[i, k]))
+            aggregate_types = set([alerts[i]._aggregate_type for i in updated if alerts[i]._aggregate_type])
+            if aggregate_types:
+                self._process_aggregate_alerts(aggregate_types)
+
+        # Leave the alerts as if they were evaluated for the last value.
+        last = len(positions) - 1
+        value = values[positions[last]]
+        for (i, a) in enumerate(alerts):
+            a._current_value = value
+            a._current_value_id = value_id
+            if not changes[i, last]:
+                a._prev_status = a._status
+
+    def _eval_values_each(self, alerts, stream_name, value_id, values):
+        """
+        Evaluates the interval alerts one value at a time, for values that
+        aren't numeric.
+        """
+        for value in values:
+            for a in alerts:
+                a.eval_alert(stream_name=stream_name, value=value, value_id=value_id)
+            aggregate_types = set([a._aggregate_type for a in alerts
+                                   if a._aggregate_type and a._prev_status != a._status])
+            if aggregate_types:
+                self._process_aggregate_alerts(aggregate_types)
+
     def _update_aggstatus(self, aggregate_type, new_status, alerts_list=None):
         """
         Called by this manager to set a new status value for an aggstatus type.
@@ -67,54 +224,57 @@ class AgentAlertManager(object):
         self._agent.aparam_aggstatus[aggregate_type] = new_status
         self._publish_agg_status_event(aggregate_type, new_status, old_status, alerts_list )
 
-    def _process_aggregate_alerts(self):
+    def _process_aggregate_alerts(self, aggregate_types=None):
         """
         loop thru alerts list and retrieve status of any alert that contributes to the aggregate status and update the state
+        @param aggregate_types The aggregate types to update, all of them by default.
         """
-        #init working status
-        updated_status = {}
-        agg_alerts = {}
-        for aggregate_type in AggregateStatusType._str_map.keys():
-            updated_status[aggregate_type] = DeviceStatusType.STATUS_OK
-
-        for a in self._agent.aparam_alerts:
-            curr_state = a.get_status()
-
-            #if this alert does not contribue to an aggregate type then pass
-            if a._aggregate_type:
-
-                #get the current value for this aggregate status
-                current_agg_state = updated_status[ a._aggregate_type ]
-
-                #check if the status of this alert has changed, if so save for event description
-                if a._prev_status != a._status:
-
-                    if a._aggregate_type in agg_alerts:
-                        agg_alerts[a._aggregate_type].append(a._name)
-                    else:
-                        agg_alerts[a._aggregate_type]= [a._name]
-
-                if a._status is not None:
-                    if a._status is True:
-                        # this alert is not 'tripped' so the status is OK
-                        #check behavior here. if there are any unknowns then set to agg satus to unknown?
-                        if current_agg_state is DeviceStatusType.STATUS_UNKNOWN:
-                            updated_status[ a._aggregate_type ]  = DeviceStatusType.STATUS_OK
-
-                    elif a._status is False:
-                        #the alert is active, either a warning or an alarm
-                        if a._alert_type is StreamAlertType.ALARM:
-                            updated_status[ a._aggregate_type ] = DeviceStatusType.STATUS_CRITICAL
-                        elif  a._alert_type is StreamAlertType.WARNING and current_agg_state is not DeviceStatusType.STATUS_CRITICAL:
-                            updated_status[ a._aggregate_type ] = DeviceStatusType.STATUS_WARNING
+        self._index_alerts()
+        if not self._aggregated:
+            # The aggregate status of every type is set the first time.
+            aggregate_types = None
 
         #compare old state with new state and publish alerts for any agg status that has changed.
         for aggregate_type in AggregateStatusType._str_map.keys():
-            if updated_status[aggregate_type] != self._agent.aparam_aggstatus[aggregate_type]:
-                alerts_list = None
-                if aggregate_type in agg_alerts:
-                    alerts_list =  agg_alerts[aggregate_type]
-                self._update_aggstatus(aggregate_type, updated_status[aggregate_type], alerts_list)
+            if aggregate_types is not None and aggregate_type not in aggregate_types:
+                continue
+            updated_status, agg_alerts = self._aggregate_status(self._alerts_by_type.get(aggregate_type, []))
+            if updated_status != self._agent.aparam_aggstatus[aggregate_type]:
+                self._update_aggstatus(aggregate_type, updated_status, agg_alerts or None)
+
+        if aggregate_types is None:
+            self._aggregated = True
+        self._other_statuses = [(a, a._status) for a in self._other_alerts]
+
+    def _aggregate_status(self, alerts):
+        """
+        Returns the aggregate status of the alerts of an aggregate type, and
+        the names of the alerts whose status changed for the event description.
+        """
+        #init working status
+        updated_status = DeviceStatusType.STATUS_OK
+        agg_alerts = []
+
+        for a in alerts:
+            #check if the status of this alert has changed, if so save for event description
+            if a._prev_status != a._status:
+                agg_alerts.append(a._name)
+
+            if a._status is not None:
+                if a._status is True:
+                    # this alert is not 'tripped' so the status is OK
+                    #check behavior here. if there are any unknowns then set to agg satus to unknown?
+                    if updated_status is DeviceStatusType.STATUS_UNKNOWN:
+                        updated_status = DeviceStatusType.STATUS_OK
+
+                elif a._status is False:
+                    #the alert is active, either a warning or an alarm
+                    if a._alert_type is StreamAlertType.ALARM:
+                        updated_status = DeviceStatusType.STATUS_CRITICAL
+                    elif  a._alert_type is StreamAlertType.WARNING and updated_status is not DeviceStatusType.STATUS_CRITICAL:
+                        updated_status = DeviceStatusType.STATUS_WARNING
+
+        return updated_status, agg_alerts
 
     def _publish_agg_status_event(self, status_type, new_status, old_status, alerts_list=None):
         """
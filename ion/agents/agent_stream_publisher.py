@@ -31,7 +31,7 @@ from interface.objects import StreamRoute
 from pyon.core.bootstrap import get_obj_registry
 from pyon.core.object import IonObjectDeserializer
 
-from ion.agents.populate_rdt import populate_rdt
+from ion.agents.populate_rdt import ParticleAccumulator
 
 class AgentStreamPublisher(object):
     """
@@ -74,6 +74,7 @@ class AgentStreamPublisher(object):
                     self._stream_defs[stream_name] = stream_def
                     rdt = RecordDictionaryTool(stream_definition_id=stream_def)    
                 self._agent.aparam_streams[stream_name] = rdt.fields
+                self._stream_buffers[stream_name] = ParticleAccumulator(rdt)
                 self._agent.aparam_pubrate[stream_name] = 0
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
@@ -95,7 +96,6 @@ class AgentStreamPublisher(object):
                                     stream_id=stream_id, stream_route=route)
                 self._publishers[stream_name] = publisher
                 self._stream_greenlets[stream_name] = None
-                self._stream_buffers[stream_name] = []
         
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
@@ -112,7 +112,7 @@ class AgentStreamPublisher(object):
         
         try:
             stream_name = sample['stream_name']
-            self._stream_buffers[stream_name].insert(0, sample)
+            self._stream_buffers[stream_name].append(sample)
             if not self._stream_greenlets[stream_name]:
                 self._publish_stream_buffer(stream_name)
 
@@ -128,7 +128,7 @@ class AgentStreamPublisher(object):
         for sample in sample_list:
             try:
                 stream_name = sample['stream_name']
-                self._stream_buffers[stream_name].insert(0, sample)
+                self._stream_buffers[stream_name].append(sample)
                 streams.add(stream_name)
             except KeyError:
                 log.warning('Instrument agent %s received sample with bad stream name %s.',
@@ -197,23 +197,13 @@ class AgentStreamPublisher(object):
                 log.debug("ASP Flush Agent State")
                 self._agent._flush_state()
 
-            buf_len = len(self._stream_buffers[stream_name])
-            if buf_len == 0:
+            # The accumulated particles, in the order they arrived.
+            rdt = self._stream_buffers[stream_name].drain()
+            if rdt is None:
                 return
 
-            stream_def = self._stream_defs[stream_name]
-            if isinstance(stream_def, str):
-                rdt = RecordDictionaryTool(stream_definition_id=stream_def)
-            else:
-                rdt = RecordDictionaryTool(stream_definition=stream_def)
-                
             publisher = self._publishers[stream_name]
-            vals = []
-            for x in xrange(buf_len):
-                vals.append(self._stream_buffers[stream_name].pop())
-    
-            rdt = populate_rdt(rdt, vals)
-            
+
             #log.info('Outgoing granule: %s',
                      #['%s: %s'%(k,v) for k,v in rdt.iteritems()])
             #log.info('Outgoing granule preferred timestamp: %s' % rdt['preferred_timestamp'][0])
@@ -17,6 +17,9 @@ from pyon.public import IonObject, log
 import time
 import copy
 
+# 3rd party.
+import numpy
+
 # gevent.
 import gevent
 
@@ -393,6 +396,35 @@ class IntervalAlert(StreamValueAlert):
         if self._prev_status != self._status:
             self.publish_alert()
 
+    def in_bounds(self, values):
+        """
+        Returns the status for an array of values, True where the value is
+        within the interval, as eval_alert would set it for each value.
+        """
+        status = numpy.ones(values.shape, dtype=bool)
+        if isinstance(self._lower_bound, (int, float)):
+            if self._lower_rel_op == '<=':
+                status &= (self._lower_bound <= values)
+            else:
+                status &= (self._lower_bound < values)
+        if isinstance(self._upper_bound, (int, float)):
+            if self._upper_rel_op == '<=':
+                status &= (values <= self._upper_bound)
+            else:
+                status &= (values < self._upper_bound)
+        return status
+
+    def update_status(self, value, value_id, status):
+        """
+        Sets the status evaluated for a value, publishing the alert if it changed.
+        """
+        self._current_value = value
+        self._prev_status = self._status
+        self._current_value_id = value_id
+        self._status = status
+        if self._prev_status != self._status:
+            self.publish_alert()
+
 
 class RSNEventAlert(BaseAlert):
     """
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.alerts.test.test_agent_alert_manager
+@file ion/agents/alerts/test/test_agent_alert_manager.py
+@brief Unit tests for the evaluation of stream alerts by the alert manager.
+"""
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+from interface.objects import StreamAlertType, AggregateStatusType, DeviceStatusType
+
+from ion.agents.agent_alert_manager import AgentAlertManager
+from ion.agents.alerts.alerts import IntervalAlert
+
+import random
+
+
+@attr('UNIT', group='sa')
+class TestAgentAlertManager(PyonTestCase):
+    def setUp(self):
+        self.events = []
+        publisher = patch('ion.agents.alerts.alerts.EventPublisher')
+        publisher.start().return_value.publish_event.side_effect = \
+            lambda **kwargs: self.events.append(('alert', kwargs['name'], kwargs['sub_type'], kwargs['values']))
+        self.addCleanup(publisher.stop)
+
+    def make_manager(self, alert_defs):
+        agent = Mock()
+        agent.ORIGIN_TYPE = 'InstrumentDevice'
+        agent.resource_id = 'abc123'
+        agent.aparam_aggstatus = {}
+        agent._event_publisher.publish_event.side_effect = \
+            lambda **kwargs: self.events.append(('aggregate', kwargs['status_name'], kwargs['status'], kwargs['values']))
+        manager = AgentAlertManager(agent)
+        agent.aparam_alerts = [IntervalAlert(resource_id='abc123', origin_type='InstrumentDevice', **alert_def)
+                               for alert_def in alert_defs]
+        return manager, agent
+
+    def alert_defs(self, rs):
+        alert_defs = []
+        for i in xrange(rs.randint(1, 6)):
+            alert_def = {
+                'name' : 'alert_%d' % i,
+                'description' : 'Value out of range.',
+                'alert_type' : rs.choice([StreamAlertType.WARNING, StreamAlertType.ALARM]),
+                'aggregate_type' : rs.choice([None, AggregateStatusType.AGGREGATE_DATA, AggregateStatusType.AGGREGATE_COMMS]),
+                'stream_name' : rs.choice(['parsed', 'raw']),
+                'value_id' : rs.choice(['temp', 'pressure'])
+            }
+            if rs.random() < 0.7:
+                alert_def.update(lower_bound=rs.choice([5, 5.5]), lower_rel_op=rs.choice(['<', '<=']))
+            if rs.random() < 0.7 or 'lower_bound' not in alert_def:
+                alert_def.update(upper_bound=rs.choice([10, 12.]), upper_rel_op=rs.choice(['<', '<=']))
+            alert_defs.append(alert_def)
+        return alert_defs
+
+    def test_process_stream_values(self):
+        # Same alerts and aggregate statuses as evaluating each value with process_alerts
+        for seed in xrange(50):
+            rs = random.Random(seed)
+            alert_defs = self.alert_defs(rs)
+            samples = []
+            for i in xrange(5):
+                count = rs.choice([1, rs.randint(1, 20)])
+                value_ids = rs.sample(['temp', 'pressure'], rs.randint(1, 2) if count == 1 else 1)
+                values = [(value_id, [rs.choice([None, 0, 3, 5, 5.5, 8, 10, 12, 15]) for j in xrange(count)])
+                          for value_id in value_ids]
+                samples.append((rs.choice(['parsed', 'raw']), values))
+
+            manager, agent = self.make_manager(alert_defs)
+            for (stream_name, values) in samples:
+                for (value_id, vals) in values:
+                    for value in vals:
+                        manager.process_alerts(stream_name=stream_name, value=value, value_id=value_id)
+            expected = self.events
+            expected_status = (agent.aparam_aggstatus, [a.get_status() for a in agent.aparam_alerts])
+
+            self.events = []
+            manager, agent = self.make_manager(alert_defs)
+            for (stream_name, values) in samples:
+                manager.process_stream_values(stream_name, values)
+            self.assertEquals(self.events, expected)
+            self.assertEquals((agent.aparam_aggstatus, [a.get_status() for a in agent.aparam_alerts]), expected_status)
+            self.events = []
+
+    def test_aggregate_types(self):
+        manager, agent = self.make_manager([
+            {'name' : 'temp_warning', 'description' : 'Temperature out of range.', 'alert_type' : StreamAlertType.WARNING,
+             'aggregate_type' : AggregateStatusType.AGGREGATE_DATA, 'stream_name' : 'parsed', 'value_id' : 'temp',
+             'lower_bound' : 0, 'lower_rel_op' : '<', 'upper_bound' : 20, 'upper_rel_op' : '<'}])
+
+        manager.process_stream_values('parsed', [('temp', [10., 25., 12.])])
+        self.assertEquals(agent.aparam_aggstatus[AggregateStatusType.AGGREGATE_DATA], DeviceStatusType.STATUS_OK)
+        self.assertEquals([e[2] for e in self.events if e[0] == 'alert'],
+                          [StreamAlertType._str_map[StreamAlertType.ALL_CLEAR], StreamAlertType._str_map[StreamAlertType.WARNING],
+                           StreamAlertType._str_map[StreamAlertType.ALL_CLEAR]])
+        self.assertEquals(agent.aparam_alerts[0].get_status()['value'], 12.)
+
+        # Only the aggregate type of the alert is recomputed
+        with patch.object(manager, '_aggregate_status', wraps=manager._aggregate_status) as aggregate_status:
+            manager.process_stream_values('parsed', [('temp', [30.])])
+            self.assertEquals(aggregate_status.call_count, 1)
+            manager.process_stream_values('parsed', [('temp', [40., 50.]), ('pressure', [1.])])
+            self.assertEquals(aggregate_status.call_count, 1)
+        self.assertEquals(agent.aparam_aggstatus[AggregateStatusType.AGGREGATE_DATA], DeviceStatusType.STATUS_WARNING)
@@ -142,7 +142,7 @@ class SIOControllerPackageParser(object):
         chunk["content"] = content
 
         b = f.read(1)
-        if b == CONTENT_ETX and crc16_iso14443b(content):
+        if b == CONTENT_ETX and crc16_iso14443b(content) == chunk["content_crc"]:
             # Yay, content is good - can follow on
             chunk["parse_status"] = "OK"
         elif b == CONTENT_ETX:
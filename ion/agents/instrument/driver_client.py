@@ -12,10 +12,15 @@ __author__ = 'Edward Hunter'
 from gevent import monkey
 monkey.patch_all()
 from gevent import spawn
+from gevent.socket import wait_read, timeout as socket_timeout
+import gevent
 
 
 import time
 import thread
+import cPickle
+import bisect
+import msgpack
 
 # We import "regular" zmq, not the patched version because
 # we handle the nonblocking sockets directly as they need to work
@@ -25,9 +30,67 @@ import zmq
 from ooi.logging import log
 from pyon.core.exception import ExceptionFactory
 from pyon.core.exception import InstDriverClientTimeoutError
+from pyon.core.interceptor.encode import encode_ion, decode_ion
 
 
 EXCEPTION_FACTORY = ExceptionFactory()
+
+# Messages are pickled, which is what driver processes expect, or msgpacked
+# with numpy support. Msgpack frames start with MSGPACK_MAGIC, pickles never
+# start with a null byte, so either can be decoded without negotiation.
+PICKLE = 'pickle'
+MSGPACK = 'msgpack'
+MSGPACK_MAGIC = '\x00MP'
+
+def encode_message(msg, serializer=PICKLE):
+    """
+    Encodes a command or event message for the driver process sockets.
+    """
+    if serializer == MSGPACK:
+        return MSGPACK_MAGIC + msgpack.packb(msg, default=encode_ion)
+    return cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+
+def decode_message(frame):
+    """
+    Decodes a message of either format. Msgpack has no tuples, exception
+    replies are sent as {'exception' : [code, message, stacks]} and returned
+    as the (code, message, stacks) tuple of pickled replies.
+    """
+    if frame.startswith(MSGPACK_MAGIC):
+        msg = msgpack.unpackb(frame[len(MSGPACK_MAGIC):], object_hook=decode_ion)
+        if isinstance(msg, dict) and len(msg) == 1 and 'exception' in msg:
+            msg = tuple(msg['exception'])
+        return msg
+    return cPickle.loads(frame)
+
+
+class LatencyHistogram(object):
+    """
+    Counts of latencies, in seconds, in buckets with log spaced upper bounds.
+    The last bucket counts the latencies above the last bound.
+    """
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10., 30., 60.)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(self.BOUNDS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def to_dict(self):
+        return {
+            'bounds' : list(self.BOUNDS),
+            'counts' : list(self.counts),
+            'count' : self.count,
+            'mean' : self.total / self.count if self.count else None,
+            'max' : self.max
+        }
 class DriverClient(object):
     """
     Base class for driver clients, subclassed for specific messaging
@@ -87,27 +150,40 @@ class DriverClient(object):
 
 class ZmqDriverClient(DriverClient):
     """
-    A class for communicating with a ZMQ-based driver process using python
-    thread for catching asynchronous driver events.
+    A class for communicating with a ZMQ-based driver process using a
+    greenlet for catching asynchronous driver events.
+
+    The sockets are not polled on a timer, the client waits on their ZMQ
+    file descriptors, which signal a change of their ZMQ events, so that
+    events and replies are handled as soon as they arrive without blocking
+    the gevent hub. Events are read in batches of up to EVENT_BATCH.
     """
-    
-    def __init__(self, host, cmd_port, event_port):
+    # The ZMQ file descriptors are edge triggered, the events are rechecked
+    # at least this often (in seconds) in case an edge was missed.
+    WAKEUP_INTERVAL = 0.5
+    EVENT_BATCH = 1000
+
+    def __init__(self, host, cmd_port, event_port, serializer=PICKLE):
         """
         Initialize members.
         @param host Host string address of the driver process.
         @param cmd_port Port number for the driver process command port.
         @param event_port Port number for the driver process event port.
+        @param serializer Format of the commands sent, PICKLE or MSGPACK.
         """
         DriverClient.__init__(self)
         self.host = host
         self.cmd_port = cmd_port
         self.event_port = event_port
+        self.serializer = serializer
         self.cmd_host_string = 'tcp://%s:%i' % (self.host, self.cmd_port)
         self.event_host_string = 'tcp://%s:%i' % (self.host, self.event_port)
         self.zmq_context = None
         self.zmq_cmd_socket = None
         self.event_thread = None
         self.stop_event_thread = True
+        self.cmd_latencies = {}
+        self.event_latencies = LatencyHistogram()
         
     def start_messaging(self, evt_callback=None):
         """
@@ -136,16 +212,26 @@ class ZmqDriverClient(DriverClient):
             """
             self.stop_event_thread = False
             while not self.stop_event_thread:
-                try:
-                    evt = self.zmq_evt_socket.recv_pyobj(flags=zmq.NOBLOCK)
-                    log.debug('got event: %s' % str(evt))
-                    if self.evt_callback:
-                        self.evt_callback(evt)
-                except zmq.ZMQError:
-                    time.sleep(.5)
-                except Exception, e:
-                    log.error('Driver client error reading from zmq event socket: ' + str(e))
-                    log.error('Driver client error type: ' + str(type(e)))                    
+                if not self._wait_for(self.zmq_evt_socket, zmq.POLLIN, self.WAKEUP_INTERVAL):
+                    continue
+                for i in xrange(self.EVENT_BATCH):
+                    try:
+                        frame = self.zmq_evt_socket.recv(flags=zmq.NOBLOCK)
+                    except zmq.ZMQError as e:
+                        if e.errno != zmq.EAGAIN:
+                            log.error('Driver client error reading from zmq event socket: ' + str(e))
+                        break
+                    try:
+                        evt = decode_message(frame)
+                        log.debug('got event: %s' % str(evt))
+                        self._record_event_latency(evt)
+                        if self.evt_callback:
+                            self.evt_callback(evt)
+                    except Exception, e:
+                        log.error('Driver client error reading from zmq event socket: ' + str(e))
+                        log.error('Driver client error type: ' + str(type(e)))
+                # Let other greenlets run between batches.
+                gevent.sleep(0)
             log.info('Client event socket closed.')
 
         self.event_thread = spawn(recv_evt_messages)
@@ -167,12 +253,49 @@ class ZmqDriverClient(DriverClient):
             self.zmq_context = None
         self.evt_callback = None
         log.info('Driver client messaging closed.')
-    
+
+    def _wait_for(self, socket, event, timeout):
+        """
+        Waits until the socket is ready for event (zmq.POLLIN or zmq.POLLOUT)
+        without blocking other greenlets.
+        @param timeout Seconds to wait for.
+        @retval True if the socket is ready, False on timeout.
+        """
+        deadline = time.time() + timeout
+        fd = socket.getsockopt(zmq.FD)
+        while not socket.getsockopt(zmq.EVENTS) & event:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                wait_read(fd, timeout=min(remaining, self.WAKEUP_INTERVAL))
+            except socket_timeout:
+                pass
+        return True
+
+    def _record_event_latency(self, evt):
+        """
+        Driver events are timestamped by the driver process when they're sent.
+        """
+        if isinstance(evt, dict) and isinstance(evt.get('time'), float):
+            self.event_latencies.add(max(time.time() - evt['time'], 0.))
+
+    def get_latency_histograms(self):
+        """
+        Returns the histograms of the latencies of the commands, from sending
+        the command to receiving the reply, and of the events, from the event
+        timestamp to receiving it.
+        """
+        return {
+            'commands' : dict([(cmd, histogram.to_dict()) for (cmd, histogram) in self.cmd_latencies.iteritems()]),
+            'events' : self.event_latencies.to_dict()
+        }
+
     def cmd_dvr(self, cmd, *args, **kwargs):
         """
         Command a driver by request-reply messaging. Package command
-        message and send on blocking command socket. Block on same socket
-        to receive the reply. Return the driver reply.
+        message and send on command socket once it's ready. Wait on same
+        socket to receive the reply. Return the driver reply.
         @param cmd The driver command identifier.
         @param args Positional arguments of the command.
         @param kwargs Keyword arguments of the command.
@@ -186,20 +309,25 @@ class ZmqDriverClient(DriverClient):
         start_send = time.time()
         while True:
             try:
-                # Attempt command send. Retry if necessary.
-                self.zmq_cmd_socket.send_pyobj(msg, flags=zmq.NOBLOCK)
+                # Attempt command send once the socket accepts it.
+                if not self._wait_for(self.zmq_cmd_socket, zmq.POLLOUT,
+                                      driver_timeout - (time.time() - start_send)):
+                    raise InstDriverClientTimeoutError()
+                self.zmq_cmd_socket.send(encode_message(msg, self.serializer), flags=zmq.NOBLOCK)
                 if msg == 'stop_driver_process':
                     return 'driver stopping'
 
                 # Command sent, break out and wait for reply.
                 break    
 
-            except zmq.ZMQError:
-                # Socket not ready to accept send. Sleep and retry later.
-                time.sleep(.5)
-                delta = time.time() - start_send
-                if delta >= driver_timeout:
-                    raise InstDriverClientTimeoutError()
+            except zmq.ZMQError as e:
+                # Socket stopped accepting sends, wait again.
+                if e.errno != zmq.EAGAIN:
+                    log.error('Driver client error writing to zmq socket: ' + str(e))
+                    raise SystemError('exception writing to zmq socket: ' + str(e))
+
+            except InstDriverClientTimeoutError:
+                raise
 
             except Exception,e:
                 log.error('Driver client error writing to zmq socket: ' + str(e))
@@ -210,22 +338,31 @@ class ZmqDriverClient(DriverClient):
         start_reply = time.time()
         while True:
             try:
-                # Attempt reply recv. Retry if necessary.
-                reply = self.zmq_cmd_socket.recv_pyobj(flags=zmq.NOBLOCK)
+                # Attempt reply recv once it has arrived.
+                if not self._wait_for(self.zmq_cmd_socket, zmq.POLLIN,
+                                      driver_timeout - (time.time() - start_reply)):
+                    raise InstDriverClientTimeoutError()
+                reply = decode_message(self.zmq_cmd_socket.recv(flags=zmq.NOBLOCK))
                 # Reply recieved, break and return.
                 break
-            except zmq.ZMQError:
-                # Socket not ready with the reply. Sleep and retry later.
-                time.sleep(.5)
-                delta = time.time() - start_reply
-                if delta >= driver_timeout:
-                    raise InstDriverClientTimeoutError()
+
+            except zmq.ZMQError as e:
+                # Reply not there after all, wait again.
+                if e.errno != zmq.EAGAIN:
+                    log.error('Driver client error reading from zmq socket: ' + str(e))
+                    raise SystemError('exception reading from zmq socket: ' + str(e))
+
+            except InstDriverClientTimeoutError:
+                raise
 
             except Exception,e:
                 log.error('Driver client error reading from zmq socket: ' + str(e))
                 log.error('Driver client error type: ' + str(type(e)))
                 raise SystemError('exception reading from zmq socket: ' + str(e))
-                
+
+        if cmd not in self.cmd_latencies:
+            self.cmd_latencies[cmd] = LatencyHistogram()
+        self.cmd_latencies[cmd].add(time.time() - start_send)
         log.trace('Reply: %r', reply)
 
         ## exception information is returned as a tuple (code, message, stacks)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.instrument.test.test_driver_client
+@file ion/agents/instrument/test/test_driver_client.py
+@brief Unit tests for the ZMQ driver client messaging.
+"""
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.core.exception import BadRequest, InstDriverClientTimeoutError
+from nose.plugins.attrib import attr
+
+from ion.agents.instrument.driver_client import ZmqDriverClient, LatencyHistogram, encode_message, decode_message, PICKLE, MSGPACK
+
+import gevent
+import numpy as np
+import time
+import zmq
+
+
+@attr('UNIT', group='mi')
+class TestZmqDriverClient(PyonTestCase):
+    def test_messages(self):
+        msg = {'cmd' : 'execute_resource', 'args' : ['DRIVER_EVENT_ACQUIRE_SAMPLE'], 'kwargs' : {'timeout' : 10}}
+        for serializer in (PICKLE, MSGPACK):
+            self.assertEquals(decode_message(encode_message(msg, serializer)), msg)
+
+        # Msgpack frames keep numpy arrays
+        values = decode_message(encode_message({'values' : np.arange(5.)}, MSGPACK))['values']
+        np.testing.assert_array_equal(values, np.arange(5.))
+
+        # Pickled tuples and msgpacked exceptions are both exception replies
+        self.assertEquals(decode_message(encode_message((400, 'Bad', None))), (400, 'Bad', None))
+        self.assertEquals(decode_message(encode_message({'exception' : [400, 'Bad', None]}, MSGPACK)), (400, 'Bad', None))
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for latency in (0.0005, 0.001, 0.003, 0.003, 100.):
+            histogram.add(latency)
+        result = histogram.to_dict()
+        self.assertEquals(result['counts'][:3], [2, 0, 2])
+        self.assertEquals(result['counts'][-1], 1)
+        self.assertEquals(result['count'], 5)
+        self.assertEquals(result['max'], 100.)
+        self.assertEquals(LatencyHistogram().to_dict()['mean'], None)
+
+    def test_messaging(self):
+        context = zmq.Context()
+        self.addCleanup(context.destroy, linger=0)
+        rep = context.socket(zmq.REP)
+        cmd_port = rep.bind_to_random_port('tcp://127.0.0.1')
+        pub = context.socket(zmq.PUB)
+        event_port = pub.bind_to_random_port('tcp://127.0.0.1')
+
+        events = []
+        client = ZmqDriverClient('127.0.0.1', cmd_port, event_port, serializer=MSGPACK)
+        client.start_messaging(events.append)
+        self.addCleanup(client.stop_messaging)
+
+        def serve(reply):
+            self.assertTrue(client._wait_for(rep, zmq.POLLIN, 5))
+            msg = decode_message(rep.recv(zmq.NOBLOCK))
+            rep.send(encode_message(reply or msg, MSGPACK))
+
+        server = gevent.spawn(serve, None)
+        reply = client.cmd_dvr('process_echo', 'test 1 2 3', driver_timeout=5)
+        server.join()
+        self.assertEquals(reply['cmd'], 'process_echo')
+        self.assertEquals(reply['args'], ['test 1 2 3'])
+
+        server = gevent.spawn(serve, {'exception' : [400, 'Bad command', None]})
+        with self.assertRaises(BadRequest):
+            client.cmd_dvr('bad_command', driver_timeout=5)
+        server.join()
+
+        histograms = client.get_latency_histograms()
+        self.assertEquals(histograms['commands']['process_echo']['count'], 1)
+        self.assertEquals(histograms['commands']['bad_command']['count'], 1)
+
+        # No reply
+        with self.assertRaises(InstDriverClientTimeoutError):
+            client.cmd_dvr('process_echo', driver_timeout=0.1)
+
+        # The subscription is ready once the first event gets through
+        for i in xrange(100):
+            pub.send(encode_message({'type' : 'DRIVER_ASYNC_EVENT_SAMPLE', 'value' : i, 'time' : time.time()}, MSGPACK))
+            gevent.sleep(0.05)
+            if events:
+                break
+        self.assertTrue(events)
+        events[:] = []
+        for i in xrange(10):
+            pub.send(encode_message({'type' : 'DRIVER_ASYNC_EVENT_SAMPLE', 'value' : i, 'time' : time.time()}))
+        for i in xrange(100):
+            gevent.sleep(0.01)
+            if len(events) == 10:
+                break
+        self.assertEquals([evt['value'] for evt in events], range(10))
+        self.assertTrue(client.get_latency_histograms()['events']['count'] >= 11)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.instrument.test.test_particle_accumulator
+@file ion/agents/instrument/test/test_particle_accumulator.py
+@brief Unit tests for the columnar particle accumulator.
+"""
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+
+from coverage_model import ParameterDictionary, ParameterContext
+from coverage_model.parameter_types import QuantityType, ArrayType
+from ion.services.dm.utility.granule_utils import RecordDictionaryTool
+from ion.agents.populate_rdt import populate_rdt, ParticleAccumulator
+
+import numpy as np
+import base64
+
+
+@attr('UNIT', group='mi')
+class TestParticleAccumulator(PyonTestCase):
+    def setUp(self):
+        pdict = ParameterDictionary()
+        pdict.add_context(ParameterContext('time', param_type=QuantityType(value_encoding='float64'), fill_value=-9999.), is_temporal=True)
+        for name in ('driver_timestamp', 'port_timestamp', 'temp', 'pressure'):
+            pdict.add_context(ParameterContext(name, param_type=QuantityType(value_encoding='float64'), fill_value=-9999.))
+        pdict.add_context(ParameterContext('count', param_type=QuantityType(value_encoding='int32'), fill_value=-1))
+        for name in ('quality_flag', 'raw'):
+            pdict.add_context(ParameterContext(name, param_type=ArrayType()))
+        self.pdict = pdict
+
+    def rdt(self):
+        return RecordDictionaryTool(param_dictionary=self.pdict)
+
+    def particle(self, i, preferred='driver_timestamp'):
+        values = [{'value_id' : 'temp', 'value' : 10. + i},
+                  {'value_id' : 'count', 'value' : i},
+                  {'value_id' : 'unknown', 'value' : 'ignored'}]
+        if i % 3:
+            values.append({'value_id' : 'pressure', 'value' : None if i % 3 == 1 else float(i)})
+        if i % 4 == 0:
+            values.append({'value_id' : 'raw', 'value' : base64.b64encode('raw %d' % i), 'binary' : True})
+        return {'quality_flag' : 'ok',
+                'preferred_timestamp' : preferred,
+                'stream_name' : 'parsed',
+                'pkt_format_id' : 'JSON_Data',
+                'driver_timestamp' : 3564867147. + i,
+                'port_timestamp' : 3564867146. + i,
+                'values' : values}
+
+    def assert_same_rdt(self, rdt, expected):
+        self.assertEquals(len(rdt), len(expected))
+        for field in expected.fields:
+            if expected[field] is None:
+                self.assertIsNone(rdt[field], field)
+            else:
+                np.testing.assert_array_equal(rdt[field], expected[field])
+                self.assertEquals(rdt[field].dtype, expected[field].dtype)
+
+    def test_drain(self):
+        particles = [self.particle(i, 'port_timestamp' if i == 5 else 'driver_timestamp') for i in xrange(150)]
+
+        accumulator = ParticleAccumulator(self.rdt())
+        self.assertIsNone(accumulator.drain())
+
+        # Grows past its initial capacity
+        accumulator.extend(particles)
+        self.assertEquals(len(accumulator), 150)
+        rdt = accumulator.drain()
+        self.assertEquals(len(accumulator), 0)
+        self.assert_same_rdt(rdt, populate_rdt(self.rdt(), particles))
+        self.assertEquals(rdt['time'][5], 3564867151.)
+        self.assertEquals(rdt['raw'][4], 'raw 4')
+
+        # Particles added after draining don't change the drained values
+        temp = rdt['temp'].copy()
+        accumulator.extend(particles[:10])
+        np.testing.assert_array_equal(rdt['temp'], temp)
+        self.assert_same_rdt(accumulator.drain(), populate_rdt(self.rdt(), particles[:10]))
+
+    def test_mixed_values(self):
+        particles = [self.particle(i) for i in xrange(4)]
+        # A value that doesn't fit the field's dtype
+        particles[2]['values'][0]['value'] = [1., 2.]
+        particles[3]['values'][0]['value'] = [3., 4.]
+        particles = particles[2:]
+
+        accumulator = ParticleAccumulator(self.rdt())
+        accumulator.extend(particles)
+        self.assert_same_rdt(accumulator.drain(), populate_rdt(self.rdt(), particles))
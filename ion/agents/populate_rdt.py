@@ -83,3 +83,133 @@ def populate_rdt(rdt, vals):
     return rdt
 
             
+
+class ParticleAccumulator(object):
+    """
+    Accumulates data particles for a stream in columns, one per field, that
+    are filled in place as particles arrive. Draining the accumulator hands
+    the filled part of the columns to a record dictionary without copying
+    them. The result is the same as populate_rdt on the particles.
+
+    Numeric fields are kept in arrays of the field's dtype, initialized to
+    the fill value, anything else (strings, arrays, values that don't fit
+    the dtype) in object arrays that are converted like populate_rdt does.
+    """
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, rdt):
+        """
+        @param rdt An empty RecordDictionaryTool for the stream, used as the
+        template of the drained record dictionaries
+        """
+        self._template = rdt
+        self._fields = set(rdt.fields)
+        self._temporal = rdt.temporal_parameter
+        self._fills = {}
+        self._dtypes = {}
+        layout = rdt.layout
+        for name in self._fields:
+            dtype = layout.dtypes.get(name)
+            fill = layout.fill_values.get(name)
+            if name in layout.quantities and dtype is not None and dtype.kind in 'biuf' and fill is not None:
+                self._dtypes[name] = dtype
+                self._fills[name] = fill
+            else:
+                self._dtypes[name] = numpy.dtype(object)
+                self._fills[name] = None
+        self._capacity = self.INITIAL_CAPACITY
+        self._columns = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _column(self, name, capacity):
+        dtype = self._dtypes[name]
+        column = numpy.empty(capacity, dtype=dtype)
+        column.fill(self._fills[name])
+        return column
+
+    def _grow(self):
+        capacity = self._capacity * 2
+        for name, column in self._columns.iteritems():
+            grown = self._column(name, capacity) if column.dtype == self._dtypes[name] else numpy.empty(capacity, dtype=object)
+            grown[:self._capacity] = column
+            self._columns[name] = grown
+        self._capacity = capacity
+
+    def _put(self, name, i, value):
+        column = self._columns.get(name)
+        if column is None:
+            column = self._columns[name] = self._column(name, self._capacity)
+        if value is None:
+            value = self._fills[name]
+        try:
+            column[i] = value
+        except (TypeError, ValueError):
+            # The value doesn't fit the field's dtype, keep the values as objects
+            column = self._columns[name] = column.astype(object)
+            column[i] = value
+
+    def append(self, particle):
+        """
+        Adds a data particle dictionary, see populate_rdt for its layout
+        """
+        if self._count == self._capacity:
+            self._grow()
+        i = self._count
+        fields = self._fields
+        preferred_timestamp = particle.get(DataParticleKey.PREFERRED_TIMESTAMP, DataParticleKey.DRIVER_TIMESTAMP)
+
+        for k,v in particle.iteritems():
+            if k == DataParticleKey.VALUES:
+                for value_dict in v:
+                    value_id = value_dict[DataParticleKey.VALUE_ID]
+                    if value_id in fields:
+                        value = value_dict[DataParticleKey.VALUE]
+                        if 'binary' in value_dict:
+                            value = base64.b64decode(value)
+                        self._put(value_id, i, value)
+
+            elif k in fields:
+                self._put(k, i, v)
+
+            if k == preferred_timestamp:
+                self._put(self._temporal, i, v)
+
+        self._count += 1
+
+    def extend(self, particles):
+        for particle in particles:
+            self.append(particle)
+
+    def drain(self):
+        """
+        Returns a record dictionary with the accumulated particles, or None if
+        there are none, and empties the accumulator. The numeric values of the
+        record dictionary are views of the columns, the accumulator starts new
+        columns so particles added while the granule is published don't change it.
+        """
+        count = self._count
+        if not count:
+            return None
+        columns = self._columns
+        self._columns = {}
+        self._count = 0
+        # Start the next batch with room for as many particles as this one
+        self._capacity = max(self.INITIAL_CAPACITY, count)
+
+        if self._temporal not in columns:
+            columns[self._temporal] = self._column(self._temporal, count)
+
+        rdt = self._template.clone_empty()
+        for k,v in columns.iteritems():
+            v = v[:count]
+            if v.dtype.kind == 'O':
+                v = numpy.array(v.tolist())
+            try:
+                rdt[k] = v
+            except ValueError:
+                log.error("Couldn't set %s as %s", k, repr(v))
+                raise
+        return rdt
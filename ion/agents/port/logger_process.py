@@ -17,6 +17,7 @@ import time
 import datetime
 import atexit
 import errno
+import select
 from subprocess import Popen
 from subprocess import PIPE
 import logging
@@ -35,6 +36,139 @@ l = lp.EthernetDeviceLogger('137.110.112.119', 4001, 8888)
 c = lp.LoggerClient('localhost', 8888, '\r\n')
 """
 
+class SocketPoller(object):
+    """
+    Waits for file descriptors to become readable. Uses epoll where the
+    platform provides it and falls back to select otherwise, e.g. when
+    select has been monkey patched by gevent.
+    """
+    def __init__(self):
+        """
+        Socket poller constructor.
+        """
+        self.filenos = set()
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+        else:
+            self.epoll = None
+
+    def register(self, fileno):
+        """
+        Start polling a file descriptor for input.
+        @param fileno The file descriptor.
+        """
+        if fileno not in self.filenos:
+            self.filenos.add(fileno)
+            if self.epoll:
+                self.epoll.register(fileno, select.EPOLLIN)
+
+    def unregister(self, fileno):
+        """
+        Stop polling a file descriptor. Call before closing it.
+        @param fileno The file descriptor.
+        """
+        if fileno in self.filenos:
+            self.filenos.discard(fileno)
+            if self.epoll:
+                try:
+                    self.epoll.unregister(fileno)
+                except (IOError, OSError, ValueError):
+                    pass
+
+    def poll(self, timeout):
+        """
+        Wait for input, hangup or errors on the registered file descriptors.
+        @param timeout Seconds to wait.
+        @retval List of ready file descriptors, empty on timeout or if
+        interrupted by a signal.
+        """
+        try:
+            if self.epoll:
+                return [fileno for (fileno, event) in self.epoll.poll(timeout)]
+            return select.select(list(self.filenos), [], [], timeout)[0]
+
+        except (IOError, OSError, select.error) as e:
+            # [Errno 4] Interrupted system call.
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        """
+        Release the poller.
+        """
+        if self.epoll:
+            self.epoll.close()
+            self.epoll = None
+        self.filenos.clear()
+
+class BufferedLogWriter(object):
+    """
+    Buffers logfile writes. The buffer is written out when it fills or when
+    the flush interval has passed, and the file is fsynced once per sync
+    interval, rather than flushing the logfile on every read.
+    """
+    def __init__(self, logfile, buffer_size=65536, flush_interval=0.5,
+                 sync_interval=5.0):
+        """
+        Buffered log writer constructor.
+        @param logfile The open logfile.
+        @param buffer_size Bytes buffered before writing to the logfile.
+        @param flush_interval Seconds between flushes of the buffer.
+        @param sync_interval Seconds between fsyncs of the logfile.
+        """
+        self.logfile = logfile
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self._buffer = []
+        self._buffered = 0
+        self._unsynced = False
+        self._last_flush = self._last_sync = time.time()
+
+    def write(self, data):
+        """
+        Buffer data for the logfile, writing it out if the buffer is full.
+        @param data The data string to log.
+        """
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffer to the logfile and flush it to the OS.
+        """
+        if self._buffer:
+            self.logfile.write(''.join(self._buffer))
+            self.logfile.flush()
+            self._buffer = []
+            self._buffered = 0
+            self._unsynced = True
+        self._last_flush = time.time()
+
+    def sync(self):
+        """
+        Flush the buffer and fsync the logfile to disk.
+        """
+        self.flush()
+        if self._unsynced:
+            os.fsync(self.logfile.fileno())
+            self._unsynced = False
+        self._last_sync = self._last_flush
+
+    def poll(self):
+        """
+        Flush or sync the logfile if the respective interval has passed.
+        Called regularly from the logger run loop.
+        """
+        now = time.time()
+        if now - self._last_sync >= self.sync_interval:
+            self.sync()
+        elif now - self._last_flush >= self.flush_interval:
+            self.flush()
+
 class BaseLoggerProcess(DaemonProcess):
     """
     Base class for device loggers. Device loggers are communication
@@ -46,6 +180,13 @@ class BaseLoggerProcess(DaemonProcess):
     Derived subclasses provide read/write logic for TCP/IP, serial or other
     device hardware.
     """
+    # Seconds to wait for socket events before servicing the logfile and
+    # checking the parent.
+    POLL_TIMEOUT = 0.5
+
+    # Seconds between reads of devices that can't be polled.
+    DEVICE_READ_INTERVAL = 0.1
+
     @staticmethod
     def launch_logger(cmd_str):
         """
@@ -73,8 +214,9 @@ class BaseLoggerProcess(DaemonProcess):
         DaemonProcess.__init__(self, pidfname, logfname, workdir)
         self.server_port = None
         self.driver_server_sock = None
-        self.driver_sock = None
-        self.driver_addr = None
+        self.drivers = {}
+        self.poller = None
+        self.logwriter = None
         self.delim = delim
         self.statusfname = workdir + statusfname
         self.ppid = ppid
@@ -100,7 +242,7 @@ class BaseLoggerProcess(DaemonProcess):
                 sock_name = self.driver_server_sock.getsockname()
                 self.server_port = sock_name[1]
                 file(self.portfname,'w+').write(str(self.server_port)+'\n')
-                self.driver_server_sock.listen(1)
+                self.driver_server_sock.listen(5)
                 self.driver_server_sock.setblocking(0)
                 self.statusfile.write('_init_driver_comms: Listening for driver at: %s.\n' % str(sock_name))
                 self.statusfile.flush()
@@ -122,46 +264,54 @@ class BaseLoggerProcess(DaemonProcess):
             
     def _accept_driver_comms(self):
         """
-        Accept a driver connection request from nonblocking driver server
-        socket. If nothing available, proceed. If a connection is accepted,
-        log with status file. Handles resource unavailable and unspecified
-        socket errors.
+        Accept pending driver connection requests from nonblocking driver
+        server socket. If nothing available, proceed. Each accepted
+        connection is registered with the poller and logged with status file.
+        Handles resource unavailable and unspecified socket errors.
         """
-        sock = None
-        addr = None
-        try:
-            sock, host_port_tuple = self.driver_server_sock.accept()
+        while True:
+            try:
+                sock, host_port_tuple = self.driver_server_sock.accept()
 
-        except socket.error as e:
-            # [Errno 35] Resource temporarily unavailable.
-            if e.errno == errno.EAGAIN:
-                # Wating for a driver connection, proceed out of function.
-                pass
-            
-            else:
-                # TBD. Report and proceed.
-                self.statusfile.write('_accept_driver_comms: raised errno %i, %s.\n' % (e.errno, str(e)))
-                self.statusfile.flush()
-            
-        if sock:        
-            self.driver_sock = sock
-            self.driver_sock.setblocking(0)            
-            self.driver_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)                            
-            self.driver_addr = host_port_tuple
-            self.statusfile.write('_accept_driver_comms: driver connected at %s:%i.\n' % self.driver_addr)
+            except socket.error as e:
+                # [Errno 35] Resource temporarily unavailable.
+                if e.errno == errno.EAGAIN:
+                    # No more driver connections waiting, proceed out of function.
+                    pass
+                
+                else:
+                    # TBD. Report and proceed.
+                    self.statusfile.write('_accept_driver_comms: raised errno %i, %s.\n' % (e.errno, str(e)))
+                    self.statusfile.flush()
+                return
+
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.drivers[sock.fileno()] = (sock, host_port_tuple)
+            if self.poller:
+                self.poller.register(sock.fileno())
+            self.statusfile.write('_accept_driver_comms: driver connected at %s:%i.\n' % host_port_tuple)
             self.statusfile.flush()
+
+    def _close_driver(self, fileno):
+        """
+        Close a driver connection and stop polling it.
+        @param fileno File descriptor of the driver socket.
+        """
+        sock, addr = self.drivers.pop(fileno)
+        if self.poller:
+            self.poller.unregister(fileno)
+        sock.close()
+        self.statusfile.write('_close_driver: closed driver connection at %s:%i.\n' % addr)
+        self.statusfile.flush()
         
     def _close_driver_comms(self):
         """
         Close driver communications. Close driver and driver server sockets
         if they exist. Log with status file.
         """
-        if self.driver_sock:
-            self.driver_sock.close()
-            self.driver_sock = None
-            self.driver_addr = None
-            self.statusfile.write('_close_driver_comms: closed driver connection.\n')
-            self.statusfile.flush()
+        for fileno in self.drivers.keys():
+            self._close_driver(fileno)
 
         if self.driver_server_sock:
             self.driver_server_sock.close()
@@ -191,11 +341,19 @@ class BaseLoggerProcess(DaemonProcess):
         """
         return False
 
+    def _device_fileno(self):
+        """
+        File descriptor to poll for device data. Overridden in hardware
+        specific subclasses. If None, the device is read every loop iteration.
+        """
+        return None
+
     def _check_parent(self):
         """
         Check if the original parent is still alive, and fire the shutdown
         process if not detected. Used when run in the testing framework
         to ensure process and pidfile goes away if the test ends abruptly.
+        @retval False if the parent is gone and the logger was cleaned up.
         """
         
         if self.ppid:
@@ -211,18 +369,22 @@ class BaseLoggerProcess(DaemonProcess):
                     self.statusfile.write('_parent_alive: parent process not detected, shutting down.\n')
                     self.statusfile.flush()
                     self._cleanup()
+                    return False
+        return True
 
-    def read_driver(self):
+    def read_driver(self, fileno):
         """
-        Read data from driver, if available. Log errors to status file.
+        Read data from a driver, if available. Log errors to status file.
         Handles resource unavailable, connection reset by peer, broken pipe
-        and unspecified socket errors.
+        and unspecified socket errors, and closes the connection if the
+        driver has disconnected.
+        @param fileno File descriptor of the driver socket.
         @retval The string of data read from the driver or None.
         """
         data = None
-        if self.driver_sock:
+        if fileno in self.drivers:
             try:
-                data = self.driver_sock.recv(4096)
+                data = self.drivers[fileno][0].recv(4096)
 
             except socket.error as e:                
                 # [Errno 35] Resource temporarily unavailable.
@@ -231,88 +393,54 @@ class BaseLoggerProcess(DaemonProcess):
                     pass
                 
                 # [Errno 54] Connection reset by peer.
-                elif e.errno == errno.ECONNRESET:
-                    # The client side has disconnected, report and close socket.
-                    self.statusfile.write('read_driver: raised errno %i, %s.\n'
-                                          % (e.errno, str(e)))
-                    self.statusfile.flush()
-                    self.driver_sock.close()
-                    self.driver_sock = None
-                    self.driver_addr = None
-                
                 # [Errno 32] Broken pipe.
-                elif e.errno == errno.EPIPE:
-                    # Broken pipe, report and close socket.
-                    self.statusfile.write('read_driver: raised errno %i, %s.\n'
-                                          % (e.errno, str(e)))
-                    self.statusfile.flush()
-                    self.driver_sock.close()
-                    self.driver_sock = None
-                    self.driver_addr = None
-                
-                # Unspecified socket error, report and close socket.
+                # Unspecified socket error.
                 else:
-                    # TBD. Report and close socket.
+                    # The client side has disconnected, report and close socket.
                     self.statusfile.write('read_driver: raised errno %i, %s.\n'
                                           % (e.errno, str(e)))
                     self.statusfile.flush()
-                    self.driver_sock.close()
-                    self.driver_sock = None
-                    self.driver_addr = None
+                    self._close_driver(fileno)
+
+            else:
+                if not data:
+                    # Orderly shutdown by the driver, close socket.
+                    self._close_driver(fileno)
+                    data = None
 
         return data
     
     def write_driver(self, data):
         """
-        Write data to driver, retrying until all has been sent. Log errors
-        to status file. Handles resource unavailable, connection reset by peer,
-        broken pipe and unspecified socket errors.
-        @param data The data string to write to the driver.
+        Write data to all connected drivers, retrying until all has been
+        sent. Log errors to status file. Handles resource unavailable,
+        connection reset by peer, broken pipe and unspecified socket errors.
+        @param data The data string to write to the drivers.
         """
-        if self.driver_sock:
-            sent = 0
-            while len(data)>0:
+        for fileno in self.drivers.keys():
+            sock = self.drivers[fileno][0]
+            remaining = data
+            while len(remaining)>0:
                 try:
-                    sent = self.driver_sock.send(data)
-                    data = data[sent:]
+                    sent = sock.send(remaining)
+                    remaining = remaining[sent:]
 
                 except socket.error as e:                
                     # [Errno 35] Resource temporarily unavailable.
                     if e.errno == errno.EAGAIN:
                         # Occurs when the network write buffer is full.
-                        # Sleep a short period of time and retry.
-                        time.sleep(.1)
+                        # Wait until the socket is writable and retry.
+                        select.select([], [sock], [], .1)
                     
                     # [Errno 54] Connection reset by peer.
-                    elif e.errno == errno.ECONNRESET:
-                        # The client side has disconnected, report and close socket.
-                        self.statusfile.write('read_driver: raised errno %i, %s.\n'
-                                              % (e.errno, str(e)))
-                        self.statusfile.flush()
-                        self.driver_sock.close()
-                        self.driver_sock = None
-                        self.driver_addr = None
-                        break
-                    
                     # [Errno 32] Broken pipe.
-                    elif e.errno == errno.EPIPE:
-                        # Broken pipe, report and close socket.
-                        self.statusfile.write('read_driver: raised errno %i, %s.\n'
-                                              % (e.errno, str(e)))
-                        self.statusfile.flush()
-                        self.driver_sock.close()
-                        self.driver_sock = None
-                        self.driver_addr = None
-                        break
-                    
-                    # Unspecified socket error, report and close socket.
+                    # Unspecified socket error.
                     else:
-                        # TBD. Report and close socket.
-                        self.statusfile.write('read_driver: raised errno %i, %s.\n' % (e.errno, str(e)))
+                        # The client side has disconnected, report and close socket.
+                        self.statusfile.write('write_driver: raised errno %i, %s.\n'
+                                              % (e.errno, str(e)))
                         self.statusfile.flush()
-                        self.driver_sock.close()
-                        self.driver_sock = None
-                        self.driver_addr = None
+                        self._close_driver(fileno)
                         break
                     
     def read_device(self):
@@ -340,6 +468,12 @@ class BaseLoggerProcess(DaemonProcess):
         """
         self._close_device_comms()
         self._close_driver_comms()
+        if self.poller:
+            self.poller.close()
+            self.poller = None
+        if self.logwriter:
+            self.logwriter.sync()
+            self.logwriter = None
         if os.path.exists(self.portfname):
             os.remove(self.portfname)
         if self.statusfile:
@@ -364,12 +498,36 @@ class BaseLoggerProcess(DaemonProcess):
         return pid            
         
      
+    def _forward_driver(self, fileno):
+        """
+        Forward data read from a driver to the device, then log it.
+        @param fileno File descriptor of the driver socket.
+        """
+        driver_data = self.read_driver(fileno)
+        if driver_data:
+            self.write_device(driver_data)
+            self.logwriter.write(self.delim[0]+repr(driver_data)+self.delim[1]+'\n')
+
+    def _forward_device(self):
+        """
+        Forward data read from the device to the drivers, then log it.
+        @retval True if data was read from the device, False otherwise.
+        """
+        device_data = self.read_device()
+        if device_data:
+            self.write_driver(device_data)
+            self.logwriter.write(repr(device_data)+'\n')
+            return True
+        return False
+
     def _run(self):
         """
         Logger run loop. Create and initialize status file, initialize
         device and driver comms and loop while device connected. Loop
-        accepts driver connections, reads driver, writes to device and
-        sniffer, reads device, writes to driver and sniffer and repeats.
+        waits on the driver server, driver and device sockets, accepts driver
+        connections, forwards driver data to the device and device data to
+        all drivers as soon as it arrives, and writes both to the logfile
+        through a buffered writer that is flushed and fsynced periodically.
         Logger is stopped by calling DaemonProcess.stop() resulting in
         SIGTERM signal sent to the logger, or if the device hardware connection
         is lost, whereby the run loop and logger process will terminate.
@@ -392,25 +550,34 @@ class BaseLoggerProcess(DaemonProcess):
             self.statusfile.flush()
             self._cleanup()
             return
+
+        self.logwriter = BufferedLogWriter(self.logfile)
+        self.poller = SocketPoller()
+        server_fileno = self.driver_server_sock.fileno()
+        self.poller.register(server_fileno)
+        device_fileno = self._device_fileno()
+        if device_fileno is not None:
+            self.poller.register(device_fileno)
+            timeout = self.POLL_TIMEOUT
+        else:
+            # The device can't be polled, check it regularly.
+            timeout = self.DEVICE_READ_INTERVAL
         
-        #last_time = time.time()
         while self._device_connected():
-            self._accept_driver_comms()
-            driver_data = self.read_driver()
-            if driver_data:
-                self.write_device(driver_data)
-                self.logfile.write(self.delim[0]+repr(driver_data)+self.delim[1])
-                self.logfile.write('\n')
-                self.logfile.flush()
-            device_data = self.read_device()
-            if device_data:
-                self.write_driver(device_data)
-                self.logfile.write(repr(device_data))
-                self.logfile.write('\n')
-                self.logfile.flush()
-            self._check_parent()
-            if not driver_data and not device_data:
-                time.sleep(.1)
+            ready = self.poller.poll(timeout)
+            for fileno in ready:
+                if fileno == server_fileno:
+                    self._accept_driver_comms()
+                elif fileno in self.drivers:
+                    self._forward_driver(fileno)
+            if device_fileno is None or device_fileno in ready:
+                self._forward_device()
+            if not self._check_parent():
+                # Cleaned up, the comms and log writer are gone.
+                return
+            self.logwriter.poll()
+
+        self.logwriter.sync()
 
 class EthernetDeviceLogger(BaseLoggerProcess):
     """
@@ -523,6 +690,12 @@ class EthernetDeviceLogger(BaseLoggerProcess):
         @retval True on success, False otherwise.
         """
         return self.device_sock != None
+
+    def _device_fileno(self):
+        """
+        File descriptor of the device socket, polled for device data.
+        """
+        return self.device_sock.fileno()
                             
     def read_device(self):
         """
@@ -567,6 +740,16 @@ class EthernetDeviceLogger(BaseLoggerProcess):
                     self.statusfile.flush()
                     self.device_sock.close()
                     self.device_sock = None
+
+            else:
+                if not data:
+                    # Device closed the connection. Report and close
+                    # socket (end logger).
+                    self.statusfile.write('read_device: device disconnected.\n')
+                    self.statusfile.flush()
+                    self.device_sock.close()
+                    self.device_sock = None
+                    data = None
             
         return data
     
@@ -589,8 +772,8 @@ class EthernetDeviceLogger(BaseLoggerProcess):
                     # [Errno 35] Resource temporarily unavailable.
                     if e.errno == errno.EAGAIN:
                         # Occurs when the network write buffer is full.
-                        # Sleep a short period of time and retry.
-                        time.sleep(.1)
+                        # Wait until the socket is writable and retry.
+                        select.select([], [self.device_sock], [], .1)
                     
                     # [Errno 54] Connection reset by peer.
                     elif e.errno == errno.ECONNRESET:
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.port.test.test_logger_process
+@file ion/agents/port/test/test_logger_process.py
+@brief Unit tests for the device logger run loop and log writer.
+"""
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+
+from ion.agents.port.logger_process import EthernetDeviceLogger, BufferedLogWriter
+
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+
+@attr('UNIT', group='mi')
+class TestLoggerProcess(PyonTestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def recv(self, sock, size):
+        data = ''
+        sock.settimeout(5)
+        while len(data) < size:
+            data += sock.recv(size - len(data))
+        return data
+
+    def test_buffered_log_writer(self):
+        logfile = file(self.workdir + 'log.txt', 'w+')
+        self.addCleanup(logfile.close)
+        writer = BufferedLogWriter(logfile, buffer_size=10, flush_interval=60, sync_interval=60)
+        writer.write('abc')
+        writer.poll()
+        self.assertEquals(file(logfile.name).read(), '')
+        # Written out once the buffer fills
+        writer.write('defghijk')
+        self.assertEquals(file(logfile.name).read(), 'abcdefghijk')
+        writer.write('l')
+        writer.flush_interval = 0
+        writer.poll()
+        self.assertEquals(file(logfile.name).read(), 'abcdefghijkl')
+        writer.write('m')
+        writer.sync()
+        self.assertEquals(file(logfile.name).read(), 'abcdefghijklm')
+
+    def test_run(self):
+        device_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(device_server.close)
+        device_server.bind(('127.0.0.1', 0))
+        device_server.listen(1)
+
+        logger = EthernetDeviceLogger('127.0.0.1', device_server.getsockname()[1], 'logger.pid.txt',
+                                      'logger.log.txt', 'logger.status.txt', 'logger.port.txt',
+                                      self.workdir, ['<<', '>>'], None)
+        logger.logfile = file(logger.logfname, 'w+')
+        self.addCleanup(logger._cleanup)
+        run_thread = threading.Thread(target=logger._run)
+        run_thread.start()
+        device, addr = device_server.accept()
+        self.addCleanup(device.close)
+
+        for i in xrange(50):
+            if logger.get_port():
+                break
+            time.sleep(0.1)
+        drivers = [socket.create_connection(('127.0.0.1', logger.get_port())) for i in xrange(2)]
+        for driver in drivers:
+            self.addCleanup(driver.close)
+
+        # Driver data goes to the device, device data goes to every driver
+        drivers[0].sendall('cmd 1\r\n')
+        self.assertEquals(self.recv(device, 7), 'cmd 1\r\n')
+        drivers[1].sendall('cmd 2\r\n')
+        self.assertEquals(self.recv(device, 7), 'cmd 2\r\n')
+        device.sendall('sample\r\n')
+        for driver in drivers:
+            self.assertEquals(self.recv(driver, 8), 'sample\r\n')
+
+        # A driver disconnecting leaves the others connected
+        drivers[0].close()
+        device.sendall('sample 2\r\n')
+        self.assertEquals(self.recv(drivers[1], 10), 'sample 2\r\n')
+
+        # The run loop ends when the device disconnects
+        device.close()
+        run_thread.join(10)
+        self.assertFalse(run_thread.is_alive())
+        self.assertEquals(file(logger.logfname).read(),
+                          "<<'cmd 1\\r\\n'>>\n<<'cmd 2\\r\\n'>>\n'sample\\r\\n'\n'sample 2\\r\\n'\n")
+
+    def test_dead_parent(self):
+        device_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(device_server.close)
+        device_server.bind(('127.0.0.1', 0))
+        device_server.listen(1)
+        parent = subprocess.Popen(['true'])
+        parent.wait()
+
+        logger = EthernetDeviceLogger('127.0.0.1', device_server.getsockname()[1], 'logger.pid.txt',
+                                      'logger.log.txt', 'logger.status.txt', 'logger.port.txt',
+                                      self.workdir, ['<<', '>>'], parent.pid)
+        logger.logfile = file(logger.logfname, 'w+')
+        self.addCleanup(logger._cleanup)
+
+        # The run loop ends once the parent is found to be gone
+        logger._run()
+        self.assertIsNone(logger.logwriter)
+        self.assertIsNone(logger.get_port())
+        self.assertIn('parent process not detected', file(logger.statusfname).read())
@@ -6,6 +6,7 @@
 @description Ingestion Process
 '''
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
+from ion.services.dm.utility.coverage_cache import CoverageCache
 from ion.services.dm.utility.granule_utils import time_series_domain
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
 from pyon.core.exception import CorruptionError, NotFound, BadRequest
@@ -46,6 +47,9 @@ MAX_RETRY_TIME=3600
 
 class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker):
     CACHE_LIMIT=CFG.get_safe('container.ingestion_cache',5)
+    # Micro-batching: 0 records disables batching and every granule is persisted as it arrives
+    BATCH_RECORDS=CFG.get_safe('container.ingestion_batch.max_records',0)
+    BATCH_AGE=CFG.get_safe('container.ingestion_batch.max_age',5.0)
 
     def __init__(self, *args,**kwargs):
         TransformStreamListener.__init__(self, *args, **kwargs)
@@ -54,13 +58,26 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         #--------------------------------------------------------------------------------
         # Ingestion Cache
         # - Datasets
-        # - Coverage instances
+        # - Streams with a coverage instance open in the container coverage cache
         #--------------------------------------------------------------------------------
         self._datasets  = collections.OrderedDict()
         self._coverages = collections.OrderedDict()
 
         self._bad_coverages = {}
 
+        #--------------------------------------------------------------------------------
+        # Granule batches
+        # - stream_id -> list of buffered RDTs
+        # - stream_id -> (time the first granule was buffered, number of records)
+        #--------------------------------------------------------------------------------
+        self._batches = {}
+        self._batch_info = {}
+        self._batch_lock = RLock()
+        self.batch_records = self.BATCH_RECORDS
+        self.batch_age = self.BATCH_AGE
+        self._batch_flusher = None
+        self._batch_shutdown = event.Event()
+
         self.time_stats = Accumulator(format='%3f')
         # unique ID to identify this worker in log msgs
         self._id = uuid.uuid1()
@@ -99,19 +116,25 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         self.add_endpoint(self.lookup_monitor)
         self.connection_id = ''
         self.connection_index = None
+
+        self.batch_records = self.CFG.get_safe('process.batch.max_records', self.BATCH_RECORDS)
+        self.batch_age = self.CFG.get_safe('process.batch.max_age', self.BATCH_AGE)
+        if self.batch_records:
+            self._batch_flusher = self._process.thread_manager.spawn(self.batch_flush_loop, thread_name='%s-batch-flusher' % self.id)
         
         self.start_listener()
 
     def on_quit(self): #pragma no cover
-        self.event_publisher.close()
+        self._batch_shutdown.set()
+        if self._batch_flusher:
+            self._batch_flusher.join(timeout=10)
+            self._batch_flusher = None
         if self.subscriber_thread:
             self.stop_listener()
-        for stream, coverage in self._coverages.iteritems():
-            try:
-                coverage.close(timeout=5)
-            except:
-                log.exception('Problems closing the coverage')
-        self._coverages.clear()
+        else:
+            self.flush_batches()
+        self.event_publisher.close()
+        self.close_coverages()
         TransformStreamListener.on_quit(self)
         BaseIngestionWorker.on_quit(self)
 
@@ -126,12 +149,8 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         with self.thread_lock:
             self.subscriber.close()
             self.subscriber_thread.join(timeout=10)
-            for stream, coverage in self._coverages.iteritems():
-                try:
-                    coverage.close(timeout=5)
-                except:
-                    log.exception('Problems closing the coverage')
-            self._coverages.clear()
+            self.flush_batches()
+            self.close_coverages()
             self.subscriber_thread = None
 
     def pause(self):
@@ -349,23 +368,37 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
 
     def get_coverage(self, stream_id):
         '''
-        Memoization (LRU) of _get_coverage
+        Returns the append mode coverage for the stream from the container's
+        coverage cache, the caller releases it with release_coverage
         '''
-        try:
-            result = self._coverages.pop(stream_id)
-        except KeyError:
-            dataset_id = self.get_dataset(stream_id)
-            if dataset_id is None:
-                return None
-            result = DatasetManagementService._get_simplex_coverage(dataset_id, mode='a')
-            if result is None:
-                return None
-            if len(self._coverages) >= self.CACHE_LIMIT:
-                k, coverage = self._coverages.popitem(0)
-                coverage.close(timeout=5)
-        self._coverages[stream_id] = result
+        dataset_id = self.get_dataset(stream_id)
+        if dataset_id is None:
+            return None
+        result = CoverageCache.get_instance(self.container).get(dataset_id, mode='a', loader='simplex')
+        if result is None:
+            return None
+        self._coverages[stream_id] = dataset_id
         return result
 
+    def release_coverage(self, coverage):
+        CoverageCache.get_instance(self.container).release(coverage)
+
+    def eject_coverage(self, stream_id):
+        '''
+        Closes the stream's coverage so the next granule reopens it
+        '''
+        dataset_id = self._coverages.pop(stream_id, None)
+        if dataset_id is not None:
+            CoverageCache.get_instance(self.container).eject(dataset_id, mode='a')
+
+    def close_coverages(self):
+        for stream_id in self._coverages.keys():
+            try:
+                self.eject_coverage(stream_id)
+            except:
+                log.exception('Problems closing the coverage')
+        self._coverages.clear()
+
 
     #--------------------------------------------------------------------------------
     # Granule Parsing and Handling
@@ -397,7 +430,103 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
             log.debug('Empty granule for stream %s', stream_id)
             return
 
-        self.persist_or_timeout(stream_id, rdt)
+        if self.batch_records:
+            self.buffer_granule(stream_id, rdt)
+        else:
+            self.persist_or_timeout(stream_id, rdt)
+
+    #--------------------------------------------------------------------------------
+    # Granule Batching
+    #--------------------------------------------------------------------------------
+
+    def batch_signature(self, rdt):
+        '''
+        Granules can only be merged if they set the same fields and carry the
+        same sparse (constant) values.
+        '''
+        signature = []
+        for k,v in rdt.iteritems():
+            if isinstance(rdt.param_type(k), SparseConstantType):
+                value = np.atleast_1d(v)[0]
+                if hasattr(value, 'tolist'):
+                    value = value.tolist()
+                signature.append((k, repr(value)))
+            else:
+                signature.append((k,))
+        signature.sort()
+        return tuple(signature)
+
+    def buffer_granule(self, stream_id, rdt):
+        '''
+        Buffers the granule for the stream, the buffer is flushed once it
+        reaches batch_records records or its oldest granule is batch_age
+        seconds old. Incompatible granules flush the buffer first so order is
+        preserved.
+        '''
+        with self._batch_lock:
+            batch = self._batches.get(stream_id)
+            if batch and self.batch_signature(batch[-1]) != self.batch_signature(rdt):
+                # If this fails the granule isn't accepted and the buffer is kept
+                self.flush_stream(stream_id)
+                batch = None
+            if not batch:
+                self._batches[stream_id] = [rdt]
+                self._batch_info[stream_id] = (time.time(), len(rdt))
+            else:
+                batch.append(rdt)
+                started, records = self._batch_info[stream_id]
+                self._batch_info[stream_id] = (started, records + len(rdt))
+
+            started, records = self._batch_info[stream_id]
+            if records >= self.batch_records or (time.time() - started) >= self.batch_age:
+                try:
+                    self.flush_stream(stream_id)
+                except Exception:
+                    # The granule is buffered, the flusher retries the batch
+                    log.exception('Failed to flush the batch for stream %s, keeping it buffered', stream_id)
+
+    def flush_stream(self, stream_id):
+        '''
+        Merges the buffered granules for a stream and persists them with a
+        single coverage write, metadata update and DatasetModified event.
+        If persisting fails the granules stay buffered and the exception is
+        raised.
+        '''
+        with self._batch_lock:
+            batch = self._batches.get(stream_id)
+            if not batch:
+                return
+            rdt = RecordDictionaryTool.concatenate(batch)
+            log.trace('Flushing %s granules (%s records) for stream %s', len(batch), len(rdt), stream_id)
+            self.persist_or_timeout(stream_id, rdt)
+            self._batches.pop(stream_id, None)
+            self._batch_info.pop(stream_id, None)
+
+    def flush_batches(self, max_age=None):
+        '''
+        Flushes every buffered stream, or only the streams whose buffer is at
+        least max_age seconds old. Streams that fail to flush stay buffered.
+        '''
+        with self._batch_lock:
+            now = time.time()
+            for stream_id, (started, records) in self._batch_info.items():
+                if max_age is None or (now - started) >= max_age:
+                    try:
+                        self.flush_stream(stream_id)
+                    except Exception:
+                        log.exception('Failed to flush the batch for stream %s', stream_id)
+
+    def batch_flush_loop(self):
+        '''
+        Flushes buffers on streams that have gone quiet before reaching the
+        record limit.
+        '''
+        interval = max(self.batch_age / 2., 0.1)
+        while not self._batch_shutdown.wait(timeout=interval):
+            try:
+                self.flush_batches(max_age=self.batch_age)
+            except Exception:
+                log.exception('Failed to flush ingestion batches')
 
     def persist_or_timeout(self, stream_id, rdt):
         '''
@@ -418,7 +547,7 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
 
             if stream_id in self._coverages:
                 log.info('Popping coverage for stream %s', stream_id)
-                self._coverages.pop(stream_id)
+                self.eject_coverage(stream_id)
 
             gevent.sleep(timeout)
 
@@ -529,15 +658,19 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         # Actual persistence
         #--------------------------------------------------------------------------------
 
-        if rdt[rdt.temporal_parameter] is None:
-            log.warning("Empty granule received")
-            return
+        try:
+            if rdt[rdt.temporal_parameter] is None:
+                log.warning("Empty granule received")
+                return
 
-        # Parse the RDT and set hte values in the coverage
-        self.insert_values(coverage, rdt, stream_id)
-        
-        # Force the data to be flushed
-        DatasetManagementService._save_coverage(coverage)
+            # Parse the RDT and set hte values in the coverage
+            self.insert_values(coverage, rdt, stream_id)
+            
+            # Force the data to be flushed
+            DatasetManagementService._save_coverage(coverage)
+        finally:
+            # Other workers may share the handle, it is only closed once all of them let go
+            self.release_coverage(coverage)
 
         self.update_metadata(dataset_id, rdt)
 
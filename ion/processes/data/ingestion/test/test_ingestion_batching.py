@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/ingestion/test/test_ingestion_batching.py
+@brief Unit tests for the micro-batched coverage writes of the ingestion worker
+'''
+
+from ion.processes.data.ingestion.science_granule_ingestion_worker import ScienceGranuleIngestionWorker
+from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock
+from gevent.coros import RLock
+
+from coverage_model import ParameterDictionary, ParameterContext
+from coverage_model.parameter_types import QuantityType
+
+import gevent
+import time
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TestIngestionBatching(PyonTestCase):
+    def setUp(self):
+        pdict = ParameterDictionary()
+        pdict.add_context(ParameterContext('time', param_type=QuantityType(value_encoding='float64')), is_temporal=True)
+        pdict.add_context(ParameterContext('temp', param_type=QuantityType(value_encoding='float32')))
+        self.pdict = pdict
+
+        self.worker = ScienceGranuleIngestionWorker()
+        self.worker.batch_records = 25
+        self.worker.batch_age = 60
+        self.persisted = []
+        self.fail = False
+        self.worker.persist_or_timeout = Mock(side_effect=self.persist)
+
+    def persist(self, stream_id, rdt):
+        if self.fail:
+            raise IOError('coverage is unavailable')
+        self.persisted.append((stream_id, rdt['time'].tolist()))
+
+    def granule(self, start, count=10):
+        rdt = RecordDictionaryTool(param_dictionary=self.pdict)
+        rdt['time'] = np.arange(start, start + count, dtype=np.float64)
+        rdt['temp'] = np.arange(count, dtype=np.float32)
+        return rdt.to_granule()
+
+    def recv(self, start, stream_id='stream1'):
+        self.worker.recv_packet(self.granule(start), None, stream_id)
+
+    def test_size_flush(self):
+        self.recv(0)
+        self.recv(10)
+        self.assertEquals(self.persisted, [])
+        self.recv(20)
+        # One write for the three granules
+        self.assertEquals(self.persisted, [('stream1', range(30))])
+        self.assertEquals(self.worker._batches, {})
+
+        self.recv(30)
+        self.worker.flush_batches()
+        self.assertEquals(self.persisted, [('stream1', range(30)), ('stream1', range(30, 40))])
+
+    def test_interval_flush(self):
+        self.recv(0)
+        self.recv(0, stream_id='stream2')
+        # Only buffers older than max_age are flushed
+        self.worker._batch_info['stream1'] = (time.time() - 120, 10)
+        self.worker.flush_batches(max_age=60)
+        self.assertEquals(self.persisted, [('stream1', range(10))])
+
+        # The flusher picks up streams that went quiet
+        self.worker.batch_age = 0.05
+        flusher = gevent.spawn(self.worker.batch_flush_loop)
+        gevent.sleep(0.3)
+        self.worker._batch_shutdown.set()
+        flusher.join(timeout=5)
+        self.assertEquals(self.persisted, [('stream1', range(10)), ('stream2', range(10))])
+
+    def test_flush_on_stop(self):
+        self.worker.subscriber = Mock()
+        self.worker.subscriber_thread = Mock()
+        self.worker.thread_lock = RLock()
+        self.recv(0)
+        self.recv(10)
+        self.worker.stop_listener()
+        self.assertEquals(self.persisted, [('stream1', range(20))])
+        self.assertEquals(self.worker._batches, {})
+
+    def test_flush_failure(self):
+        self.recv(0)
+        self.recv(10)
+        self.fail = True
+        # The flush fails, the granules stay buffered
+        self.recv(20)
+        self.worker.flush_batches()
+        self.assertEquals(self.persisted, [])
+        self.assertEquals(len(self.worker._batches['stream1']), 3)
+
+        # And are written once, in order, when the coverage comes back
+        self.fail = False
+        self.recv(30)
+        self.assertEquals(self.persisted, [('stream1', range(40))])
+        self.worker.flush_batches()
+        self.assertEquals(self.persisted, [('stream1', range(40))])
@@ -6,6 +6,7 @@
 @description Implementation for a replay process.
 '''
 
+from pyon.container.cc import Container
 from pyon.core.exception import BadRequest
 from pyon.core.object import IonObjectDeserializer
 from pyon.core.bootstrap import get_obj_registry
@@ -14,6 +15,7 @@ from pyon.util.log import log
 
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.coverage_cache import CoverageCache
 from ion.util.time_utils import TimeUtils
 
 from coverage_model import utils
@@ -48,11 +50,16 @@ class ReplayProcess(BaseReplayProcess):
         start_time: 0         # Start time (index value) to be replayed
         end_time:   0         # End time (index value) to be replayed
         parameters: []        # List of parameters to form in the granule
+        publish_limit: 10     # Maximum number of records in each published granule
+        segment_records: 10000 # Number of records to aim for in each time segment read from the coverage
+        segment_length: 0     # Fixed length (in seconds) of the time segments, overrides segment_records
       
 
     '''
     process_type  = 'standalone'
     publish_limit = 10
+    segment_length  = None
+    segment_records = 10000
     dataset_id    = None
     delivery_format = {}
     start_time      = None
@@ -86,6 +93,8 @@ class ReplayProcess(BaseReplayProcess):
         self.stride_time     = self.CFG.get_safe('process.query.stride_time', None)
         self.parameters      = self.CFG.get_safe('process.query.parameters',None)
         self.publish_limit   = self.CFG.get_safe('process.query.publish_limit', 10)
+        self.segment_length  = self.CFG.get_safe('process.query.segment_length', None)
+        self.segment_records = self.CFG.get_safe('process.query.segment_records', 10000)
         self.tdoa            = self.CFG.get_safe('process.query.tdoa',None)
         self.stream_id       = self.CFG.get_safe('process.publish_streams.output', '')
         self.stream_def      = pubsub.read_stream_definition(stream_id=self.stream_id)
@@ -119,8 +128,10 @@ class ReplayProcess(BaseReplayProcess):
         return corrected_time
 
     @classmethod
-    def _data_dict_to_rdt(cls, data_dict, stream_def_id, coverage):
-        if stream_def_id:
+    def _data_dict_to_rdt(cls, data_dict, stream_def_id, coverage, stream_definition=None):
+        if stream_definition:
+            rdt = RecordDictionaryTool(stream_definition=stream_definition)
+        elif stream_def_id:
             rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
         else:
             rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
@@ -133,19 +144,18 @@ class ReplayProcess(BaseReplayProcess):
             return rdt
 
 
-        rdt[coverage.temporal_parameter_name] = data_dict[coverage.temporal_parameter_name]
+        # The values have already been inside a coverage so we know they're safe and they exist, they don't need to be checked for fill values.
+        rdt.set_trusted(coverage.temporal_parameter_name, data_dict[coverage.temporal_parameter_name])
         for field in rdt.fields:
             if field == coverage.temporal_parameter_name:
                 continue
-            # The values have already been inside a coverage so we know they're safe and they exist, so they can be inserted directly.
             if field in data_dict:
-                rdt._rd[field] = data_dict[field]
-            #rdt[k] = v
+                rdt.set_raw(field, data_dict[field])
 
         return rdt
 
     @classmethod
-    def _cov2granule(cls, coverage, start_time=None, end_time=None, stride_time=None, stream_def_id=None, parameters=None, tdoa=None, sort_parameter=None):
+    def _cov2granule(cls, coverage, start_time=None, end_time=None, stride_time=None, stream_def_id=None, parameters=None, tdoa=None, sort_parameter=None, dataset_id=None):
         # Deal with the NTP
         if start_time:
             start_time += 2208988800
@@ -158,9 +168,15 @@ class ReplayProcess(BaseReplayProcess):
             else:
                 data_dict = coverage.get_parameter_values(param_names=parameters, time_segment=(start_time, end_time), stride_length=stride_time, fill_empty_params=True, sort_parameter=sort_parameter).get_data()
         elif isinstance(tdoa, slice):
-            log.warning("Using tdoa argument on large datasets can consume too much memory")
-            data_dict = coverage.get_parameter_values(param_names=parameters, fill_empty_params=True).get_data()
-            data_dict = { k : v[tdoa] for k,v in data_dict.iteritems() }
+            time_segment, indices = cls._resolve_tdoa(coverage, tdoa, dataset_id)
+            if time_segment is None:
+                data_dict = {}
+            else:
+                tname = coverage.temporal_parameter_name
+                data_dict = coverage.get_parameter_values(param_names=parameters, time_segment=time_segment, fill_empty_params=True, sort_parameter=tname).get_data()
+                if tname in data_dict:
+                    indices = indices[indices < data_dict[tname].shape[0]]
+                data_dict = { k : v[indices] for k,v in data_dict.iteritems() }
         else:
             raise TypeError("tdoa is incorrect type: %s" % type(tdoa))
 
@@ -168,53 +184,122 @@ class ReplayProcess(BaseReplayProcess):
        
 
 
+    @classmethod
+    def _resolve_tdoa(cls, coverage, tdoa, dataset_id=None):
+        '''
+        Translates a tdoa slice into the bounded time segment it spans and the
+        indices, relative to that segment, of the records the slice selects.
+        The slice is resolved against the number of timesteps, then only the
+        time values from whichever end of the dataset is closer to the slice
+        are read (see _tail_times), the other parameters are read for the
+        segment alone. Returns (None, None) if the slice selects nothing.
+        '''
+        count = coverage.num_timesteps()
+        indices = np.arange(*tdoa.indices(count))
+        if not indices.shape[0]:
+            return None, None
+        lo, hi = indices.min(), indices.max()
+        if count - lo <= hi + 1:
+            times = cls._tail_times(coverage, dataset_id, count - lo)
+            offset = count - times.shape[0]
+        else:
+            times = cls._head_times(coverage, dataset_id, hi + 1)
+            offset = 0
+        t0 = times[lo - offset]
+        t1 = times[hi - offset]
+        # Records sharing the first timestamp that precede the slice are in the segment too
+        first = offset + np.searchsorted(times, t0, side='left')
+        return (np.asscalar(t0), np.asscalar(t1)), indices - first
+
     def execute_retrieve(self):
         '''
         execute_retrieve Executes a retrieval and returns the result 
         as a value in lieu of publishing it on a stream
         '''
         try: 
-            coverage = DatasetManagementService._get_coverage(self.dataset_id,mode='r')
-            if coverage.is_empty():
-                log.info('Reading from an empty coverage')
-                rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
-            else: 
-                rdt = ReplayProcess._cov2granule(coverage=coverage, 
-                        start_time=self.start_time, 
-                        end_time=self.end_time,
-                        stride_time=self.stride_time, 
-                        parameters=self.parameters, 
-                        stream_def_id=self.delivery_format, 
-                        tdoa=self.tdoa)
+            with CoverageCache.get_instance().hold(self.dataset_id, mode='r') as coverage:
+                if coverage.is_empty():
+                    log.info('Reading from an empty coverage')
+                    rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
+                else: 
+                    rdt = ReplayProcess._cov2granule(coverage=coverage, 
+                            start_time=self.start_time, 
+                            end_time=self.end_time,
+                            stride_time=self.stride_time, 
+                            parameters=self.parameters, 
+                            stream_def_id=self.delivery_format, 
+                            tdoa=self.tdoa,
+                            dataset_id=self.dataset_id)
         except:
+            CoverageCache.get_instance().eject(self.dataset_id, mode='r')
             log.exception('Problems reading from the coverage')
             raise BadRequest('Problems reading from the coverage')
-        finally:
-            coverage.close(timeout=5)
         return rdt.to_granule()
 
+    @classmethod
+    def _tail_times(cls, coverage, dataset_id, number_of_points):
+        '''
+        Returns the sorted time values of at least the last number_of_points
+        records (or all of them if there are fewer). The time bounds and record
+        count in the dataset's metadata document give a time window at the end
+        of the dataset expected to hold that many records, the window is
+        doubled until it does, so the read scales with number_of_points rather
+        than with the length of the dataset.
+        '''
+        return cls._edge_times(coverage, dataset_id, number_of_points, tail=True)
+
+    @classmethod
+    def _head_times(cls, coverage, dataset_id, number_of_points):
+        '''
+        Returns the sorted time values of at least the first number_of_points
+        records, see _tail_times
+        '''
+        return cls._edge_times(coverage, dataset_id, number_of_points, tail=False)
+
+    @classmethod
+    def _edge_times(cls, coverage, dataset_id, number_of_points, tail=True):
+        tname = coverage.temporal_parameter_name
+        try:
+            doc = Container.instance.object_store.read_doc(dataset_id)
+            t_min, t_max = doc['bounds'][tname]
+            extents = doc['extents'][tname]
+        except Exception:
+            log.debug('No metadata for %s, reading all of the time values', dataset_id)
+            return coverage.get_parameter_values([tname], sort_parameter=tname).get_data()[tname]
+
+        span = t_max - t_min
+        window = span
+        if extents and span > 0:
+            window = span * min(1., 1.5 * number_of_points / float(extents))
+        while True:
+            if window >= span:
+                return coverage.get_parameter_values([tname], sort_parameter=tname).get_data()[tname]
+            # Open ended in case data arrived after the metadata was updated
+            time_segment = (t_max - window, None) if tail else (None, t_min + window)
+            times = coverage.get_parameter_values([tname], time_segment=time_segment, sort_parameter=tname).get_data()[tname]
+            if times.shape[0] >= number_of_points:
+                return times
+            window *= 2
+
     @classmethod
     def get_last_values(cls, dataset_id, number_of_points=100, delivery_format=''):
         stream_def_id = delivery_format
         try:
-            cov = DatasetManagementService._get_coverage(dataset_id, mode='r')
-            if cov.is_empty():
-                rdt = RecordDictionaryTool(param_dictionary=cov.parameter_dictionary)
-            else:
-                time_array = cov.get_parameter_values([cov.temporal_parameter_name], sort_parameter=cov.temporal_parameter_name).get_data()
-                time_array = time_array[cov.temporal_parameter_name][-number_of_points:]
+            with CoverageCache.get_instance().hold(dataset_id, mode='r') as cov:
+                if cov.is_empty():
+                    rdt = RecordDictionaryTool(param_dictionary=cov.parameter_dictionary)
+                else:
+                    time_array = cls._tail_times(cov, dataset_id, number_of_points)[-number_of_points:]
 
-                t0 = np.asscalar(time_array[0])
-                t1 = np.asscalar(time_array[-1])
+                    t0 = np.asscalar(time_array[0])
+                    t1 = np.asscalar(time_array[-1])
 
-                data_dict = cov.get_parameter_values(time_segment=(t0, t1), fill_empty_params=True).get_data()
-                rdt = cls._data_dict_to_rdt(data_dict, stream_def_id, cov)
+                    data_dict = cov.get_parameter_values(time_segment=(t0, t1), fill_empty_params=True).get_data()
+                    rdt = cls._data_dict_to_rdt(data_dict, stream_def_id, cov)
         except:
+            CoverageCache.get_instance().eject(dataset_id, mode='r')
             log.exception('Problems reading from the coverage')
             raise BadRequest('Problems reading from the coverage')
-        finally:
-            if cov is not None:
-                cov.close(timeout=5)
         return rdt
 
 
@@ -229,11 +314,16 @@ class ReplayProcess(BaseReplayProcess):
 
     def replay(self):
         self.publishing.set() # Minimal state, supposed to prevent two instances of the same process from replaying on the same stream
-        for rdt in self._replay():
-            if self.end.is_set():
-                return
-            self.play.wait()
-            self.output.publish(rdt.to_granule())
+        replay = self._replay()
+        try:
+            for rdt in replay:
+                if self.end.is_set():
+                    return
+                self.play.wait()
+                self.output.publish(rdt.to_granule())
+        finally:
+            # Releases the coverage when the replay is stopped early
+            replay.close()
 
         self.publishing.clear()
         return 
@@ -247,20 +337,100 @@ class ReplayProcess(BaseReplayProcess):
     def stop(self):
         self.end.set()
 
+    @classmethod
+    def time_segments(cls, start_time, end_time, segment_length):
+        '''
+        Yields consecutive (t0, t1) segments covering [start_time, end_time]
+        '''
+        if start_time == end_time:
+            yield (start_time, end_time)
+            return
+        segment_length = segment_length or (end_time - start_time)
+        while start_time < end_time:
+            yield (start_time, min(start_time + segment_length, end_time))
+            start_time = min(start_time + segment_length, end_time)
+
+    @classmethod
+    def estimate_segment_length(cls, start_time, end_time, num_records, segment_records):
+        '''
+        Returns the length of the time segments expected to hold
+        segment_records records each, assuming the records are spread evenly
+        between start_time and end_time. 0 means a single segment.
+        '''
+        span = end_time - start_time
+        if span <= 0 or not segment_records or num_records <= segment_records:
+            return 0
+        return span * segment_records / float(num_records)
+
+    def _time_bounds(self, coverage):
+        '''
+        Returns the (min, max) of the coverage's time values, using the
+        dataset's metadata document when it's available.
+        '''
+        tname = coverage.temporal_parameter_name
+        try:
+            doc = self.container.object_store.read_doc(self.dataset_id)
+            return tuple(doc['bounds'][tname])
+        except Exception:
+            log.debug('No time bounds in the metadata for %s, reading the time values', self.dataset_id)
+        times = coverage.get_parameter_values([tname]).get_data()[tname]
+        if not times.shape[0]:
+            return None
+        return (np.min(times), np.max(times))
+
     def _replay(self):
-        coverage = DatasetManagementService._get_coverage(self.dataset_id,mode='r')
-        rdt = self._cov2granule(coverage=coverage, start_time=self.start_time, end_time=self.end_time, stride_time=self.stride_time, parameters=self.parameters, stream_def_id=self.stream_def_id)
-        elements = len(rdt)
-        
-        for i in xrange(elements / self.publish_limit):
-            outgoing = RecordDictionaryTool(stream_definition_id=self.stream_def_id)
-            fields = self.parameters or outgoing.fields
-            for field in fields:
-                v = rdt[field]
-                if v is not None:
-                    outgoing[field] = v[(i*self.publish_limit) : ((i+1)*self.publish_limit)]
-            yield outgoing
-        coverage.close(timeout=5)
+        '''
+        Reads the coverage one time segment at a time and yields granules of
+        at most publish_limit records. Only one segment is held in memory, and
+        since this is a generator nothing more is read while the replay is
+        paused. The coverage handle is held until the generator finishes.
+        '''
+        with CoverageCache.get_instance().hold(self.dataset_id, mode='r') as coverage:
+            for rdt in self._replay_coverage(coverage):
+                yield rdt
+
+    def _replay_coverage(self, coverage):
+        if coverage.is_empty():
+            return
+        tname = coverage.temporal_parameter_name
+        bounds = self._time_bounds(coverage)
+        if bounds is None:
+            return
+        start_time, end_time = bounds
+        segment_length = self.segment_length
+        if not segment_length:
+            # Sized from the record density so sparse datasets aren't read in mostly empty segments
+            segment_length = self.estimate_segment_length(start_time, end_time, coverage.num_timesteps(), self.segment_records)
+        # Deal with the NTP
+        if self.start_time:
+            start_time = max(start_time, self.start_time + 2208988800)
+        if self.end_time:
+            end_time = min(end_time, self.end_time + 2208988800)
+
+        parameters = self.parameters
+        if parameters and tname not in parameters:
+            parameters = list(parameters) + [tname]
+
+        last_time = None
+        for t0, t1 in self.time_segments(start_time, end_time, segment_length):
+            if self.end.is_set():
+                return
+            data_dict = coverage.get_parameter_values(param_names=parameters, time_segment=(t0, t1), stride_length=self.stride_time, fill_empty_params=True, sort_parameter=tname).get_data()
+            if not data_dict or tname not in data_dict:
+                continue
+            # Segments share their boundaries, skip records that were already published
+            if last_time is not None:
+                mask = data_dict[tname] > last_time
+                if not mask.all():
+                    data_dict = { k : v[mask] for k,v in data_dict.iteritems() }
+            elements = data_dict[tname].shape[0]
+            if not elements:
+                continue
+            last_time = data_dict[tname][-1]
+
+            for i in xrange(0, elements, self.publish_limit):
+                chunk = { k : v[i:i+self.publish_limit] for k,v in data_dict.iteritems() }
+                yield self._data_dict_to_rdt(chunk, self.stream_def_id, coverage, stream_definition=self.stream_def)
         return 
 
 class RetrieveProcess:
@@ -275,17 +445,20 @@ class RetrieveProcess:
         '''
         Returns all of the values between time1 and time2
         '''
-        coverage = self.get_coverage()
         # Convert python datetimes to unix timestamps
         if isinstance(time1, datetime):
             time1 = calendar.timegm(time1.timetuple())
         if isinstance(time2, datetime):
             time2 = calendar.timegm(time2.timetuple())
 
-        rdt = ReplayProcess._cov2granule(coverage, time1, time2)
+        with CoverageCache.get_instance().hold(self.dataset_id, mode='r') as coverage:
+            rdt = ReplayProcess._cov2granule(coverage, time1, time2)
         return rdt
 
     def get_coverage(self):
+        '''
+        Returns a read coverage owned by the caller, who closes it
+        '''
         return DatasetManagementService._get_coverage(self.dataset_id, mode='r')
 
 
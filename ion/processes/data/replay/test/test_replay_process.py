@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/replay/test/test_replay_process.py
+@brief Unit tests for the replay process
+'''
+
+from ion.processes.data.replay.replay_process import ReplayProcess
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TestReplayProcess(PyonTestCase):
+    def test_time_segments(self):
+        segments = list(ReplayProcess.time_segments(0, 10, 4))
+        self.assertEquals(segments, [(0, 4), (4, 8), (8, 10)])
+
+        # A single record still gets a segment
+        self.assertEquals(list(ReplayProcess.time_segments(5, 5, 4)), [(5, 5)])
+
+        # No segment length reads it all at once
+        self.assertEquals(list(ReplayProcess.time_segments(0, 10, 0)), [(0, 10)])
+
+        self.assertEquals(list(ReplayProcess.time_segments(10, 0, 4)), [])
+
+    def test_estimate_segment_length(self):
+        self.assertEquals(ReplayProcess.estimate_segment_length(0, 1000, 10000, 100), 10.)
+        # Fewer records than a segment holds are read at once
+        self.assertEquals(ReplayProcess.estimate_segment_length(0, 1000, 50, 100), 0)
+        self.assertEquals(ReplayProcess.estimate_segment_length(5, 5, 10000, 100), 0)
+
+    def replay_sparse(self, times, segment_records):
+        reads = []
+        def get_parameter_values(param_names=None, time_segment=None, **kwargs):
+            reads.append(time_segment)
+            mask = np.ones(times.shape, dtype=bool)
+            if time_segment:
+                mask = (times >= time_segment[0]) & (times <= time_segment[1])
+            values = Mock()
+            values.get_data.return_value = {'time' : times[mask], 'temp' : times[mask] * 2}
+            return values
+
+        coverage = self.get_time_coverage(times)
+        coverage.is_empty.return_value = False
+        coverage.num_timesteps.return_value = times.shape[0]
+        coverage.get_parameter_values.side_effect = get_parameter_values
+
+        replay = ReplayProcess()
+        replay.container = Mock()
+        replay.container.object_store.read_doc.side_effect = KeyError('dataset_id')
+        replay.dataset_id = 'dataset_id'
+        replay.publish_limit = 10
+        replay.stream_def = None
+        replay.segment_records = segment_records
+        replay._data_dict_to_rdt = lambda data_dict, *args, **kwargs: data_dict
+        chunks = list(replay._replay_coverage(coverage))
+        # The bounds are read from the time values, then one read per segment
+        return np.concatenate([chunk['time'] for chunk in chunks]), reads[1:]
+
+    def test_replay_sparse(self):
+        # 50 records spread over five years
+        rs = np.random.RandomState(0)
+        times = np.sort(rs.uniform(3.5e9, 3.5e9 + 5 * 365 * 86400, 50))
+        replayed, reads = self.replay_sparse(times, 10000)
+        np.testing.assert_array_equal(replayed, times)
+        # Not one read per hour
+        self.assertEquals(len(reads), 1)
+
+        # Segments are sized from the record density
+        times = np.sort(rs.uniform(3.5e9, 3.5e9 + 5 * 365 * 86400, 1000))
+        replayed, reads = self.replay_sparse(times, 100)
+        np.testing.assert_array_equal(replayed, times)
+        self.assertEquals(len(reads), 10)
+
+    def get_time_coverage(self, times):
+        coverage = Mock()
+        coverage.temporal_parameter_name = 'time'
+        coverage.get_parameter_values.return_value.get_data.return_value = {'time' : times}
+        return coverage
+
+    @patch('ion.processes.data.replay.replay_process.Container')
+    def test_resolve_tdoa(self, container):
+        times = np.array([0., 1., 2., 2., 3., 4., 5., 6., 7., 8.] + range(9, 999), dtype=np.float64)
+        container.instance.object_store.read_doc.return_value = {'bounds' : {'time' : (0., 998.)}, 'extents' : {'time' : 1000}}
+        reads = []
+        def get_parameter_values(param_names, time_segment=None, sort_parameter=None):
+            reads.append(time_segment)
+            mask = np.ones(times.shape, dtype=bool)
+            if time_segment and time_segment[0] is not None:
+                mask &= times >= time_segment[0]
+            if time_segment and time_segment[1] is not None:
+                mask &= times <= time_segment[1]
+            values = Mock()
+            values.get_data.return_value = {'time' : times[mask]}
+            return values
+        coverage = Mock()
+        coverage.temporal_parameter_name = 'time'
+        coverage.num_timesteps.return_value = times.shape[0]
+        coverage.get_parameter_values.side_effect = get_parameter_values
+
+        def check(tdoa):
+            del reads[:]
+            segment, indices = ReplayProcess._resolve_tdoa(coverage, tdoa, 'dataset_id')
+            window = times[(times >= segment[0]) & (times <= segment[1])]
+            np.testing.assert_array_equal(window[indices], times[tdoa])
+            return segment
+
+        # Last three points, only a window at the end of the dataset is read
+        self.assertEquals(check(slice(-3, None)), (996., 998.))
+        self.assertEquals(len(reads), 1)
+        self.assertTrue(reads[0][0] > 990 and reads[0][1] is None)
+        self.assertEquals(check(slice(-10, None, -3)), (0., 989.))
+
+        # Duplicate timestamps before the slice are part of the segment
+        self.assertEquals(check(slice(3, 6)), (2., 4.))
+        self.assertEquals(len(reads), 1)
+        self.assertTrue(reads[0][0] is None and reads[0][1] < 10)
+
+        # Negative steps
+        self.assertEquals(check(slice(None, None, -2)), (1., 998.))
+        self.assertEquals(check(slice(-1, -6, -2)), (994., 998.))
+
+        # Without metadata all of the time values are read
+        container.instance.object_store.read_doc.side_effect = KeyError('dataset_id')
+        self.assertEquals(check(slice(-3, None)), (996., 998.))
+        self.assertEquals(reads, [None])
+
+        self.assertEquals(ReplayProcess._resolve_tdoa(coverage, slice(5, 5)), (None, None))
+
+    @patch('ion.processes.data.replay.replay_process.Container')
+    def test_tail_times(self, container):
+        times = np.arange(1000, dtype=np.float64)
+        container.instance.object_store.read_doc.return_value = {'bounds' : {'time' : (0., 999.)}, 'extents' : {'time' : 1000}}
+
+        reads = []
+        def get_parameter_values(param_names, time_segment=None, sort_parameter=None):
+            reads.append(time_segment)
+            values = Mock()
+            t0 = time_segment[0] if time_segment else 0
+            values.get_data.return_value = {'time' : times[times >= t0]}
+            return values
+
+        coverage = Mock()
+        coverage.temporal_parameter_name = 'time'
+        coverage.get_parameter_values.side_effect = get_parameter_values
+
+        tail = ReplayProcess._tail_times(coverage, 'dataset_id', 10)
+        np.testing.assert_array_equal(tail[-10:], times[-10:])
+        # Only a window at the end of the dataset was read
+        self.assertEquals(len(reads), 1)
+        self.assertTrue(len(tail) < 20)
+
+        # Without metadata all of the time values are read
+        container.instance.object_store.read_doc.side_effect = KeyError('dataset_id')
+        tail = ReplayProcess._tail_times(coverage, 'dataset_id', 10)
+        np.testing.assert_array_equal(tail, times)
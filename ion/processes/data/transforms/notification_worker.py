@@ -9,6 +9,8 @@
 
 from datetime import datetime
 from email.mime.text import MIMEText
+from gevent.queue import Queue, Empty
+import gevent
 import smtplib
 
 from pyon.event.event import EventPublisher, EventSubscriber
@@ -17,11 +19,87 @@ from pyon.public import log, RT, OT, PRED, CFG
 from interface.objects import DeliveryModeEnum, NotificationFrequencyEnum
 
 from ion.core.process.transform import TransformEventListener
-from ion.services.dm.utility.uns_utility_methods import load_notifications
+from ion.services.dm.utility.uns_utility_methods import load_notifications, NotificationIndex
 
 from jinja2 import Environment, FileSystemLoader
 
-import smtplib
+
+class SMTPSender(object):
+    """
+    Delivers messages from a bounded queue with a small pool of greenlets.
+
+    Each greenlet opens an SMTP connection when there is mail waiting and keeps using it until the queue is drained,
+    so a burst of notifications shares a few connections instead of opening one per event. Producers block once the
+    queue is full.
+    """
+    def __init__(self, connect, pool_size=2, queue_size=1000):
+        """
+        @param connect    callable returning a connected SMTP client
+        @param pool_size  number of concurrent connections
+        @param queue_size maximum number of messages waiting to be sent
+        """
+        self.connect = connect
+        self.queue = Queue(maxsize=queue_size)
+        self.sent = 0
+        self.failed = 0
+        self._greenlets = [gevent.spawn(self._send_loop) for i in xrange(max(1, pool_size))]
+
+    def send(self, smtp_from, smtp_to, msg, callback=None):
+        """ queues a message, callback is called once it has been sent """
+        self.queue.put((smtp_from, smtp_to, msg, callback))
+
+    def stop(self, timeout=10):
+        """ sends what is already queued then stops the pool """
+        for g in self._greenlets:
+            self.queue.put(StopIteration)
+        gevent.joinall(self._greenlets, timeout=timeout)
+        gevent.killall(self._greenlets)
+
+    def _send_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is StopIteration:
+                return
+            smtp = None
+            try:
+                while item is not None:
+                    if item is StopIteration:
+                        return
+                    if smtp is None:
+                        smtp = self.connect()
+                    self._deliver(smtp, item)
+                    try:
+                        item = self.queue.get_nowait()
+                    except Empty:
+                        item = None
+            except Exception:
+                # the connection failed, the message that was being sent is dropped
+                self.failed += 1
+                log.exception('Failed to connect to the SMTP server')
+            finally:
+                if smtp is not None:
+                    try:
+                        smtp.quit()
+                    except Exception:
+                        log.warning('Failed to close SMTP connection')
+
+    def _deliver(self, smtp, item):
+        smtp_from, smtp_to, msg, callback = item
+        try:
+            smtp.sendmail(smtp_from, smtp_to, msg)
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except Exception:
+            self.failed += 1
+            log.exception('Failed to send message to %s', smtp_to)
+            return
+        self.sent += 1
+        if callback is not None:
+            try:
+                callback()
+            except Exception:
+                log.exception('Notification sent callback failed')
+
 
 class NotificationWorker(TransformEventListener):
     """
@@ -37,6 +115,8 @@ class NotificationWorker(TransformEventListener):
         self.smtp_from = CFG.get_safe('server.smtp.from', 'data_alerts@oceanobservatories.org')
         self.smtp_host = CFG.get_safe('server.smtp.host', 'localhost')
         self.smtp_port = CFG.get_safe('server.smtp.port', 25)
+        self.smtp_pool_size = self.CFG.get_safe('process.smtp.pool_size', 2)
+        self.smtp_queue_size = self.CFG.get_safe('process.smtp.queue_size', 1000)
 
         # Jinja2 template environment
         self.jinja_env = Environment(loader=FileSystemLoader('res/templates'), trim_blocks=True, lstrip_blocks=True)
@@ -47,11 +127,13 @@ class NotificationWorker(TransformEventListener):
 
         super(NotificationWorker,self).on_start()
 
-        self.notifications = load_notifications()
+        self.smtp_sender = SMTPSender(self._initialize_smtp, pool_size=self.smtp_pool_size, queue_size=self.smtp_queue_size)
+
+        self._load_notifications()
 
         def _load_notifications_callback(msg, headers):
             """ local callback method so this can be used as callback in EventSubscribers """
-            self.notifications = load_notifications() # from uns_utility_methods
+            self._load_notifications()
 
 
         # the subscriber for the ReloadUserInfoEvent (new subscriber, subscription deleted, notifications changed, etc)
@@ -71,33 +153,31 @@ class NotificationWorker(TransformEventListener):
         )
         self.add_endpoint(self.userinfo_rsc_mod_subscriber)
 
+    def on_quit(self):
+        super(NotificationWorker, self).on_quit()
+        self.smtp_sender.stop()
+
+    def _load_notifications(self):
+        notifications = load_notifications() # from uns_utility_methods
+        # swapped in together so process_event never sees an index for other notifications
+        self.notifications, self.notification_index = notifications, NotificationIndex(notifications)
+
     def process_event(self, event, headers):
         """
         callback for the subscriber listening for all events
         """
 
-        # create tuple key (origin,origin_type,event_type,event_subtype) for incoming event
-        # use key to match against known notifications, keyed by same tuple (or combination of this tuple)
-        origin = event.origin
-        origin_type = event.origin_type
-        event_type = event.type_
-        event_subtype = event.sub_type
-        key = (origin,origin_type,event_type,event_subtype)
-
+        # match the event's (origin,origin_type,event_type,event_subtype) against the subscription index
         # users to notify with a list of the notifications that have been triggered by this Event
         users = {} # users to be notified
-        # loop the combinations of keys (see _key_combinations below for explanation)
-        # set() to eliminate duplicates when '' values exist in tuple
-        for k in set(self._key_combinations(key)):
-            if k in self.notifications:
-                for (notification, user) in self.notifications.get(k, []):
-                    # notification has been triggered
-                    if user not in users:
-                        users[user] = []
-                    users[user].append(notification)
+        for (notification, user) in self.notification_index.match_event(event):
+            # notification has been triggered
+            if user not in users:
+                users[user] = []
+            users[user].append(notification)
         # we now have a dict, keyed by users that will be notified, each user has a list of notifications triggered by this event
-        
-        # send email
+
+        # queue emails for the SMTP sender
         if users:
 
             # message content for Jinja2 template (these fields are based on Event and thus are the same for all users/notifications)
@@ -108,67 +188,70 @@ class NotificationWorker(TransformEventListener):
             context['url'] = 'http://ooinet.oceanobservatories.org' # TODO get from CFG
             context['timestamp'] = datetime.utcfromtimestamp(float(event.ts_created)/1000.0).strftime('%Y-%m-%d %H:%M:%S (UTC)')
 
-            # use one SMTP connection for all emails
-            smtp = self._initialize_smtp()
-            try:
+            # same for every message sent for this event
+            notification_max = int(CFG.get_safe("service.user_notification.max_daily_notifications", 1000))
+            templates = {}
 
-                # loop through list of users getting notified of this Event
-                for user in users:
+            # loop through list of users getting notified of this Event
+            for user in users:
 
-                    # list of NotificationRequests for this user triggered by this event
-                    for notification in users[user]:
+                # list of NotificationRequests for this user triggered by this event
+                for notification in users[user]:
 
-                        # name of NotificationRequest, defaults to...NotificationRequest? I don't think name gets set anywhere? TODO, what's default?
-                        context['notification_name'] = notification.name or notification.type_
+                    # name of NotificationRequest, defaults to...NotificationRequest? I don't think name gets set anywhere? TODO, what's default?
+                    context['notification_name'] = notification.name or notification.type_
 
-                        # send message for each DeliveryConfiguration (this has mode and frequency to determine realtime, email or SMS)
-                        for delivery_configuration in notification.delivery_configurations:
+                    # send message for each DeliveryConfiguration (this has mode and frequency to determine realtime, email or SMS)
+                    for delivery_configuration in notification.delivery_configurations:
 
-                            # skip if DeliveryConfiguration.frequency is DISABLED
-                            if delivery_configuration.frequency == NotificationFrequencyEnum.DISABLED:
-                                continue
+                        # skip if DeliveryConfiguration.frequency is DISABLED
+                        if delivery_configuration.frequency == NotificationFrequencyEnum.DISABLED:
+                            continue
 
-                            # only process REAL_TIME
-                            if delivery_configuration.frequency != NotificationFrequencyEnum.REAL_TIME:
-                                continue
+                        # only process REAL_TIME
+                        if delivery_configuration.frequency != NotificationFrequencyEnum.REAL_TIME:
+                            continue
 
-                            # default to UserInfo.contact.email if no email specified in DeliveryConfiguration
-                            smtp_to = delivery_configuration.email if delivery_configuration.email else user.contact.email
-                            context['smtp_to'] = smtp_to
+                        # default to UserInfo.contact.email if no email specified in DeliveryConfiguration
+                        smtp_to = delivery_configuration.email if delivery_configuration.email else user.contact.email
+                        context['smtp_to'] = smtp_to
 
-                            # message from Jinja2 template (email or SMS)
-                            try:
+                        # message from Jinja2 template (email or SMS)
+                        try:
 
-                                # email - MIMEText
-                                if delivery_configuration.mode == DeliveryModeEnum.EMAIL:
-                                    body = self.jinja_env.get_template('notification_realtime_email.txt').render(context)
-                                    mime_text = MIMEText(body)
-                                    mime_text['Subject'] = 'OOINet ION Event Notification - %s' % context['event_label']
-                                    mime_text['From'] = self.smtp_from
-                                    mime_text['To'] = context['smtp_to']
-                                    smtp_msg = mime_text.as_string()
+                            # email - MIMEText
+                            if delivery_configuration.mode == DeliveryModeEnum.EMAIL:
+                                body = self._render('notification_realtime_email.txt', context, templates)
+                                mime_text = MIMEText(body)
+                                mime_text['Subject'] = 'OOINet ION Event Notification - %s' % context['event_label']
+                                mime_text['From'] = self.smtp_from
+                                mime_text['To'] = context['smtp_to']
+                                smtp_msg = mime_text.as_string()
 
-                                # SMS - just the template string
-                                elif delivery_configuration.mode == DeliveryModeEnum.SMS:
-                                    body = self.jinja_env.get_template('notification_realtime_sms.txt').render(context)
-                                    smtp_msg = body
+                            # SMS - just the template string
+                            elif delivery_configuration.mode == DeliveryModeEnum.SMS:
+                                body = self._render('notification_realtime_sms.txt', context, templates)
+                                smtp_msg = body
 
-                                # unknown DeliveryMode
-                                else:
-                                    raise Exception #TODO specify unknown DeliveryModeEnum
+                            # unknown DeliveryMode
+                            else:
+                                raise Exception #TODO specify unknown DeliveryModeEnum
 
-                                smtp.sendmail(self.smtp_from, smtp_to, smtp_msg)
+                        except Exception:
+                            log.error('Failed to create message for notification %s', notification._id)
+                            continue # skips this notification
 
-                            except Exception:
-                                log.error('Failed to create message for notification %s', notification._id)
-                                continue # skips this notification
+                        # publish NotificationSentEvent once sent - one per NotificationRequest (EventListener plugin NotificationSentScanner listens)
+                        def _sent(user_id=user._id, notification_id=notification._id):
+                            self.event_publisher.publish_event(user_id=user_id, notification_id=notification_id, notification_max=notification_max)
 
-                            # publish NotificationSentEvent - one per NotificationRequest (EventListener plugin NotificationSentScanner listens)
-                            notification_max = int(CFG.get_safe("service.user_notification.max_daily_notifications", 1000))
-                            self.event_publisher.publish_event(user_id=user._id, notification_id=notification._id, notification_max=notification_max)
+                        self.smtp_sender.send(self.smtp_from, smtp_to, smtp_msg, callback=_sent)
 
-            finally:
-                smtp.quit()
+    def _render(self, name, context, templates):
+        """ renders a template, templates caches the ones already loaded for this event """
+        if name not in templates:
+            templates[name] = self.jinja_env.get_template(name)
+        return templates[name].render(context)
 
     def _initialize_smtp(self):
         """ class method so user/pass/etc can be added """
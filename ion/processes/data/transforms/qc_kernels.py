@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/qc_kernels.py
+@description Windows the ion_functions QC tests so they can be evaluated over time chunks.
+
+A kernel's flag for a point depends only on the values within kernel.left
+points before it and kernel.right points after it, or, for sequential
+tests, on a small state carried from the previous chunk. Evaluating a
+chunk with that much overlap (see evaluate_range) gives the same flags as
+running the ion_functions test on the whole array. Tests whose verdict
+depends on the whole record are marked whole and always evaluate it all.
+'''
+
+import numpy as np
+
+
+def evaluate_range(kernel, dat, x, start, stop, state=None):
+    '''
+    Evaluates the kernel for the points in [start, stop) of the arrays, using
+    views of the overlap the kernel needs around them.
+    Returns the flags for the points and the kernel state after them.
+    '''
+    if kernel.whole:
+        lo, hi = 0, len(dat)
+    else:
+        lo = max(0, start - kernel.left)
+        hi = min(len(dat), stop + kernel.right)
+    flags, state = kernel.evaluate(dat[lo:hi], x[lo:hi], state)
+    return flags[start - lo:stop - lo], state
+
+
+def evaluate_chunks(kernel, dat, x, chunk_size, state=None):
+    '''
+    Evaluates the kernel over chunks of chunk_size points. The flags are the
+    same as those of a single evaluation of the whole array.
+    '''
+    dat = np.asarray(dat)
+    x = np.asarray(x)
+    flags = np.ones(dat.shape[0], dtype=np.int8)
+    for start in xrange(0, dat.shape[0], chunk_size):
+        stop = min(dat.shape[0], start + chunk_size)
+        flags[start:stop], state = evaluate_range(kernel, dat, x, start, stop, state)
+    return flags, state
+
+
+class QCKernel(object):
+    '''
+    Base QC kernel.
+    left and right are the number of neighbouring points a flag depends on,
+    kernels carrying a state must not need any. whole kernels are evaluated
+    over the whole record, every flag can change when data is added.
+    parameters names the attributes the flags depend on.
+    '''
+    left  = 0
+    right = 0
+    whole = False
+    parameters = ()
+
+    def signature(self):
+        '''
+        Returns a string identifying the test and its parameters, flags
+        evaluated under another signature are stale
+        '''
+        return '%s%r' % (self.__class__.__name__, tuple(getattr(self, name) for name in self.parameters))
+
+    def evaluate(self, dat, x, state=None):
+        '''
+        Returns the flags for the values dat at times x and the state to pass
+        to the evaluation of the data that follows
+        '''
+        raise NotImplementedError()
+
+
+class GlobalRangeKernel(QCKernel):
+    '''
+    dataqc_globalrangetest, each flag only depends on its value
+    '''
+    parameters = ('min_value', 'max_value')
+
+    def __init__(self, min_value, max_value):
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def evaluate(self, dat, x, state=None):
+        from ion_functions.qc.qc_functions import dataqc_globalrangetest
+        return dataqc_globalrangetest(dat, [self.min_value, self.max_value]), state
+
+
+class SpikeKernel(QCKernel):
+    '''
+    dataqc_spiketest_wrapper, a value is tested against the window of L
+    points around it. The window is shifted to stay within the data at
+    either end, so a flag can depend on the L - 1 points on each side of it.
+    '''
+    parameters = ('acc', 'N', 'L')
+
+    def __init__(self, acc, N=5, L=5):
+        self.acc = acc
+        self.N = N
+        self.L = L
+        self.left = self.right = max(int(L) - 1, 0)
+
+    def evaluate(self, dat, x, state=None):
+        from ion_functions.qc.qc_functions import dataqc_spiketest_wrapper
+        return dataqc_spiketest_wrapper(dat, self.acc, self.N, self.L), state
+
+
+class StuckValueKernel(QCKernel):
+    '''
+    dataqc_stuckvaluetest_wrapper, fails runs of num values, so a flag can
+    depend on the num - 1 points on each side of it.
+    '''
+    parameters = ('reso', 'num')
+
+    def __init__(self, reso, num=10):
+        self.reso = reso
+        self.num = num
+        self.left = self.right = max(int(num) - 1, 0)
+
+    def evaluate(self, dat, x, state=None):
+        from ion_functions.qc.qc_functions import dataqc_stuckvaluetest_wrapper
+        return dataqc_stuckvaluetest_wrapper(dat, self.reso, self.num), state
+
+
+class GradientKernel(QCKernel):
+    '''
+    dataqc_gradienttest_wrapper, a sequential test: each value is compared
+    to the last value that passed (the reference), the first reference is
+    startdat. The reference and its time are the kernel state. A chunk is
+    evaluated with the reference in front of it as startdat, the reference
+    passes against itself and the values after it are tested as they are
+    in a run over the whole array.
+    '''
+    parameters = ('ddatdx', 'mindx', 'startdat', 'toldat')
+
+    def __init__(self, ddatdx, mindx, startdat, toldat):
+        self.ddatdx = ddatdx
+        self.mindx = mindx
+        self.startdat = startdat
+        self.toldat = toldat
+
+    def evaluate(self, dat, x, state=None):
+        from ion_functions.qc.qc_functions import dataqc_gradienttest_wrapper
+        dat = np.asarray(dat, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        if state:
+            ref, xref = state
+            dat = np.concatenate([[ref], dat])
+            x = np.concatenate([[xref], x])
+            flags = dataqc_gradienttest_wrapper(dat, x, self.ddatdx, self.mindx, ref, self.toldat)[1:]
+            dat, x = dat[1:], x[1:]
+        else:
+            flags = dataqc_gradienttest_wrapper(dat, x, self.ddatdx, self.mindx, self.startdat, self.toldat)
+
+        passed = np.flatnonzero(flags == 1)
+        if passed.size:
+            state = [float(dat[passed[-1]]), float(x[passed[-1]])]
+        return flags, state
+
+
+class TrendKernel(QCKernel):
+    '''
+    dataqc_polytrendtest_wrapper. The verdict is for the whole record, so
+    unlike the other kernels it isn't windowed: the whole record is
+    evaluated and every flag is rewritten whenever data is added.
+    '''
+    whole = True
+    parameters = ('ord_n', 'nstd')
+
+    def __init__(self, ord_n=1, nstd=3):
+        self.ord_n = ord_n
+        self.nstd = nstd
+
+    def evaluate(self, dat, x, state=None):
+        from ion_functions.qc.qc_functions import dataqc_polytrendtest_wrapper
+        return dataqc_polytrendtest_wrapper(dat, x, self.ord_n, self.nstd), state
@@ -10,6 +10,9 @@ from pyon.ion.process import ImmediateProcess, SimpleProcess
 from interface.services.dm.idata_retriever_service import DataRetrieverServiceProcessClient
 from ion.services.dm.utility.granule import RecordDictionaryTool
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.util.stored_values import StoredValueManager
+from ion.processes.data.transforms.qc_kernels import evaluate_range, GlobalRangeKernel, SpikeKernel, StuckValueKernel, TrendKernel, GradientKernel
+from coverage_model import NumpyParameterData
 import time
 from pyon.ion.event import EventPublisher
 from pyon.public import OT, RT,PRED
@@ -117,28 +120,54 @@ class QCPostProcessing(SimpleProcess):
         return
 
 class QCProcessor(SimpleProcess):
+    '''
+    Evaluates QC incrementally. The first pass covers every data product,
+    after that only the datasets that were modified (DatasetModified events)
+    are processed. For each dataset and QC parameter a watermark is
+    persisted in the object store and only newer data is read, along with
+    the overlap the windowed tests need (see qc_kernels).
+    '''
     def __init__(self):
         self.event = Event() # Synchronizes the thread
         self.timeout = 10
+        self._full_pass = True
+        self._modified = set() # Datasets modified since they were last processed
+
+        # Resource lookups, cleared every cache_ttl seconds
+        self._reference_designators = {} # data product id -> reference designator or None
+        self._parameters            = {} # data product id -> parameter contexts
+        self._datasets              = {} # data product id -> dataset id
+        self._cache_time            = time.time()
+        self._lookup_docs           = {} # reference designator -> (lookup doc or None, time read)
+        self._watermarks            = {} # dataset id -> {qc parameter : watermark}
 
     def on_start(self):
         '''
         Process initialization
         '''
-        self._thread = self._process.thread_manager.spawn(self.thread_loop)
-        self._event_subscriber = EventSubscriber(event_type=OT.ResetQCEvent, callback=self.receive_event, auto_delete=True) # TODO Correct event types
-        self._event_subscriber.start()
         self.timeout = self.CFG.get_safe('endpoint.receive.timeout', 10)
+        self.cache_ttl = self.CFG.get_safe('process.qc.cache_ttl', 3600)
+        self.lookup_ttl = self.CFG.get_safe('process.qc.lookup_ttl', 300)
         self.resource_registry = self.container.resource_registry
+        self.stored_values = StoredValueManager(self.container)
         self.event_queue = Queue()
+        self._event_subscriber = EventSubscriber(event_type=OT.ResetQCEvent, callback=self.receive_event, auto_delete=True) # TODO Correct event types
+        self._event_subscriber.start()
+        self._dataset_subscriber = EventSubscriber(event_type=OT.DatasetModified, callback=self.dataset_modified, auto_delete=True)
+        self._dataset_subscriber.start()
+        self._thread = self._process.thread_manager.spawn(self.thread_loop)
 
     def on_quit(self):
         '''
         Stop and cleanup the thread
         '''
         self._event_subscriber.stop()
+        self._dataset_subscriber.stop()
         self.suspend()
 
+    def dataset_modified(self, event, *args, **kwargs):
+        self._modified.add(event.origin)
+
     def receive_event(self, event, *args, **kwargs):
         log.error("Adding event to the event queue")
         self.event_queue.put(event)
@@ -160,16 +189,30 @@ class QCProcessor(SimpleProcess):
 
     def qc_processing_loop(self):
         '''
-        Iterates through available data products and evaluates QC
+        Evaluates QC for the data products of the datasets modified since
+        the last pass, or for every data product on the first pass
         '''
-        data_products, _ = self.container.resource_registry.find_resources(restype=RT.DataProduct, id_only=False)
+        if time.time() - self._cache_time > self.cache_ttl:
+            self.clear_caches()
+
+        if self._full_pass:
+            data_products, _ = self.container.resource_registry.find_resources(restype=RT.DataProduct, id_only=False)
+            self._full_pass = False
+        elif self._modified:
+            dataset_ids, self._modified = self._modified, set()
+            data_products = []
+            for dataset_id in dataset_ids:
+                subjects, _ = self.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct, id_only=False)
+                data_products.extend(subjects)
+        else:
+            return
+
         for data_product in data_products:
             # Get the reference designator
-            try:
-                rd = self.get_reference_designator(data_product._id)
-            except BadRequest:
+            rd = self.cached_reference_designator(data_product._id)
+            if rd is None:
                 continue
-            parameters = self.get_parameters(data_product)
+            parameters = self.cached_parameters(data_product)
             # Create a mapping of inputs to QC
             qc_mapping = {}
 
@@ -209,6 +252,69 @@ class QCProcessor(SimpleProcess):
         log.info("QC Thread Suspended")
 
 
+    def clear_caches(self):
+        self._reference_designators.clear()
+        self._parameters.clear()
+        self._datasets.clear()
+        self._lookup_docs.clear()
+        self._cache_time = time.time()
+
+    def cached_reference_designator(self, data_product_id):
+        '''
+        Returns the reference designator for a data product or None if it doesn't have one
+        '''
+        if data_product_id not in self._reference_designators:
+            try:
+                rd = self.get_reference_designator(data_product_id)
+            except BadRequest:
+                rd = None
+            self._reference_designators[data_product_id] = rd
+        return self._reference_designators[data_product_id]
+
+    def cached_parameters(self, data_product):
+        if data_product._id not in self._parameters:
+            self._parameters[data_product._id] = self.get_parameters(data_product)
+        return self._parameters[data_product._id]
+
+    def lookup_doc(self, reference_designator):
+        '''
+        Returns the QC lookup document for the reference designator, None if
+        there isn't one. Documents are read again after lookup_ttl seconds.
+        '''
+        doc, read_at = self._lookup_docs.get(reference_designator, (None, 0))
+        if time.time() - read_at > self.lookup_ttl:
+            try:
+                doc = self.container.object_store.read_doc(reference_designator)
+            except NotFound:
+                doc = None
+            self._lookup_docs[reference_designator] = (doc, time.time())
+        return doc
+
+    def watermark_key(self, dataset_id):
+        return '%s_qc_watermarks' % dataset_id
+
+    def get_watermark(self, dataset_id, parameter_name):
+        '''
+        Returns the watermark for the QC parameter, None if it hasn't been evaluated.
+        The watermark is a dictionary of
+            time    - the time of the last record with a final flag
+            last    - the time of the last record evaluated, the flags after time are provisional
+            context - the time the next evaluation reads from, earlier than time when the test needs overlap
+            state   - the state of a sequential test after the last record
+            params  - the signature of the kernel the flags were evaluated with
+            count   - the number of records up to time, more of them means records arrived late
+        '''
+        if dataset_id not in self._watermarks:
+            try:
+                self._watermarks[dataset_id] = dict(self.stored_values.read_value(self.watermark_key(dataset_id)))
+            except NotFound:
+                self._watermarks[dataset_id] = {}
+        return self._watermarks[dataset_id].get(parameter_name)
+
+    def set_watermark(self, dataset_id, parameter_name, value):
+        self.stored_values.stored_value_cas(self.watermark_key(dataset_id), {parameter_name : value})
+        self._watermarks.setdefault(dataset_id, {})[parameter_name] = value
+
     def get_reference_designator(self, data_product_id=''):
         '''
         Returns the reference designator for a data product if it has one
@@ -276,9 +382,8 @@ class QCProcessor(SimpleProcess):
             return # No input!
         input_name = self.calibrated_candidates(data_product, parameter, qc_mapping, parameters)
 
-        try:
-            doc = self.container.object_store.read_doc(reference_designator)
-        except NotFound:
+        doc = self.lookup_doc(reference_designator)
+        if doc is None:
             return # NO QC lookups found
         if dp_ident not in doc:
             log.critical("Data product %s not in doc", dp_ident)
@@ -287,38 +392,42 @@ class QCProcessor(SimpleProcess):
         lookup_table = doc[dp_ident]
 
         # An instance of the coverage is loaded if we need to run an algorithm
-        dataset_id = self.get_dataset(data_product)
+        dataset_id = self.cached_dataset(data_product)
         coverage = self.get_coverage(dataset_id)
-        if not coverage.num_timesteps: # No data = no qc
+        if not coverage.num_timesteps(): # No data = no qc
             coverage.close()
             return
 
+        # Only the data after the watermark is evaluated
+        watermark = self.get_watermark(dataset_id, parameter.name)
+        evaluated = watermark
+
         try:
             # Get the lookup table info then run
             if alg.lower() == 'glblrng':
                 row = self.recent_row(lookup_table['global_range'])
                 min_value = row['min_value']
                 max_value = row['max_value']
-                self.process_glblrng(coverage, parameter, input_name, min_value, max_value)
+                evaluated = self.process_glblrng(coverage, parameter, input_name, min_value, max_value, watermark)
 
             elif alg.lower() == 'stuckvl':
                 row = self.recent_row(lookup_table['stuck_value'])
                 resolution = row['resolution']
                 N = row['consecutive_values']
-                self.process_stuck_value(coverage, parameter,input_name, resolution, N)
+                evaluated = self.process_stuck_value(coverage, parameter,input_name, resolution, N, watermark)
 
             elif alg.lower() == 'trndtst':
                 row = self.recent_row(lookup_table['trend_test'])
                 ord_n = row['polynomial_order']
                 nstd = row['standard_deviation']
-                self.process_trend_test(coverage, parameter, input_name, ord_n, nstd)
+                evaluated = self.process_trend_test(coverage, parameter, input_name, ord_n, nstd, watermark)
 
             elif alg.lower() == 'spketst':
                 row = self.recent_row(lookup_table['spike_test'])
                 acc = row['accuracy']
                 N = row['range_multiplier']
                 L = row['window_length']
-                self.process_spike_test(coverage, parameter, input_name, acc, N, L)
+                evaluated = self.process_spike_test(coverage, parameter, input_name, acc, N, L, watermark)
 
             elif alg.lower() == "gradtst":
                 row = self.recent_row(lookup_table["gradient_test"])
@@ -330,7 +439,7 @@ class QCProcessor(SimpleProcess):
                 if isinstance(mindx, basestring) and not mindx:
                     mindx = np.nan
                 toldat = row["toldat"]
-                self.process_gradient_test(coverage, parameter, input_name, ddatdx, mindx, startdat, toldat)
+                evaluated = self.process_gradient_test(coverage, parameter, input_name, ddatdx, mindx, startdat, toldat, watermark)
 
             elif alg.lower() == 'loclrng':
                 row = self.recent_row(lookup_table["local_range"])
@@ -346,12 +455,16 @@ class QCProcessor(SimpleProcess):
 
                 datlimz = np.column_stack(datlimz)
                 datlim = np.column_stack([table['datlim1'], table['datlim2']])
-                self.process_local_range_test(coverage, parameter, input_name, datlim, datlimz, dims)
+                time_segment = (watermark['time'], None) if watermark else None
+                self.process_local_range_test(coverage, parameter, input_name, datlim, datlimz, dims, time_segment)
 
 
         except KeyError: # No lookup table
             self.set_error(coverage, parameter)
 
+        else:
+            if evaluated and evaluated != watermark:
+                self.set_watermark(dataset_id, parameter.name, evaluated)
 
         finally:
             coverage.close()
@@ -359,117 +472,129 @@ class QCProcessor(SimpleProcess):
     def set_error(self, coverage, parameter):
         log.error("setting coverage parameter %s to -99", parameter.name)
 
-    def get_parameter_values(self, coverage, name):
-        array = coverage.get_parameter_values([name], fill_empty_params=True).get_data()[name]
+    def get_parameter_values(self, coverage, name, time_segment=None):
+        '''
+        Returns the values of a parameter in time order, the incremental QC assumes sorted times
+        '''
+        array = coverage.get_parameter_values([name], time_segment=time_segment, sort_parameter=coverage.temporal_parameter_name, fill_empty_params=True).get_data()[name]
         return array
 
 
-    def process_glblrng(self, coverage, parameter, input_name, min_value, max_value):
+    def process_glblrng(self, coverage, parameter, input_name, min_value, max_value, watermark=None):
         '''
-        Evaluates the QC for global range for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for global range for the data after the watermark
         '''
-        log.error("input name: %s", input_name)
-        log.info("Num timesteps: %s", coverage.num_timesteps)
-
-        # Get all of the QC values, and find where -88 is set (uninitialized)
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where( qc_array == -88 )[0]
+        return self.process_kernel(coverage, parameter, input_name, GlobalRangeKernel(min_value, max_value), watermark)
 
-        # Now build a variable, but I need to keep track of the time where the data goes
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-
-        from ion_functions.qc.qc_functions import dataqc_globalrangetest
-        qc = dataqc_globalrangetest(value_array, [min_value, max_value])
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc
-        }
-
-
-    def process_stuck_value(self, coverage, parameter, input_name, resolution, N):
+    def process_stuck_value(self, coverage, parameter, input_name, resolution, N, watermark=None):
         '''
-        Evaluates the QC for stuck value for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for stuck value for the data after the watermark
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
-        # Horribly inefficient...
-        from ion_functions.qc.qc_functions import dataqc_stuckvaluetest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        qc_array = dataqc_stuckvaluetest_wrapper(value_array, resolution, N)
-        qc_array = qc_array[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
+        return self.process_kernel(coverage, parameter, input_name, StuckValueKernel(resolution, N), watermark)
 
-
-    def process_trend_test(self, coverage, parameter, input_name, ord_n, nstd):
+    def process_trend_test(self, coverage, parameter, input_name, ord_n, nstd, watermark=None):
         '''
-        Evaluates the QC for trend test for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for trend test for the data after the watermark
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
-        from ion_functions.qc.qc_functions import dataqc_polytrendtest_wrapper
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
+        return self.process_kernel(coverage, parameter, input_name, TrendKernel(ord_n, nstd), watermark)
 
-        qc_array = dataqc_polytrendtest_wrapper(value_array, time_array, ord_n, nstd)
-        qc_array = qc_array[indexes]
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
-
-    def process_spike_test(self, coverage, parameter, input_name, acc, N, L):
+    def process_spike_test(self, coverage, parameter, input_name, acc, N, L, watermark=None):
         '''
-        Evaluates the QC for spike test for all data values that equal -88 (not yet evaluated)
+        Evaluates the QC for spike test for the data after the watermark
         '''
-        # Get al of the QC values and find out where -88 is set
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
+        return self.process_kernel(coverage, parameter, input_name, SpikeKernel(acc, N, L), watermark)
 
-        from ion_functions.qc.qc_functions import dataqc_spiketest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        qc_array = dataqc_spiketest_wrapper(value_array, acc, N, L)
-        qc_array = qc_array[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array,
-                parameter.name : qc_array
-        }
-
-    def process_gradient_test(self, coverage, parameter, input_name, ddatdx, mindx, startdat, toldat):
-        qc_array = self.get_parameter_values(coverage, parameter.name)
-        indexes = np.where(qc_array == -88)[0]
-
-        from ion_functions.qc.qc_functions import dataqc_gradienttest_wrapper
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
-        
-        qc_array = dataqc_gradienttest_wrapper(value_array, time_array, ddatdx, mindx, startdat, toldat)
-
-        return_dictionary = {
-                coverage.temporal_parameter_name : time_array[indexes],
-                parameter.name : qc_array[indexes]
-        }
+    def process_gradient_test(self, coverage, parameter, input_name, ddatdx, mindx, startdat, toldat, watermark=None):
+        '''
+        Evaluates the QC for gradient test for the data after the watermark
+        '''
+        return self.process_kernel(coverage, parameter, input_name, GradientKernel(ddatdx, mindx, startdat, toldat), watermark)
 
+    def process_kernel(self, coverage, parameter, input_name, kernel, watermark=None):
+        '''
+        Evaluates a QC kernel for the data after the watermark and writes the
+        flags, returns the new watermark.
+
+        The data is read from the watermark's context so the records before
+        the watermark the kernel needs are available. The last kernel.right
+        flags are provisional, they're evaluated again on the next pass
+        once the data after them is available. Kernels that test the whole
+        record read all of it and rewrite every flag.
+
+        A watermark left by a kernel with other parameters, e.g. after the
+        lookup table changed, is dropped and the whole record re-evaluated.
+        Records that arrive before the watermark, e.g. a backfill through
+        manual upload, rewind it to the first record not yet evaluated.
+        '''
+        params = kernel.signature()
+        if watermark and watermark.get('params') != params:
+            log.info("QC parameters for %s changed to %s, re-evaluating", parameter.name, params)
+            watermark = None
+
+        # Counted before the read, records appended meanwhile can't pass for late ones
+        total = coverage.num_timesteps()
+        times = self.get_parameter_values(coverage, coverage.temporal_parameter_name, self.kernel_segment(kernel, watermark))
+        if watermark and watermark.get('count') is not None:
+            settled = total - (times.size - int(np.searchsorted(times, watermark['time'], side='right')))
+            if settled > watermark['count']:
+                log.info("Records arrived before the QC watermark of %s, re-evaluating them", parameter.name)
+                watermark = self.rewind_watermark(coverage, parameter, kernel, watermark)
+                times = self.get_parameter_values(coverage, coverage.temporal_parameter_name, self.kernel_segment(kernel, watermark))
+
+        if not times.size or (watermark and times[-1] <= watermark['last']):
+            return watermark # No new data
+        start = int(np.searchsorted(times, watermark['time'], side='right')) if watermark and not kernel.whole else 0
+        values = self.get_parameter_values(coverage, input_name, self.kernel_segment(kernel, watermark))
+
+        state = watermark.get('state') if watermark else None
+        flags, state = evaluate_range(kernel, values, times, start, times.size, state)
+        self.write_flags(coverage, parameter, times[start:], flags)
+
+        settled = times.size - 1 - kernel.right
+        if settled < start: # Every flag is provisional
+            return dict(watermark, last=float(times[-1])) if watermark else None
+        context = min(max(settled + 1 - kernel.left, 0), times.size - 1)
+        count = total - times.size + settled + 1
+        return {'time' : float(times[settled]), 'last' : float(times[-1]), 'context' : float(times[context]), 'state' : state, 'params' : params, 'count' : count}
+
+    def kernel_segment(self, kernel, watermark=None):
+        '''
+        Returns the time segment a kernel reads from the watermark
+        '''
+        return (watermark['context'], None) if watermark and not kernel.whole else None
 
-    def process_local_range_test(self, coverage, parameter, input_name, datlim, datlimz, dims):
+    def rewind_watermark(self, coverage, parameter, kernel, watermark):
+        '''
+        Returns a watermark before the first record up to the watermark that
+        isn't evaluated yet (flagged -88), so the records that arrived late are
+        evaluated along with the flags that depend on them. Returns None, to
+        re-evaluate the whole record, for whole and sequential kernels whose
+        flags all depend on the earlier records.
+        '''
+        if kernel.whole or watermark.get('state') is not None:
+            return None
+        segment = (None, watermark['time'])
+        times = self.get_parameter_values(coverage, coverage.temporal_parameter_name, segment)
+        flags = self.get_parameter_values(coverage, parameter.name, segment)
+        late = np.flatnonzero(flags == -88)
+        settled = late[0] - 1 - kernel.right if late.size else -1
+        if settled < 0:
+            return None
+        context = max(settled + 1 - kernel.left, 0)
+        return dict(watermark, time=float(times[settled]), last=float(times[settled]), context=float(times[context]), count=int(settled + 1))
+
+    def write_flags(self, coverage, parameter, times, flags):
+        coverage.set_parameter_values({parameter.name : NumpyParameterData(parameter.name, flags, times)})
+
+    def process_local_range_test(self, coverage, parameter, input_name, datlim, datlimz, dims, time_segment=None):
         return # Not ready
-        qc_array = self.get_parameter_values(coverage, parameter.name)
+        qc_array = self.get_parameter_values(coverage, parameter.name, time_segment)
         indexes = np.where(qc_array == -88)[0]
 
         from ion_functions.qc.qc_functions import dataqc_localrangetest_wrapper
         # dat
-        value_array = self.get_parameter_values(coverage, input_name)[indexes]
-        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name)[indexes]
+        value_array = self.get_parameter_values(coverage, input_name, time_segment)[indexes]
+        time_array = self.get_parameter_values(coverage, coverage.temporal_parameter_name, time_segment)[indexes]
 
         # datlim is an argument and comes from the lookup table
         # datlimz is an argument and comes from the lookup table
@@ -492,6 +617,11 @@ class QCProcessor(SimpleProcess):
 
 
 
+    def cached_dataset(self, data_product):
+        if data_product._id not in self._datasets:
+            self._datasets[data_product._id] = self.get_dataset(data_product)
+        return self._datasets[data_product._id]
+
     def get_dataset(self, data_product):
         dataset_ids, _ = self.resource_registry.find_objects(data_product, PRED.hasDataset, id_only=True)
         if not dataset_ids:
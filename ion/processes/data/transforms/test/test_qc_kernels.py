@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_qc_kernels.py
+@brief Unit tests for the windowed QC kernels
+'''
+
+from ion.processes.data.transforms.qc_kernels import evaluate_chunks, evaluate_range, GlobalRangeKernel, SpikeKernel, StuckValueKernel, GradientKernel, TrendKernel
+from ion_functions.qc.qc_functions import dataqc_globalrangetest, dataqc_spiketest_wrapper, dataqc_stuckvaluetest_wrapper, dataqc_gradienttest_wrapper, dataqc_polytrendtest_wrapper
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TestQCKernels(PyonTestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.x = np.arange(500, dtype=np.float64) + rs.rand(500) * 0.5
+        self.dat = np.round(rs.randn(500).cumsum(), 1)
+        self.dat[rs.rand(500) < 0.05] = 40.
+        self.dat[100:110] = self.dat[100]
+
+    def assert_chunk_equivalence(self, kernel, expected):
+        '''
+        The flags of a chunked evaluation are those of the ion_functions test run on the whole array
+        '''
+        expected = np.asarray(expected)
+        for chunk_size in (1, 7, 64, 499, 500):
+            flags, state = evaluate_chunks(kernel, self.dat, self.x, chunk_size)
+            np.testing.assert_array_equal(flags, expected)
+        return expected
+
+    def test_global_range(self):
+        flags = self.assert_chunk_equivalence(GlobalRangeKernel(-10, 30), dataqc_globalrangetest(self.dat, [-10, 30]))
+        self.assertFalse(flags.all())
+
+    def test_spike(self):
+        for L in (3, 5, 8, 11):
+            flags = self.assert_chunk_equivalence(SpikeKernel(0.1, 3, L), dataqc_spiketest_wrapper(self.dat, 0.1, 3, L))
+        self.assertFalse(flags.all())
+
+    def test_stuck_value(self):
+        for num in (2, 4, 10, 11):
+            flags = self.assert_chunk_equivalence(StuckValueKernel(0.05, num), dataqc_stuckvaluetest_wrapper(self.dat, 0.05, num))
+            self.assertEquals(flags[100:110].any(), num > 10)
+
+    def test_gradient(self):
+        for startdat in (np.nan, 0.):
+            kernel = GradientKernel([-2., 2.], np.nan, startdat, 0.3)
+            flags = self.assert_chunk_equivalence(kernel, dataqc_gradienttest_wrapper(self.dat, self.x, [-2., 2.], np.nan, startdat, 0.3))
+            self.assertFalse(flags.all())
+
+    def test_trend(self):
+        kernel = TrendKernel(2, 3)
+        self.assert_chunk_equivalence(kernel, dataqc_polytrendtest_wrapper(self.dat, self.x, 2, 3))
+
+        # Added data can change the verdict for all of the record
+        x = np.arange(1000, dtype=np.float64) * 3600
+        dat = np.random.RandomState(1).randn(1000)
+        dat[500:] += np.arange(500) * 0.1
+        self.assertTrue(evaluate_range(kernel, dat[:500], x[:500], 0, 500)[0].all())
+        self.assertFalse(evaluate_range(kernel, dat, x, 0, 1000)[0].any())
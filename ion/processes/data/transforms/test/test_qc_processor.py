@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_qc_processor.py
+@brief Unit tests for incremental QC processing
+'''
+
+from ion.processes.data.transforms.qc_post_processing import QCProcessor
+from ion.processes.data.transforms.qc_kernels import GlobalRangeKernel, SpikeKernel, StuckValueKernel, GradientKernel, TrendKernel
+
+from pyon.core.exception import NotFound
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TestQCProcessor(PyonTestCase):
+    def setUp(self):
+        self.processor = QCProcessor()
+        self.processor.container = Mock()
+        self.processor.resource_registry = Mock()
+        self.processor.stored_values = Mock()
+        self.processor.cache_ttl = 3600
+        self.processor.lookup_ttl = 300
+        self.processor.run_qc = Mock()
+        self.processor.get_reference_designator = Mock(return_value='RD')
+        self.processor.get_parameters = Mock(return_value=[])
+
+    def data_product(self, data_product_id):
+        data_product = Mock()
+        data_product._id = data_product_id
+        return data_product
+
+    def test_incremental_passes(self):
+        rr = self.processor.container.resource_registry
+        rr.find_resources.return_value = ([self.data_product('dp1'), self.data_product('dp2')], None)
+
+        self.processor.qc_processing_loop()
+        self.assertEquals(self.processor.get_parameters.call_count, 2)
+
+        # Nothing was modified
+        self.processor.qc_processing_loop()
+        self.assertEquals(rr.find_resources.call_count, 1)
+        self.assertEquals(self.processor.get_parameters.call_count, 2)
+
+        event = Mock()
+        event.origin = 'dataset1'
+        self.processor.dataset_modified(event)
+        self.processor.resource_registry.find_subjects.return_value = ([self.data_product('dp1')], None)
+        self.processor.qc_processing_loop()
+        self.processor.resource_registry.find_subjects.assert_called_once_with(object='dataset1', predicate='hasDataset', subject_type='DataProduct', id_only=False)
+        # The reference designator and parameters were cached
+        self.assertEquals(self.processor.get_reference_designator.call_count, 2)
+        self.assertEquals(self.processor.get_parameters.call_count, 2)
+
+    def test_watermarks(self):
+        stored_values = self.processor.stored_values
+        stored_values.read_value.side_effect = NotFound('dataset1_qc_watermarks')
+        self.assertEquals(self.processor.get_watermark('dataset1', 'tempwat_glblrng_qc'), None)
+
+        watermark = {'time' : 10., 'last' : 10., 'context' : 10., 'state' : None}
+        self.processor.set_watermark('dataset1', 'tempwat_glblrng_qc', watermark)
+        stored_values.stored_value_cas.assert_called_once_with('dataset1_qc_watermarks', {'tempwat_glblrng_qc' : watermark})
+        self.assertEquals(self.processor.get_watermark('dataset1', 'tempwat_glblrng_qc'), watermark)
+        self.assertEquals(stored_values.read_value.call_count, 1)
+
+    def test_lookup_doc(self):
+        object_store = self.processor.container.object_store
+        object_store.read_doc.return_value = {'TEMPWAT' : {}}
+        self.assertEquals(self.processor.lookup_doc('RD'), {'TEMPWAT' : {}})
+        self.processor.lookup_doc('RD')
+        self.assertEquals(object_store.read_doc.call_count, 1)
+
+        self.processor.lookup_ttl = -1
+        self.processor.lookup_doc('RD')
+        self.assertEquals(object_store.read_doc.call_count, 2)
+
+    def get_coverage(self, data):
+        coverage = Mock()
+        coverage.temporal_parameter_name = 'time'
+        coverage.reads = []
+        coverage.num_timesteps.return_value = data['time'].size
+        # Records are stored out of time order, only a sorted read is in order
+        order = np.random.RandomState(1).permutation(data['time'].size)
+        data = {name : array[order] for name, array in data.iteritems()}
+        def get_parameter_values(names, time_segment=None, sort_parameter=None, fill_empty_params=False):
+            coverage.reads.append(time_segment)
+            mask = np.ones(data['time'].size, dtype=bool)
+            if time_segment and time_segment[0] is not None:
+                mask &= data['time'] >= time_segment[0]
+            if time_segment and time_segment[1] is not None:
+                mask &= data['time'] <= time_segment[1]
+            sort = np.argsort(data[sort_parameter][mask], kind='mergesort') if sort_parameter else slice(None)
+            values = Mock()
+            values.get_data.return_value = {name : data[name][mask][sort] for name in names}
+            return values
+        coverage.get_parameter_values.side_effect = get_parameter_values
+        return coverage
+
+    @patch('ion.processes.data.transforms.qc_post_processing.NumpyParameterData')
+    def test_process_kernel(self, parameter_data):
+        parameter_data.side_effect = lambda name, flags, times : (flags, times)
+        parameter = Mock()
+        parameter.name = 'tempwat_spketst_qc'
+
+        rs = np.random.RandomState(0)
+        times = np.arange(500, dtype=np.float64)
+        values = np.round(rs.randn(500).cumsum(), 1)
+        values[rs.rand(500) < 0.05] = 40.
+
+        kernels = (GlobalRangeKernel(-10, 30), SpikeKernel(0.1, 3, 7), StuckValueKernel(0.2, 3), GradientKernel([-2., 2.], np.nan, np.nan, 0.3), TrendKernel(1, 3))
+        for kernel in kernels:
+            written = np.zeros(500, dtype=np.int8) - 88
+            watermark = None
+            for end in (3, 200, 201, 350, 500):
+                coverage = self.get_coverage({'time' : times[:end], 'temp' : values[:end]})
+                watermark = self.processor.process_kernel(coverage, parameter, 'temp', kernel, watermark)
+                for (flags, flag_times), in [call[0][0].values() for call in coverage.set_parameter_values.call_args_list]:
+                    written[flag_times.astype(int)] = flags
+                if watermark and not kernel.whole:
+                    # Only the overlap before the watermark is read
+                    self.assertTrue(watermark['time'] - watermark['context'] <= kernel.left)
+
+            # The flags written incrementally are those of the whole record
+            np.testing.assert_array_equal(written, kernel.evaluate(values, times)[0])
+            self.assertEquals(watermark['time'], 499 - kernel.right)
+
+            # No new data, nothing is written
+            coverage = self.get_coverage({'time' : times, 'temp' : values})
+            self.assertEquals(self.processor.process_kernel(coverage, parameter, 'temp', kernel, watermark), watermark)
+            self.assertFalse(coverage.set_parameter_values.called)
+
+    @patch('ion.processes.data.transforms.qc_post_processing.NumpyParameterData')
+    def test_process_kernel_parameters_changed(self, parameter_data):
+        parameter_data.side_effect = lambda name, flags, times : (flags, times)
+        parameter = Mock()
+        parameter.name = 'tempwat_glblrng_qc'
+
+        times = np.arange(100, dtype=np.float64)
+        values = np.arange(100, dtype=np.float64)
+        coverage = self.get_coverage({'time' : times, 'temp' : values})
+        watermark = self.processor.process_kernel(coverage, parameter, 'temp', GlobalRangeKernel(0, 50), None)
+        self.assertEquals(watermark['params'], GlobalRangeKernel(0, 50).signature())
+
+        # A new lookup table row re-evaluates the data already flagged
+        coverage = self.get_coverage({'time' : times, 'temp' : values})
+        kernel = GlobalRangeKernel(0, 80)
+        watermark = self.processor.process_kernel(coverage, parameter, 'temp', kernel, watermark)
+        (flags, flag_times), = coverage.set_parameter_values.call_args[0][0].values()
+        np.testing.assert_array_equal(flag_times, times)
+        np.testing.assert_array_equal(flags, kernel.evaluate(values, times)[0])
+        self.assertEquals(watermark['params'], kernel.signature())
+
+    @patch('ion.processes.data.transforms.qc_post_processing.NumpyParameterData')
+    def test_process_kernel_late_records(self, parameter_data):
+        parameter_data.side_effect = lambda name, flags, times : (flags, times)
+        parameter = Mock()
+        parameter.name = 'tempwat_spketst_qc'
+
+        rs = np.random.RandomState(0)
+        times = np.arange(500, dtype=np.float64)
+        values = np.round(rs.randn(500).cumsum(), 1)
+        values[rs.rand(500) < 0.05] = 40.
+        # Records 150 to 169 are backfilled after the rest was evaluated
+        late = (times >= 150) & (times < 170)
+
+        kernels = (GlobalRangeKernel(-10, 30), SpikeKernel(0.1, 3, 7), StuckValueKernel(0.2, 3), GradientKernel([-2., 2.], np.nan, np.nan, 0.3), TrendKernel(1, 3))
+        for kernel in kernels:
+            written = np.zeros(500, dtype=np.int8) - 88
+            watermark = None
+            for end, backfilled in ((200, False), (500, False), (500, True)):
+                present = (times < end) & (backfilled | ~late)
+                coverage = self.get_coverage({'time' : times[present], 'temp' : values[present], parameter.name : written[present]})
+                watermark = self.processor.process_kernel(coverage, parameter, 'temp', kernel, watermark)
+                for (flags, flag_times), in [call[0][0].values() for call in coverage.set_parameter_values.call_args_list]:
+                    written[flag_times.astype(int)] = flags
+
+            np.testing.assert_array_equal(written, kernel.evaluate(values, times)[0])
+            self.assertEquals(watermark['count'], 500 - kernel.right)
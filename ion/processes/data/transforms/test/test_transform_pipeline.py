@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_transform_pipeline.py
+@brief Unit tests for the transform worker's compiled pipelines and egg cache
+'''
+
+from ion.processes.data.transforms.transform_worker import TransformWorker
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.containers import DotDict
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+def double(x):
+    return x * 2
+
+def scale(x, context):
+    return x * context.factor
+
+
+@attr('UNIT', group='dm')
+class TestTransformPipeline(PyonTestCase):
+    def setUp(self):
+        self.worker = TransformWorker()
+        self.worker._dataprocesses = {
+            'dp1' : DotDict(module=__name__, function='double', argument_map={'x' : 'temp'},
+                            out_stream_def='stream_def_id', output_param='temp_double'),
+            'dp2' : DotDict(module=__name__, function='scale', argument_map={'x' : 'pressure'}),
+            'dp3' : DotDict(module=__name__, function='missing', argument_map={'x' : 'temp'}),
+        }
+
+    def test_compile_pipeline(self):
+        pipeline = self.worker.compile_pipeline('stream1', ['dp1', 'dp2'])
+        self.assertEquals([step.dataprocess_id for step in pipeline], ['dp1', 'dp2'])
+
+        step = pipeline[0]
+        self.assertIs(step.function, double)
+        self.assertEquals(step.record_params, ['temp'])
+        self.assertEquals(step.context, {})
+        self.assertEquals((step.out_stream_definition, step.output_parameter), ('stream_def_id', 'temp_double'))
+        self.assertFalse(step.cpu_bound)
+
+        # Functions taking a context get one for the stream
+        step = pipeline[1]
+        self.assertEquals(step.record_params, ['pressure'])
+        self.assertEquals(step.context.stream_id, 'stream1')
+        self.assertEquals(step.context.dataprocess_id, 'dp2')
+
+    def test_compile_missing_function(self):
+        # Data processes whose function can't be loaded are left out
+        pipeline = self.worker.compile_pipeline('stream1', ['dp3', 'dp1'])
+        self.assertEquals([step.dataprocess_id for step in pipeline], ['dp1'])
+
+    def test_retrieve_pipeline(self):
+        self.worker.retrieve_dataprocess_for_stream = Mock(return_value=['dp1'])
+        pipeline = self.worker.retrieve_pipeline_for_stream('stream1')
+        self.assertIs(self.worker.retrieve_pipeline_for_stream('stream1'), pipeline)
+        # The data processes are only looked up the first time
+        self.worker.retrieve_dataprocess_for_stream.assert_called_once_with('stream1')
+
+
+@attr('UNIT', group='dm')
+class TestEggCache(PyonTestCase):
+    URL = 'http://example.com/eggs/ion_example-0.1-py2.7.egg'
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        gettempdir = patch('ion.processes.data.transforms.transform_worker.gettempdir', return_value=tmpdir)
+        gettempdir.start()
+        self.addCleanup(gettempdir.stop)
+        requests_get = patch('ion.processes.data.transforms.transform_worker.requests.get')
+        self.get = requests_get.start()
+        self.addCleanup(requests_get.stop)
+
+    def response(self, content, status_code=200, headers=None, fail=False):
+        response = Mock()
+        response.status_code = status_code
+        response.headers = headers or {}
+        def iter_content(chunk_size):
+            yield content[:3]
+            if fail:
+                raise IOError('connection reset')
+            yield content[3:]
+        response.iter_content.side_effect = iter_content
+        return response
+
+    def cache_files(self, url):
+        return sorted(os.listdir(os.path.dirname(TransformWorker.egg_cache_path(url))))
+
+    def test_cache_hit(self):
+        url = self.URL + '#md5=' + hashlib.md5('egg data').hexdigest()
+        self.get.return_value = self.response('egg data')
+        path = TransformWorker.download_egg(url)
+        self.assertEquals(open(path).read(), 'egg data')
+        self.assertEquals(TransformWorker.download_egg(url), path)
+        self.assertEquals(self.get.call_count, 1)
+
+    def test_digest_mismatch(self):
+        url = self.URL + '#sha1=' + hashlib.sha1('egg data').hexdigest()
+        self.get.return_value = self.response('tampered')
+        with self.assertRaises(IOError):
+            TransformWorker.download_egg(url)
+        self.assertEquals(self.cache_files(url), [])
+
+        # A cached egg that no longer matches is downloaded again
+        path = TransformWorker.egg_cache_path(url)
+        with open(path, 'w') as f:
+            f.write('stale')
+        self.get.return_value = self.response('egg data')
+        TransformWorker.download_egg(url)
+        self.assertEquals(open(path).read(), 'egg data')
+
+    def test_partial_download(self):
+        self.get.return_value = self.response('egg data', fail=True)
+        with self.assertRaises(IOError):
+            TransformWorker.download_egg(self.URL)
+        self.assertEquals(self.cache_files(self.URL), [])
+
+    def test_revalidation(self):
+        self.get.return_value = self.response('egg data', headers={'etag' : '"v1"', 'last-modified' : 'Mon, 01 Jul 2013 00:00:00 GMT'})
+        path = TransformWorker.download_egg(self.URL)
+
+        # Within the TTL the cached egg is used as is
+        TransformWorker.download_egg(self.URL)
+        self.assertEquals(self.get.call_count, 1)
+
+        with patch.object(TransformWorker, 'EGG_CACHE_TTL', 0):
+            self.get.return_value = self.response('', status_code=304)
+            self.assertEquals(TransformWorker.download_egg(self.URL), path)
+            headers = self.get.call_args[1]['headers']
+            self.assertEquals(headers['If-None-Match'], '"v1"')
+            self.assertEquals(headers['If-Modified-Since'], 'Mon, 01 Jul 2013 00:00:00 GMT')
+            self.assertEquals(open(path).read(), 'egg data')
+
+            # A republished egg replaces the cached one
+            self.get.return_value = self.response('new egg data', headers={'etag' : '"v2"'})
+            TransformWorker.download_egg(self.URL)
+            self.assertEquals(open(path).read(), 'new egg data')
+            self.assertEquals(TransformWorker.read_egg_info(path)['etag'], '"v2"')
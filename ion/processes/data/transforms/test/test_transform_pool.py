@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_transform_pool.py
+@brief Unit tests for the transform worker's process pool
+'''
+
+from ion.processes.data.transforms.transform_pool import TransformPool, to_shared, from_shared, release_shared, cpu_bound
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+
+import gevent
+import numpy as np
+import os
+import time
+
+
+@attr('UNIT', group='dm')
+class TestTransformPool(PyonTestCase):
+    def test_shared_arrays(self):
+        arr = np.arange(10, dtype=np.float32)
+        descriptor = to_shared(arr, '/tmp')
+        self.assertEquals(descriptor[0], 'shm')
+        self.assertTrue(os.path.exists(descriptor[1]))
+        np.testing.assert_array_equal(from_shared(descriptor), arr)
+        release_shared(descriptor)
+        self.assertFalse(os.path.exists(descriptor[1]))
+
+        # Non numeric values are passed by value
+        for value in (np.array(['a', 'b'], dtype=object), {'stream_id':'abc'}, None):
+            descriptor = to_shared(value, '/tmp')
+            self.assertEquals(descriptor[0], 'value')
+
+    def test_cpu_bound(self):
+        @cpu_bound
+        def func(a):
+            return a
+        self.assertTrue(func.cpu_bound)
+
+    def test_pool(self):
+        pool = TransformPool(1, shm_dir='/tmp')
+        self.addCleanup(pool.close)
+
+        a = np.arange(100, dtype=np.float64)
+        job = pool.submit('numpy', 'add', None, [a, a])
+        np.testing.assert_array_equal(pool.result(job), a * 2)
+
+        job = pool.submit('numpy', 'add', None, [a, np.arange(3)])
+        with self.assertRaises(ValueError):
+            pool.result(job)
+
+    def test_hub_not_blocked(self):
+        pool = TransformPool(2, shm_dir='/tmp')
+        self.addCleanup(pool.close)
+
+        ticks = []
+        def ticker():
+            while True:
+                ticks.append(time.time())
+                gevent.sleep(0.01)
+        ticker = gevent.spawn(ticker)
+        self.addCleanup(ticker.kill)
+
+        # Both workers sleep at the same time while the ticker keeps running
+        t0 = time.time()
+        jobs = [pool.submit('time', 'sleep', None, [0.5]) for i in xrange(2)]
+        for job in jobs:
+            self.assertIsNone(pool.result(job))
+        self.assertLess(time.time() - t0, 0.9)
+        self.assertGreater(len(ticks), 20)
+
+    def test_worker_exit(self):
+        pool = TransformPool(1, shm_dir='/tmp')
+        self.addCleanup(pool.close)
+        pid = pool._workers[0].pid
+
+        job = pool.submit('os', '_exit', None, [1])
+        with self.assertRaises(IOError):
+            pool.result(job)
+
+        # The worker is replaced and the pool keeps working
+        self.assertNotEquals(pool._workers[0].pid, pid)
+        a = np.arange(10)
+        np.testing.assert_array_equal(pool.result(pool.submit('numpy', 'add', None, [a, a])), a * 2)
@@ -36,6 +36,7 @@ from interface.services.sa.idata_process_management_service import DataProcessMa
 from interface.services.sa.idata_acquisition_management_service import DataAcquisitionManagementServiceClient
 from interface.services.cei.iprocess_dispatcher_service import ProcessDispatcherServiceClient
 from ion.processes.data.transforms.transform_worker import TransformWorker
+from ion.processes.data.transforms.transform_pool import cpu_bound
 from ion.services.dm.test.test_dm_end_2_end import DatasetMonitor
 from ion.services.dm.utility.test.parameter_helper import ParameterHelper
 from interface.services.sa.iinstrument_management_service import InstrumentManagementServiceProcessClient
@@ -45,6 +46,7 @@ from coverage_model.coverage import AbstractCoverage
 from pyon.util.context import LocalContextMixin
 
 from gevent.event import Event
+from mock import patch
 
 import unittest
 import os
@@ -62,6 +64,11 @@ def validate_salinity_array(a, context={}):
 
     event_publisher.publish_event(  origin = stream_id, values=[dataprocess_id], description="Invalid value for salinity")
 
+@cpu_bound
+def add_arrays_in_pool(a, b):
+    # Runs in a transform pool worker process
+    return a + b
+
 class TransformWorkerTestProcess(LocalContextMixin):
     name = 'tranform_worker_test'
     id='tranform_worker_int_test'
@@ -491,6 +498,69 @@ class TestTransformWorker(IonIntegrationTestCase):
         self.assertEqual(ex.message, "Output data product does not contain the output parameter name provided")
 
 
+    @attr('LOCOINT')
+    @unittest.skipIf(os.getenv('CEI_LAUNCH_TEST', False), 'Skip test while in CEI LAUNCH mode')
+    def test_transform_worker_pool(self):
+        # A CPU bound data process runs in the pool of a transform worker launched in the container
+        self.dp_list = []
+        self._output_stream_ids = []
+        self.granule_verified = Event()
+
+        self.parameter_dict_id = self.dataset_management_client.read_parameter_dictionary_by_name(name='ctd_parsed_param_dict', id_only=True)
+        self.stream_def_id = self.pubsub_client.create_stream_definition(name='stream_def', parameter_dictionary_id=self.parameter_dict_id)
+        self.addCleanup(self.pubsub_client.delete_stream_definition, self.stream_def_id)
+
+        input_dp_obj = IonObject(RT.DataProduct, name='input_data_product', description='input test stream')
+        self.input_dp_id = self.dataproductclient.create_data_product(data_product=input_dp_obj, stream_definition_id=self.stream_def_id)
+        stream_ids, _ = self.rrclient.find_objects(self.input_dp_id, PRED.hasStream, RT.Stream, True)
+        self.stream_id = stream_ids[0]
+
+        output_dp_id = self.create_output_data_product()
+        tf_obj = IonObject(RT.TransformFunction,
+            name='add_array_pool_func',
+            description='adds values in an array in the transform pool',
+            function='add_arrays_in_pool',
+            module='ion.processes.data.transforms.test.test_transform_worker',
+            arguments=['a', 'b'],
+            function_type=TransformFunctionType.TRANSFORM)
+        func_id, _ = self.rrclient.create(tf_obj)
+
+        dpd_obj = IonObject(RT.DataProcessDefinition,
+            name='add_arrays_in_pool',
+            description='adds the values of two arrays in the transform pool',
+            data_process_type=DataProcessTypeEnum.TRANSFORM_PROCESS)
+        dpd_id = self.dataprocessclient.create_data_process_definition(data_process_definition=dpd_obj, function_id=func_id)
+        self.dataprocessclient.assign_stream_definition_to_data_process_definition(self.stream_def_id, dpd_id, binding='add_array_pool_func')
+
+        # The worker launched for the data process starts a pool
+        pool_size = patch.object(TransformWorker, 'POOL_SIZE', 1)
+        pool_size.start()
+        self.addCleanup(pool_size.stop)
+        dp_id = self.dataprocessclient.create_data_process(data_process_definition_id=dpd_id, inputs=[self.input_dp_id],
+                                                           outputs=[output_dp_id], argument_map={'a' : 'conductivity', 'b' : 'pressure'},
+                                                           out_param_name='salinity')
+        self.damsclient.register_process(dp_id)
+        self.addCleanup(self.dataprocessclient.delete_data_process, dp_id)
+
+        subscription_objs, _ = self.rrclient.find_objects(subject=dp_id, predicate=PRED.hasSubscription, object_type=RT.Subscription, id_only=False)
+        subscription_id = self.pubsub_client.create_subscription(name='parsed_subscription', stream_ids=[self.stream_id], exchange_name=subscription_objs[0].exchange_name)
+        self.addCleanup(self.pubsub_client.delete_subscription, subscription_id)
+        self.pubsub_client.activate_subscription(subscription_id)
+        self.addCleanup(self.pubsub_client.deactivate_subscription, subscription_id)
+
+        stream_route = self.pubsub_client.read_stream_route(self.stream_id)
+        publisher = StandaloneStreamPublisher(stream_id=self.stream_id, stream_route=stream_route)
+        for n in range(10):
+            rdt = RecordDictionaryTool(stream_definition_id=self.stream_def_id)
+            rdt['time']         = [n]
+            rdt['conductivity'] = [1]
+            rdt['pressure']     = [2]
+            rdt['salinity']     = [8]
+            publisher.publish(rdt.to_granule())
+
+        # validate_output_granule checks the salinity computed by the pool worker
+        self.assertTrue(self.granule_verified.wait(self.wait_time))
+
     def create_event_data_processes(self):
 
         # two data processes using one transform and one DPD
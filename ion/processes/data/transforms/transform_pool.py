@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/transform_pool.py
+@description Process pool execution for CPU bound data process functions.
+
+The workers are separate python processes started with exec rather than
+forked from the container, so they inherit none of its gevent hub, AMQP
+connections or threads. Requests and replies are pickled over the workers'
+stdin and stdout pipes, which the container side waits on with gevent so a
+running function never blocks the hub. Numeric numpy arguments and results
+are exchanged through memory mapped files in a shared memory directory
+(/dev/shm by default) rather than being pickled through the pipes.
+'''
+
+from pyon.util.log import log
+
+from gevent.socket import wait_read, wait_write
+from gevent.queue import Queue
+from tempfile import gettempdir
+import cPickle as pickle
+import subprocess
+import importlib
+import signal
+import struct
+import errno
+import fcntl
+import gevent
+import numpy as np
+import sys
+import os
+import uuid
+
+
+def cpu_bound(func):
+    '''
+    Marks a data process function to be run in the transform worker's
+    process pool when one is configured
+    '''
+    func.cpu_bound = True
+    return func
+
+
+def default_shm_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return gettempdir()
+
+
+#--------------------------------------------------------------------------------
+# Shared arrays
+#--------------------------------------------------------------------------------
+
+def is_shareable(value):
+    return isinstance(value, np.ndarray) and value.dtype.kind in 'biufc' and value.size > 0
+
+def to_shared(value, shm_dir):
+    '''
+    Writes numeric arrays to a memory mapped file and returns a descriptor
+    for them, anything else is returned as is and gets pickled
+    '''
+    if not is_shareable(value):
+        return ('value', value)
+    path = os.path.join(shm_dir, 'tfw-%s.dat' % uuid.uuid4().hex)
+    shared = np.memmap(path, dtype=value.dtype, mode='w+', shape=value.shape)
+    shared[:] = value
+    del shared
+    return ('shm', path, value.dtype.str, value.shape)
+
+def from_shared(descriptor, copy=False):
+    '''
+    Returns the value for a descriptor made by to_shared. Unless copy is
+    set the array is a read only view of the mapped file.
+    '''
+    if descriptor[0] == 'value':
+        return descriptor[1]
+    kind, path, dtype, shape = descriptor
+    value = np.memmap(path, dtype=np.dtype(dtype), mode='r', shape=shape)
+    if copy:
+        value = np.array(value)
+    return value
+
+def release_shared(descriptor):
+    if descriptor[0] == 'shm':
+        try:
+            os.remove(descriptor[1])
+        except OSError:
+            pass
+
+
+#--------------------------------------------------------------------------------
+# Worker channel
+#--------------------------------------------------------------------------------
+
+_HEADER = struct.Struct('!I')
+
+def _write(fd, data, wait=None):
+    '''
+    Writes all of data to fd. With wait set the descriptor is non blocking
+    and wait(fd) is called until it can be written to.
+    '''
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN and wait is not None:
+                wait(fd)
+                continue
+            raise
+        data = data[written:]
+
+def _read(fd, size, wait=None):
+    '''
+    Reads exactly size bytes from fd, raises EOFError if the other end closed
+    '''
+    chunks = []
+    while size:
+        try:
+            chunk = os.read(fd, size)
+        except OSError as e:
+            if e.errno == errno.EAGAIN and wait is not None:
+                wait(fd)
+                continue
+            raise
+        if not chunk:
+            raise EOFError('Transform pool channel closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def send_message(fd, message, wait=None):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    _write(fd, _HEADER.pack(len(data)) + data, wait)
+
+def receive_message(fd, wait=None):
+    size, = _HEADER.unpack(_read(fd, _HEADER.size, wait))
+    return pickle.loads(_read(fd, size, wait))
+
+
+#--------------------------------------------------------------------------------
+# Pool worker side
+#--------------------------------------------------------------------------------
+
+_functions = {}
+
+def _resolve_function(module, function, egg):
+    key = (module, function)
+    if key not in _functions:
+        if egg:
+            import pkg_resources
+            if egg not in pkg_resources.working_set.entries:
+                pkg_resources.working_set.add_entry(egg)
+        _functions[key] = getattr(importlib.import_module(module), function)
+    return _functions[key]
+
+def execute(module, function, egg, args, shm_dir):
+    '''
+    Runs in a pool process: maps the arguments, runs the function and writes
+    the result back to shared memory
+    '''
+    func = _resolve_function(module, function, egg)
+    values = [from_shared(arg) for arg in args]
+    result = func(*values)
+    if isinstance(result, np.memmap):
+        result = np.array(result)
+    return to_shared(result, shm_dir)
+
+
+def worker_main():
+    '''
+    Worker process loop: runs requests read from stdin until it is closed
+    '''
+    # The container stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    in_fd = sys.stdin.fileno()
+    # Replies get a private copy of stdout, anything the functions print goes to stderr
+    out_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        try:
+            module, function, egg, args, shm_dir = receive_message(in_fd)
+        except EOFError:
+            break
+        try:
+            reply = ('result', execute(module, function, egg, args, shm_dir))
+        except Exception as e:
+            reply = ('error', e)
+        try:
+            send_message(out_fd, reply)
+        except (pickle.PicklingError, TypeError):
+            # Exceptions that can't be pickled are sent as their message
+            send_message(out_fd, ('error', RuntimeError('%s: %s' % (type(reply[1]).__name__, reply[1]))))
+
+
+#--------------------------------------------------------------------------------
+# Transform worker side
+#--------------------------------------------------------------------------------
+
+class PoolWorker(object):
+    '''
+    A worker process and its request pipes
+    '''
+    STOP_TIMEOUT = 5
+
+    def __init__(self):
+        env = dict(os.environ)
+        # The worker imports modules from the same path as the container
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        self.process = subprocess.Popen([sys.executable, '-m', __name__],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        close_fds=True, env=env)
+        self.in_fd = self.process.stdin.fileno()
+        self.out_fd = self.process.stdout.fileno()
+        for fd in (self.in_fd, self.out_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def call(self, request):
+        '''
+        Sends a request and waits for its (status, value) reply without blocking
+        other greenlets
+        '''
+        send_message(self.in_fd, request, wait=wait_write)
+        return receive_message(self.out_fd, wait=wait_read)
+
+    def close(self):
+        '''
+        Closes the worker's stdin so it exits, killing it if it doesn't
+        '''
+        for f in (self.process.stdin, self.process.stdout):
+            try:
+                f.close()
+            except IOError:
+                pass
+        for i in xrange(int(self.STOP_TIMEOUT / 0.01)):
+            if self.process.poll() is not None:
+                return
+            gevent.sleep(0.01)
+        log.warning('Transform pool worker %d did not exit, killing it', self.pid)
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class TransformPool(object):
+    '''
+    A pool of worker processes running data process functions. Jobs run in
+    greenlets that wait on the worker pipes, so neither submitting nor
+    waiting on a result blocks the gevent hub.
+    '''
+
+    def __init__(self, size, shm_dir=None):
+        self.size = size
+        self.shm_dir = shm_dir or default_shm_dir()
+        self._closed = False
+        self._workers = [PoolWorker() for i in xrange(size)]
+        self._idle = Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def submit(self, module, function, egg, args):
+        '''
+        Starts running the function on the arguments, returns a job to pass to result()
+        '''
+        descriptors = [to_shared(arg, self.shm_dir) for arg in args]
+        try:
+            greenlet = gevent.spawn(self._call, (module, function, egg, descriptors, self.shm_dir))
+        except:
+            for descriptor in descriptors:
+                release_shared(descriptor)
+            raise
+        return (greenlet, descriptors)
+
+    def result(self, job):
+        '''
+        Waits for the job to complete and returns its result, reraising any
+        exception the function raised
+        '''
+        greenlet, descriptors = job
+        try:
+            descriptor = greenlet.get()
+        finally:
+            for arg in descriptors:
+                release_shared(arg)
+        try:
+            return from_shared(descriptor, copy=True)
+        finally:
+            release_shared(descriptor)
+
+    def _call(self, request):
+        worker = self._idle.get()
+        try:
+            status, value = worker.call(request)
+        except Exception:
+            # The worker died or its pipes broke, it is replaced
+            log.error('Transform pool worker %d failed', worker.pid, exc_info=True)
+            self._replace(worker)
+            raise IOError('Transform pool worker %d failed running %s.%s' % (worker.pid, request[0], request[1]))
+        self._idle.put(worker)
+        if status == 'error':
+            raise value
+        return value
+
+    def _replace(self, worker):
+        self._workers.remove(worker)
+        worker.close()
+        if not self._closed:
+            replacement = PoolWorker()
+            self._workers.append(replacement)
+            self._idle.put(replacement)
+
+    def close(self):
+        self._closed = True
+        for worker in list(self._workers):
+            try:
+                worker.close()
+            except Exception:
+                log.exception('Problems closing the transform pool')
+        self._workers = []
+
+
+if __name__ == '__main__':
+    worker_main()
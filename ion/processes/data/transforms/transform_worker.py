@@ -14,6 +14,7 @@ from pyon.util.containers import DotDict
 
 
 from gevent.coros import RLock
+from gevent.queue import Queue
 
 from pyon.public import log, RT, PRED, CFG, OT
 from pyon.util.arg_check import validate_is_instance
@@ -22,9 +23,17 @@ from pyon.core.object import IonObjectSerializer
 from pyon.ion.stream import StreamSubscriber
 from pyon.ion.event import handle_stream_exception
 
+from ion.processes.data.transforms.transform_pool import TransformPool
+
 from tempfile import gettempdir
+import hashlib
+import importlib
+import inspect
+import json
 import os
 import requests
+import time
+import urlparse
 
 
 class TransformWorker(TransformStreamListener):
@@ -33,6 +42,13 @@ class TransformWorker(TransformStreamListener):
     # Status publishes after a set of granules has been processed
     STATUS_INTERVAL = 100
 
+    # Number of processes running CPU bound data process functions, 0 runs everything inline
+    POOL_SIZE = CFG.get_safe('container.transform_worker.pool_size', 0)
+    # Maximum number of pending steps per stream before the subscriber blocks
+    POOL_QUEUE_SIZE = CFG.get_safe('container.transform_worker.pool_queue_size', 100)
+    # Seconds a cached egg without a digest in its URL is used before the server is asked for a newer one
+    EGG_CACHE_TTL = CFG.get_safe('container.transform_worker.egg_cache_ttl', 3600)
+
     def __init__(self, *args,**kwargs):
         super(TransformWorker, self).__init__(*args, **kwargs)
 
@@ -43,6 +59,17 @@ class TransformWorker(TransformStreamListener):
 
         self._transforms = {}
 
+        # stream_id -> list of compiled data process steps
+        self._pipelines = {}
+        # egg url -> local path of eggs already added to the working set
+        self._eggs = {}
+
+        # Process pool and the per-stream queues keeping its results in order
+        self.pool = None
+        self.pool_queue_size = self.POOL_QUEUE_SIZE
+        self._output_queues = {}
+        self._output_threads = {}
+
 
     def on_start(self): #pragma no cover
         #super(TransformWorker,self).on_start()
@@ -64,6 +91,12 @@ class TransformWorker(TransformStreamListener):
         self._rpc_server = self.container.proc_manager._create_listening_endpoint(from_name=self.id, process=self)
         self.add_endpoint(self._rpc_server)
 
+        # The pool workers are started before the listener
+        pool_size = self.CFG.get_safe('process.pool_size', self.POOL_SIZE)
+        self.pool_queue_size = self.CFG.get_safe('process.pool_queue_size', self.POOL_QUEUE_SIZE)
+        if pool_size:
+            self.pool = TransformPool(pool_size, shm_dir=self.CFG.get_safe('process.shm_dir', None))
+
         self.start_listener()
 
         #todo: determine and publish appropriate set of status events
@@ -72,9 +105,10 @@ class TransformWorker(TransformStreamListener):
 
 
     def on_quit(self): #pragma no cover
-        self.event_publisher.close()
         if self.subscriber_thread:
             self.stop_listener()
+        self.stop_pool()
+        self.event_publisher.close()
         super(TransformWorker, self).on_quit()
 
     def start_listener(self):
@@ -107,6 +141,7 @@ class TransformWorker(TransformStreamListener):
             return
 
 
+        # The granule is decoded once and shared by every data process on the stream
         rdt = RecordDictionaryTool.load_from_granule(msg)
         log.debug('received granule for stream rdt %s', rdt)
         if rdt is None:
@@ -116,56 +151,99 @@ class TransformWorker(TransformStreamListener):
             log.debug('Empty granule for stream %s', stream_id)
             return
 
-        dp_id_list = self.retrieve_dataprocess_for_stream(stream_id)
-
-        for dp_id in dp_id_list:
-
-            function, argument_list, context = self.retrieve_function_and_define_args(stream_id, dp_id)
-
-            args = []
-            rdt = RecordDictionaryTool.load_from_granule(msg)
-
+        for step in self.retrieve_pipeline_for_stream(stream_id):
             #create the input arguments list
-            #todo: this logic is tied to the example function, generalize
             #todo: how to inject params not in the granule such as stream_id, dp_id, etc?
-            for func_param, record_param in argument_list.iteritems():
-                args.append(rdt[record_param])
-            if context:
-                args.append(context)
+            args = [rdt[record_param] for record_param in step.record_params]
+            if step.context:
+                args.append(step.context)
+
+            if self.pool is not None:
+                self.dispatch(stream_id, step, rdt, args)
+                continue
 
             try:
                 #run the calc
-                #todo: nothing in the data process resource to specify multi-out map
-                result = ''
-                try:
-                    result = function(*args)
-                    log.debug('recv_packet  result: %s',result)
-                except:
-                    log.error('Error running transform %s with args %s.', dp_id, args, exc_info=True)
-                    raise
-
-                out_stream_definition, output_parameter = self.retrieve_dp_output_params(dp_id)
-
-                if out_stream_definition and output_parameter:
-                    rdt_out = RecordDictionaryTool(stream_definition_id=out_stream_definition)
-                    publisher = self._publisher_map.get(dp_id,'')
-
-                    for param in rdt:
-                        if param in rdt_out:
-                            rdt_out[param] = rdt[param]
-                    rdt_out[ output_parameter ] = result
-
-                    if publisher:
-                        log.debug('output rdt: %s',rdt)
-                        publisher.publish(rdt_out.to_granule())
-                    else:
-                        log.error('Publisher not found for data process %s', dp_id)
-
-                self.update_dp_metrics( dp_id )
+                result = self.run_step(step, args)
+                self.publish_result(step, rdt, result)
 
             except ImportError:
                 log.error('Error running transform')
 
+    def run_step(self, step, args):
+        #todo: nothing in the data process resource to specify multi-out map
+        result = ''
+        try:
+            result = step.function(*args)
+            log.debug('recv_packet  result: %s',result)
+        except:
+            log.error('Error running transform %s with args %s.', step.dataprocess_id, args, exc_info=True)
+            raise
+        return result
+
+    def publish_result(self, step, rdt, result):
+        dp_id = step.dataprocess_id
+        out_stream_definition, output_parameter = step.out_stream_definition, step.output_parameter
+
+        if out_stream_definition and output_parameter:
+            rdt_out = RecordDictionaryTool(stream_definition_id=out_stream_definition)
+            publisher = self._publisher_map.get(dp_id,'')
+
+            for param in rdt:
+                if param in rdt_out:
+                    rdt_out[param] = rdt[param]
+            rdt_out[ output_parameter ] = result
+
+            if publisher:
+                log.debug('output rdt: %s',rdt)
+                publisher.publish(rdt_out.to_granule())
+            else:
+                log.error('Publisher not found for data process %s', dp_id)
+
+        self.update_dp_metrics( dp_id )
+
+    #--------------------------------------------------------------------------------
+    # Process pool execution
+    #--------------------------------------------------------------------------------
+
+    def dispatch(self, stream_id, step, rdt, args):
+        '''
+        Starts CPU bound steps in the process pool (other steps run inline) and
+        queues them for the stream's output greenlet, which publishes the
+        results in the order the granules arrived. The queue is bounded so a
+        slow pool pushes back on the subscriber.
+        '''
+        job, result = None, None
+        if step.cpu_bound:
+            job = self.pool.submit(step.module, step.function_name, step.egg, args)
+        else:
+            result = self.run_step(step, args)
+        if stream_id not in self._output_queues:
+            self._output_queues[stream_id] = Queue(maxsize=self.pool_queue_size)
+            self._output_threads[stream_id] = self._process.thread_manager.spawn(self.output_loop, stream_id, thread_name='%s-output-%s' % (self.id, stream_id))
+        self._output_queues[stream_id].put((step, rdt, job, result))
+
+    def output_loop(self, stream_id):
+        # Iteration ends when StopIteration is put on the queue
+        for step, rdt, job, result in self._output_queues[stream_id]:
+            try:
+                if job is not None:
+                    result = self.pool.result(job)
+                self.publish_result(step, rdt, result)
+            except Exception:
+                log.error('Error running transform %s', step.dataprocess_id, exc_info=True)
+
+    def stop_pool(self):
+        for queue in self._output_queues.itervalues():
+            queue.put(StopIteration)
+        for thread in self._output_threads.itervalues():
+            thread.join(timeout=10)
+        self._output_queues.clear()
+        self._output_threads.clear()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
     def retrieve_dataprocess_for_stream(self, stream_id):
         # if any data procrocesses apply to this stream
         dp_id_list = []
@@ -176,8 +254,46 @@ class TransformWorker(TransformStreamListener):
         return dp_id_list
 
 
+    def retrieve_pipeline_for_stream(self, stream_id):
+        '''
+        Returns the compiled pipeline for the stream, building it the first
+        time the stream is seen
+        '''
+        if stream_id in self._pipelines:
+            return self._pipelines[stream_id]
+        dp_id_list = self.retrieve_dataprocess_for_stream(stream_id)
+        return self.compile_pipeline(stream_id, dp_id_list)
+
+    def compile_pipeline(self, stream_id, dp_id_list):
+        '''
+        Resolves the function, argument extractors, context and output
+        parameters of each data process on the stream once, so none of it is
+        repeated per granule
+        '''
+        pipeline = []
+        for dp_id in dp_id_list:
+            function, argument_list, context = self.retrieve_function_and_define_args(stream_id, dp_id)
+            if not function:
+                log.error('Data process %s has no function and will not be run', dp_id)
+                continue
+            out_stream_definition, output_parameter = self.retrieve_dp_output_params(dp_id)
+            dataprocess_info = self._dataprocesses[dp_id]
+            step = DotDict()
+            step.dataprocess_id = dp_id
+            step.function = function
+            step.module = dataprocess_info.get_safe('module', '')
+            step.function_name = dataprocess_info.get_safe('function', '')
+            step.egg = self._eggs.get(dataprocess_info.get_safe('uri', ''))
+            step.cpu_bound = bool(getattr(function, 'cpu_bound', False) or dataprocess_info.get_safe('cpu_bound', False))
+            step.record_params = [record_param for func_param, record_param in argument_list.iteritems()]
+            step.context = context
+            step.out_stream_definition = out_stream_definition
+            step.output_parameter = output_parameter
+            pipeline.append(step)
+        self._pipelines[stream_id] = pipeline
+        return pipeline
+
     def retrieve_function_and_define_args(self, stream_id, dataprocess_id):
-        import importlib
         argument_list = {}
         function = ''
         context = {}
@@ -191,9 +307,7 @@ class TransformWorker(TransformStreamListener):
             #load the associated transform function
             egg_uri = dataprocess_info.get_safe('uri','')
             if egg_uri:
-                egg = self.download_egg(egg_uri)
-                import pkg_resources
-                pkg_resources.working_set.add_entry(egg)
+                self.add_egg(egg_uri)
             else:
                 log.warning('No uri provided for module in data process definition.')
 
@@ -206,8 +320,8 @@ class TransformWorker(TransformStreamListener):
             if self.has_context_arg(function,argument_list ):
                 context = self.create_context_arg(stream_id, dataprocess_id)
 
-        except ImportError:
-            log.error('Error running transform')
+        except (ImportError, AttributeError):
+            log.error('Error loading the function for data process %s', dataprocess_id, exc_info=True)
         log.debug('retrieve_function_and_define_args  argument_list: %s',argument_list)
         return function, argument_list, context
 
@@ -280,30 +394,131 @@ class TransformWorker(TransformStreamListener):
 
         self._publisher_map[dataprocess_id] = publisher
 
+    def add_egg(self, url):
+        '''
+        Downloads the egg (unless it's cached) and adds it to the working set,
+        once per egg
+        '''
+        if url in self._eggs:
+            return self._eggs[url]
+        egg = self.download_egg(url)
+        import pkg_resources
+        pkg_resources.working_set.add_entry(egg)
+        self._eggs[url] = egg
+        return egg
+
     @classmethod
-    def download_egg(cls, url):
+    def egg_cache_path(cls, url):
         '''
-        Downloads an egg from the URL specified into the cache directory
-        Returns the full path to the egg
+        Returns the path an egg is cached at, keyed by a hash of its URL
         '''
         # Get the filename based on the URL
-        filename = url.split('/')[-1]
+        filename = urlparse.urldefrag(url)[0].split('/')[-1]
         # Store it in the $TMPDIR
-        egg_cache = gettempdir()
-        path = os.path.join(egg_cache, filename)
-        r = requests.get(url, stream=True)
+        egg_cache = os.path.join(gettempdir(), 'egg_cache', hashlib.sha1(url).hexdigest())
+        return os.path.join(egg_cache, filename)
+
+    @classmethod
+    def egg_digest(cls, url):
+        '''
+        Returns (algorithm, hexdigest) from a URL fragment like #md5=... or
+        (None, None) if the URL doesn't carry one
+        '''
+        fragment = urlparse.urldefrag(url)[1]
+        if '=' in fragment:
+            algorithm, digest = fragment.split('=', 1)
+            if algorithm in ('md5', 'sha1', 'sha256'):
+                return algorithm, digest.lower()
+        return None, None
+
+    @classmethod
+    def verify_egg(cls, url, path):
+        algorithm, digest = cls.egg_digest(url)
+        if algorithm is None:
+            return True
+        h = hashlib.new(algorithm)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                h.update(chunk)
+        return h.hexdigest() == digest
+
+    @classmethod
+    def read_egg_info(cls, path):
+        '''
+        Returns the validators (etag, last_modified) and the time of the last
+        check against the server for a cached egg
+        '''
+        try:
+            with open(path + '.info') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @classmethod
+    def write_egg_info(cls, path, info):
+        with open(path + '.info', 'w') as f:
+            json.dump(info, f)
+
+    @classmethod
+    def download_egg(cls, url):
+        '''
+        Downloads an egg from the URL specified into the cache directory
+        Returns the full path to the egg. Eggs already in the cache aren't
+        downloaded again if they match the hash in the URL's fragment. Without
+        a hash they are reused for EGG_CACHE_TTL seconds, then revalidated
+        against the server's ETag/Last-Modified.
+        '''
+        path = cls.egg_cache_path(url)
+        algorithm, digest = cls.egg_digest(url)
+        cached = os.path.exists(path) and os.path.getsize(path)
+        headers = {}
+        info = {}
+        if cached:
+            if algorithm is not None:
+                if cls.verify_egg(url, path):
+                    return path
+            else:
+                info = cls.read_egg_info(path)
+                if time.time() - info.get('checked', 0) < cls.EGG_CACHE_TTL:
+                    return path
+                if info.get('etag'):
+                    headers['If-None-Match'] = info['etag']
+                if info.get('last_modified'):
+                    headers['If-Modified-Since'] = info['last_modified']
+        egg_cache = os.path.dirname(path)
+        if not os.path.exists(egg_cache):
+            os.makedirs(egg_cache)
+        try:
+            r = requests.get(urlparse.urldefrag(url)[0], stream=True, headers=headers)
+        except requests.exceptions.RequestException:
+            if cached and algorithm is None:
+                log.warning("Couldn't check %s for a newer egg, using the cached one", url, exc_info=True)
+                return path
+            raise
+        if r.status_code == 304 and headers:
+            info['checked'] = time.time()
+            cls.write_egg_info(path, info)
+            return path
         if r.status_code == 200:
-            # Download the file using requests stream
-            with open(path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
+            # Download the file using requests stream, then move it into place
+            partial = '%s.%s.part' % (path, os.getpid())
+            try:
+                with open(partial, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=1024):
+                        if chunk:
+                            f.write(chunk)
+                if not cls.verify_egg(url, partial):
+                    raise IOError("Hash mismatch for the file at %s" % url)
+                os.rename(partial, path)
+            except:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            cls.write_egg_info(path, {'etag' : r.headers.get('etag'), 'last_modified' : r.headers.get('last-modified'), 'checked' : time.time()})
             return path
         raise IOError("Couldn't download the file at %s" % url)
 
     def has_context_arg(self, func , argument_map):
-        import inspect
         argspec = inspect.getargspec(func)
         return argspec.args != argument_map and 'context' in argspec.args
 
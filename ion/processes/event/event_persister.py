@@ -2,16 +2,29 @@
 
 """Process that subscribes to ALL events and persists them efficiently in bulk into the events datastore"""
 
+import itertools
+import msgpack
+import os
 import pprint
-from gevent.queue import Queue
+import time
+from tempfile import gettempdir
+from gevent.queue import Queue, Full
 from gevent.event import Event
+from gevent.pool import Pool
 
+from pyon.core.bootstrap import get_obj_registry
+from pyon.core.exception import Conflict, NotFound
+from pyon.core.object import IonObjectSerializer, IonObjectDeserializer
 from pyon.event.event import EventSubscriber
 from pyon.ion.process import StandaloneProcess
 from pyon.util.async import spawn
 from pyon.util.containers import named_any
 from pyon.public import log
 
+from ooi.timer import Accumulator
+
+stats = Accumulator(persist=True)
+
 PROCESS_PLUGINS = [("DeviceStateManager", "ion.processes.event.device_state.DeviceStateManager", {}),
                    ("NotificationSentScanner","ion.processes.event.notification_sent_scanner.NotificationSentScanner", {})]
 
@@ -32,8 +45,24 @@ class EventPersister(StandaloneProcess):
         # Time in between view refreshs
         self.refresh_interval = float(self.CFG.get_safe("process.event_persister.refresh_interval", 60.0))
 
+        # Maximum number of events held in memory, beyond that the overflow policy applies
+        self.max_queue_size = int(self.CFG.get_safe("process.event_persister.max_queue_size", 100000))
+
+        # What to do with events when the queue is full: "spill" them to a local append-only file that is
+        # replayed once the datastore catches up, or "drop" them
+        self.overflow_policy = self.CFG.get_safe("process.event_persister.overflow_policy", "spill")
+        spill_dir = self.CFG.get_safe("process.event_persister.spill_dir", os.path.join(gettempdir(), "event_persister"))
+        self.spill = EventSpillFile(spill_dir) if self.overflow_policy == "spill" else None
+
+        # Maximum number of events in one put_events call and number of those calls made concurrently
+        self.max_batch_size = int(self.CFG.get_safe("process.event_persister.max_batch_size", 1000))
+        self.write_concurrency = int(self.CFG.get_safe("process.event_persister.write_concurrency", 4))
+
         # Holds received events FIFO in syncronized queue
-        self.event_queue = Queue()
+        self.event_queue = Queue(maxsize=self.max_queue_size or None)
+
+        # Counters, also exported to the stats accumulator every persist cycle
+        self.counters = dict(received=0, persisted=0, spilled=0, replayed=0, dropped=0, failed_batches=0)
 
         # Temporarily holds list of events to persist while datastore operation are not yet completed
         # This is where events to persist will remain if datastore operation fails occasionally.
@@ -90,8 +119,37 @@ class EventPersister(StandaloneProcess):
         self._persist_greenlet.join(timeout=5)
         self._refresh_greenlet.join(timeout=5)
 
+        if self.spill is not None:
+            self.spill.close()
+
     def _on_event(self, event, *args, **kwargs):
-        self.event_queue.put(event)
+        self.counters['received'] += 1
+        try:
+            self.event_queue.put_nowait(event)
+        except Full:
+            self._overflow(event)
+
+    def _overflow(self, event):
+        if self.spill is not None:
+            try:
+                self.spill.append(event)
+                self.counters['spilled'] += 1
+                return
+            except Exception:
+                log.exception("Failed to spill event to %s", self.spill.path)
+        self.counters['dropped'] += 1
+        if self.counters['dropped'] % 1000 == 1:
+            log.error("Event queue full, %s events dropped so far", self.counters['dropped'])
+
+    def get_stats(self):
+        stats_dict = dict(self.counters)
+        stats_dict['queue_depth'] = self.event_queue.qsize()
+        stats_dict['spill_pending'] = len(self.spill) if self.spill is not None else 0
+        return stats_dict
+
+    def _export_stats(self):
+        for name, value in self.get_stats().iteritems():
+            stats.add_value('event_persister.%s' % name, value)
 
     def _in_blacklist(self, event):
         if event.type_ in self._event_type_blacklist:
@@ -132,8 +190,11 @@ class EventPersister(StandaloneProcess):
                 elif self.events_to_persist:
                     # There was an error last time and we need to retry
                     log.info("Retry persisting %s events" % len(self.events_to_persist))
-                    self._persist_events(self.events_to_persist)
-                    self.events_to_persist = None
+                    self.events_to_persist = self._persist_batches(self.events_to_persist) or None
+                    if self.events_to_persist:
+                        # The datastore is still failing, incoming events wait in the (bounded) queue
+                        self.failure_count += 1
+                        continue
 
                 # process ALL events (not retried on fail like peristing is)
                 events_to_process = [self.event_queue.get() for x in xrange(self.event_queue.qsize())]
@@ -141,17 +202,112 @@ class EventPersister(StandaloneProcess):
                 self.events_to_persist = [x for x in events_to_process if not self._in_blacklist(x)]
 
                 try:
-                    self._persist_events(self.events_to_persist)
+                    self.events_to_persist = self._persist_batches(self.events_to_persist) or None
                 finally:
                     self._process_events(events_to_process)
-                self.events_to_persist = None
-                self.failure_count = 0
+                if self.events_to_persist:
+                    log.warn("Failed to persist %s received events. Will retry next cycle" % len(self.events_to_persist))
+                    self.failure_count += 1
+                else:
+                    self.failure_count = 0
+                    self._replay_spill()
             except Exception as ex:
                 # Note: Persisting events may fail occasionally during test runs (when the "events" datastore is force
                 # deleted and recreated). We'll log and keep retrying forever.
-                log.exception("Failed to persist %s received events. Will retry next cycle" % len(self.events_to_persist))
+                log.exception("Failed to persist %s received events. Will retry next cycle" % len(self.events_to_persist or []))
                 self.failure_count += 1
                 self._log_events(self.events_to_persist)
+            finally:
+                if self.spill is not None:
+                    self.spill.sync()
+                self._export_stats()
+
+    def _persist_batches(self, event_list):
+        """
+        Persists the events in batches of at most max_batch_size, write_concurrency batches at a time.
+        Returns the events of the batches that failed.
+        """
+        if not event_list:
+            return []
+        batches = [event_list[i:i+self.max_batch_size] for i in xrange(0, len(event_list), self.max_batch_size)]
+        failed = [None] * len(batches)
+
+        def write(index):
+            batch = batches[index]
+            start_time = time.time()
+            try:
+                self._persist_events(batch)
+            except Exception:
+                log.exception("Failed to persist a batch of %s events", len(batch))
+                self.counters['failed_batches'] += 1
+                failed[index] = batch
+                return
+            stats.add_value('event_persister.batch_latency', time.time() - start_time)
+            self.counters['persisted'] += len(batch)
+
+        if len(batches) == 1:
+            write(0)
+        else:
+            Pool(self.write_concurrency).map(write, xrange(len(batches)))
+        return [event for batch in failed if batch for event in batch]
+
+    def _replay_spill(self):
+        """
+        Persists events spilled to disk while the queue was full, once the queue has drained
+        """
+        if self.spill is None or not len(self.spill) or self.event_queue.qsize() > self.max_queue_size / 2:
+            return
+        log.info("Replaying %s spilled events", len(self.spill))
+        self.spill.replay(self.max_batch_size, self._persist_replayed)
+
+    def _persist_replayed(self, events):
+        """
+        Persists a batch of replayed events. Returns False to stop the replay and keep the batch in the
+        spill file for the next one.
+        """
+        if self._terminate_persist.is_set():
+            return False
+        events_to_persist = [x for x in events if not self._in_blacklist(x)]
+        failed = self._persist_batches(events_to_persist)
+        if failed:
+            bad_events = self._persist_individually(failed)
+            if len(bad_events) == len(failed):
+                log.warn("Failed to persist %s replayed events, replay stopped until the next cycle", len(failed))
+                return False
+            if bad_events:
+                log.error("Discarding %s replayed events that can't be persisted", len(bad_events))
+                self._log_events(bad_events)
+        self.counters['replayed'] += len(events_to_persist)
+        self._process_events(events)
+        return True
+
+    def _persist_individually(self, event_list):
+        """
+        Persists the events one at a time, events already in the datastore (from a replay that was
+        interrupted before it could record its progress) count as persisted. Returns the events that failed.
+        """
+        bad_events = []
+        for event in event_list:
+            try:
+                self.container.event_repository.put_event(event)
+            except Conflict:
+                pass
+            except Exception:
+                if not self._is_persisted(event):
+                    bad_events.append(event)
+        return bad_events
+
+    def _is_persisted(self, event):
+        event_id = getattr(event, "_id", None)
+        if not event_id:
+            return False
+        try:
+            return self.container.event_repository.get_event(event_id) is not None
+        except NotFound:
+            return False
+        except Exception:
+            log.debug("Cannot check whether event %s is persisted", event_id, exc_info=True)
+            return False
 
     def _persist_events(self, event_list):
         if event_list:
@@ -179,6 +335,102 @@ class EventPersister(StandaloneProcess):
                 log.exception("Failed to refresh events views")
 
 
+class EventSpillFile(object):
+    """
+    Append-only file of msgpack encoded events, used to hold events that don't fit in memory
+    """
+    def __init__(self, directory, name="events.spill"):
+        self.path = os.path.join(directory, name)
+        self.replay_path = self.path + ".replay"
+        self._file = None
+        self._count = 0
+        self.serializer = IonObjectSerializer()
+        self.deserializer = IonObjectDeserializer(obj_registry=get_obj_registry())
+        # Left over from a previous run
+        for path in (self.path, self.replay_path):
+            if os.path.exists(path) and os.path.getsize(path):
+                self._count += self._count_events(path)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, event):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._file = open(self.path, "ab")
+        self._file.write(msgpack.packb(self.serializer.serialize(event)))
+        # Spilled events survive the process going away, sync() also gets them to disk
+        self._file.flush()
+        self._count += 1
+
+    def sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def replay(self, batch_size, persist):
+        """
+        Calls persist with the spilled events in lists of at most batch_size. When persist returns False
+        or raises, the replay stops and that batch and the ones after it are kept for the next replay.
+        The spill file is rotated first, so events spilled during the replay go to a new file.
+        Returns True if every spilled event was replayed.
+        """
+        self.close()
+        if not os.path.exists(self.replay_path):
+            if not os.path.exists(self.path):
+                return True
+            os.rename(self.path, self.replay_path)
+        with open(self.replay_path, "rb") as f:
+            unpacker = msgpack.Unpacker(f)
+            batch = []
+            completed = False
+            try:
+                for obj in unpacker:
+                    batch.append(obj)
+                    if len(batch) >= batch_size:
+                        if not self._replay_batch(batch, persist):
+                            return False
+                        batch = []
+                if batch and not self._replay_batch(batch, persist):
+                    return False
+                completed = True
+            finally:
+                if not completed:
+                    self._keep_remainder(itertools.chain(batch, unpacker))
+        os.remove(self.replay_path)
+        self._count = max(self._count, 0)
+        return True
+
+    def _replay_batch(self, batch, persist):
+        if not persist([self.deserializer.deserialize(obj) for obj in batch]):
+            return False
+        self._count -= len(batch)
+        return True
+
+    def _keep_remainder(self, objs):
+        """
+        Replaces the replay file with the events that were not replayed yet
+        """
+        tmp_path = self.replay_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for obj in objs:
+                f.write(msgpack.packb(obj))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.replay_path)
+
+    def _count_events(self, path):
+        with open(path, "rb") as f:
+            return sum(1 for obj in msgpack.Unpacker(f))
+
+
 class EventProcessor(object):
     """Callback interface for event processors"""
 
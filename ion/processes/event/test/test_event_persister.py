@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/event/test/test_event_persister.py
+@brief Unit tests for the event persister's overflow spill and replay
+'''
+
+from ion.processes.event.event_persister import EventPersister
+
+from pyon.core.exception import Conflict
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.containers import DotDict
+from pyon.public import IonObject, OT
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import os
+import shutil
+import tempfile
+
+
+class EventStore(object):
+    '''
+    Event repository keeping events by origin, failing on duplicates like the datastore does
+    '''
+    def __init__(self):
+        self.events = {}
+        self.down = False
+
+    def put_events(self, events):
+        if self.down:
+            raise IOError('datastore is unavailable')
+        if any(event.origin in self.events for event in events):
+            raise Exception('Bulk create had conflicts')
+        for event in events:
+            self.events[event.origin] = event
+
+    def put_event(self, event):
+        if self.down:
+            raise IOError('datastore is unavailable')
+        if event.origin in self.events:
+            raise Conflict('Object with id %s already exists' % event.origin)
+        self.events[event.origin] = event
+
+    def origins(self):
+        return sorted(self.events, key=int)
+
+
+@attr('UNIT', group='coi')
+class TestEventPersister(PyonTestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spill_dir)
+        plugins = patch('ion.processes.event.event_persister.PROCESS_PLUGINS', [])
+        plugins.start()
+        self.addCleanup(plugins.stop)
+        self.store = EventStore()
+        self.persister = self.start_persister()
+
+    def start_persister(self):
+        persister = EventPersister()
+        persister.CFG = DotDict({'process' : {'event_persister' : {'max_queue_size' : 5, 'max_batch_size' : 3, 'spill_dir' : self.spill_dir}}})
+        persister.on_init()
+        persister.container = Mock()
+        persister.container.event_repository = self.store
+        persister._terminate_persist = Mock()
+        persister._terminate_persist.is_set.return_value = False
+        return persister
+
+    def event(self, i):
+        return IonObject(OT.ResourceEvent, origin=str(i))
+
+    def receive(self, start, count):
+        for i in xrange(start, start + count):
+            self.persister._on_event(self.event(i))
+
+    def cycle(self):
+        # One pass through the persister loop
+        self.persister._terminate_persist.wait.side_effect = [False, True]
+        self.persister._persister_loop(0)
+
+    def spill_files(self):
+        return sorted(os.listdir(self.spill_dir))
+
+    def test_spill_and_replay(self):
+        self.receive(0, 12)
+        self.assertEquals(self.persister.event_queue.qsize(), 5)
+        self.assertEquals(self.persister.counters['spilled'], 7)
+        self.assertEquals(len(self.persister.spill), 7)
+
+        self.cycle()
+        self.assertEquals(self.store.origins(), [str(i) for i in xrange(12)])
+        self.assertEquals(self.persister.counters['replayed'], 7)
+        self.assertEquals(len(self.persister.spill), 0)
+        self.assertEquals(self.spill_files(), [])
+
+    def test_replay_after_restart(self):
+        self.receive(0, 12)
+        # The persister stops after the first replayed batch
+        self.persister._terminate_persist.is_set.side_effect = [False, True]
+        self.cycle()
+        self.assertEquals(len(self.store.events), 8)
+        self.persister.spill.close()
+
+        # The events that weren't replayed are picked up after a restart
+        self.persister = self.start_persister()
+        self.assertEquals(len(self.persister.spill), 4)
+        self.cycle()
+        self.assertEquals(self.store.origins(), [str(i) for i in xrange(12)])
+        self.assertEquals(self.spill_files(), [])
+
+    def test_replay_duplicates(self):
+        self.receive(0, 12)
+        self.persister.spill.close()
+        # A process killed during the replay leaves events that were already persisted in the spill file
+        for i in (5, 6, 9):
+            self.store.put_event(self.event(i))
+
+        self.persister = self.start_persister()
+        self.cycle()
+        self.assertEquals(self.store.origins(), [str(i) for i in xrange(5, 12)])
+        self.assertEquals(self.persister.counters['replayed'], 7)
+        self.assertEquals(len(self.persister.spill), 0)
+        self.assertEquals(self.spill_files(), [])
+
+    def test_replay_failure(self):
+        self.receive(0, 12)
+        self.persister._persist_batches([self.persister.event_queue.get() for i in xrange(5)])
+        self.store.down = True
+        self.persister._replay_spill()
+        # The spilled events are kept, once
+        self.assertEquals(len(self.persister.spill), 7)
+        self.assertEquals(self.persister.counters['replayed'], 0)
+        self.assertEquals(self.spill_files(), ['events.spill.replay'])
+
+        self.store.down = False
+        self.cycle()
+        self.assertEquals(self.store.origins(), [str(i) for i in xrange(12)])
+        self.assertEquals(self.persister.counters['replayed'], 7)
+        self.assertEquals(self.spill_files(), [])
@@ -8,6 +8,7 @@ from ion.core.function.transform_function import TransformFunction
 from ion.processes.data.replay.replay_process import ReplayProcess
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.coverage_cache import CoverageCache
 
 from pyon.core.exception import BadRequest 
 from pyon.container.cc import Container
@@ -15,35 +16,24 @@ from pyon.public import PRED, RT
 from pyon.util.arg_check import validate_is_instance, validate_true
 from pyon.util.containers import for_name
 from pyon.util.log import log
-from pyon.event.event import EventSubscriber
 
 from interface.objects import Replay, CoverageTypeEnum
 from interface.services.dm.idata_retriever_service import BaseDataRetrieverService
 from coverage_model import SimplexCoverage
 
-import collections
-import time
-import gevent
 
 class DataRetrieverService(BaseDataRetrieverService):
     REPLAY_PROCESS = 'replay_process'
 
     _refresh_interval = 10
-    _cache_limit      = 5
-    _retrieve_cache   = collections.OrderedDict()
-    _cache_lock       = gevent.coros.RLock()
 
     def on_start(self):
-        self.event_subscriber = EventSubscriber(event_type='DatasetModified', callback=lambda event,m : self._eject_cache(event.origin), auto_delete=True)
-        self.add_endpoint(self.event_subscriber)
+        # The shared coverage cache ejects read handles on DatasetModified
+        CoverageCache.get_instance(self.container)
 
     @classmethod
     def _eject_cache(cls, dataset_id):
-        with cls._cache_lock:
-            try:
-                cls._retrieve_cache.pop(dataset_id)
-            except KeyError:
-                pass
+        CoverageCache.get_instance().eject(dataset_id, mode='r')
     
     def define_replay(self, dataset_id='', query=None, delivery_format='', stream_id=''):
         ''' Define the stream that will contain the data from data store by streaming to an exchange name.
@@ -123,46 +113,32 @@ class DataRetrieverService(BaseDataRetrieverService):
     @classmethod
     def _get_coverage(cls,dataset_id):
         '''
-        Memoized coverage instantiation and management
+        Memoized coverage instantiation and management, the handle is held
+        until the context exits
         '''
-        # Cached get
-        retval = None
-        with cls._cache_lock:
-            try:
-                retval, age = cls._retrieve_cache.pop(dataset_id)
-                if (time.time() - age) > cls._refresh_interval:
-                    raise KeyError(dataset_id)
-            except KeyError: # Cache miss
-                #@TODO: Add in LRU logic (maybe some mem checking too!)
-                if len(cls._retrieve_cache) > cls._cache_limit:
-                    cls._retrieve_cache.popitem(0)
-                retval = DatasetManagementService._get_nonview_coverage(dataset_id, mode='r') 
-            age = time.time()
-            cls._retrieve_cache[dataset_id] = (retval, age)
-        return retval
+        return CoverageCache.get_instance().hold(dataset_id, mode='r', loader='nonview', max_age=cls._refresh_interval)
 
     @classmethod
     def retrieve_oob(cls, dataset_id='', query=None, delivery_format=''):
         query = query or {}
-        coverage = None
         try:
-            coverage = cls._get_coverage(dataset_id)
-            if coverage is None:
-                raise BadRequest('no such coverage')
-            if isinstance(coverage, SimplexCoverage) and coverage.is_empty():
-                log.info('Reading from an empty coverage')
-                rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
-            else:
-                args = {
-                    'start_time'     : query.get('start_time', None),
-                    'end_time'       : query.get('end_time', None),
-                    'stride_time'    : query.get('stride_time', None),
-                    'parameters'     : query.get('parameters', None),
-                    'stream_def_id'  : delivery_format,
-                    'tdoa'           : query.get('tdoa', None),
-                    'sort_parameter' : query.get('sort_parameter', None)
-                }
-                rdt = ReplayProcess._cov2granule(coverage=coverage, **args)
+            with cls._get_coverage(dataset_id) as coverage:
+                if coverage is None:
+                    raise BadRequest('no such coverage')
+                if isinstance(coverage, SimplexCoverage) and coverage.is_empty():
+                    log.info('Reading from an empty coverage')
+                    rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
+                else:
+                    args = {
+                        'start_time'     : query.get('start_time', None),
+                        'end_time'       : query.get('end_time', None),
+                        'stride_time'    : query.get('stride_time', None),
+                        'parameters'     : query.get('parameters', None),
+                        'stream_def_id'  : delivery_format,
+                        'tdoa'           : query.get('tdoa', None),
+                        'sort_parameter' : query.get('sort_parameter', None)
+                    }
+                    rdt = ReplayProcess._cov2granule(coverage=coverage, dataset_id=dataset_id, **args)
         except Exception as e:
             cls._eject_cache(dataset_id)
             data_products, _ = Container.instance.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct)
@@ -5,7 +5,9 @@
 __author__ = 'Luke Campbell <LCampbell@ASAScience.com>, Michael Meisinger'
 
 from collections import deque
-import heapq
+from gevent.pool import Pool
+import copy
+import time
 
 from pyon.datastore.datastore_query import QUERY_EXP_KEY, DQ
 from pyon.public import PRED, CFG, RT, log, BadRequest, EventPublisher, get_sys_name, NotFound
@@ -20,6 +22,8 @@ from interface.objects import View, Catalog
 
 class DiscoveryService(BaseDiscoveryService):
     MAX_SEARCH_RESULTS = CFG.get_safe('service.discovery.max_search_results', 250)
+    VIEW_CACHE_TTL     = CFG.get_safe('service.discovery.view_cache_ttl', 60)
+    POOL_SIZE          = CFG.get_safe('service.discovery.pool_size', 8)
 
     def on_start(self):
         super(DiscoveryService, self).on_start()
@@ -29,6 +33,7 @@ class DiscoveryService(BaseDiscoveryService):
             raise Exception("Discovery service does not support datastores other than postgresql")
 
         self.ds_discovery = DatastoreDiscovery(self)
+        self._view_cache = {} # (view_id, view_name) -> (view, time read)
 
    
     #===================================================================
@@ -80,19 +85,12 @@ class DiscoveryService(BaseDiscoveryService):
             raise BadRequest("Must provide argument view_id or view_name")
         if view_id and view_name:
             raise BadRequest("Cannot provide both arguments view_id and view_name")
-        if view_id:
-            view_obj = self.clients.resource_registry.read(view_id)
-        else:
-            view_obj = self.ds_discovery.get_builtin_view(view_name)
-            if not view_obj:
-                view_objs, _ = self.clients.resource_registry.find_resources(restype=RT.View, name=view_name)
-                if not view_objs:
-                    raise NotFound("View with name '%s' not found" % view_name)
-                view_obj = view_objs[0]
+        view_obj = self._get_view(view_id, view_name)
 
         if view_obj.type_ != RT.View:
             raise BadRequest("Argument view_id is not a View resource")
-        view_query = view_obj.view_definition
+        # The view is cached, the query is merged and annotated on a copy
+        view_query = copy.deepcopy(view_obj.view_definition)
         if not QUERY_EXP_KEY in view_query:
             raise BadRequest("Unknown View query format")
 
@@ -112,7 +110,7 @@ class DiscoveryService(BaseDiscoveryService):
                 view_query["where"] = view_query["where"] or ext_query["where"]
             if ext_query["order_by"]:
                 # Override ordering if present
-                view_query["where"] = ext_query["order_by"]
+                view_query["order_by"] = ext_query["order_by"]
 
             # Other query settings
             view_qargs = view_query["query_args"]
@@ -124,6 +122,26 @@ class DiscoveryService(BaseDiscoveryService):
         return self._discovery_request(view_query, id_only=id_only,
                                        search_args=search_args, query_params=query_params)
 
+    def _get_view(self, view_id='', view_name=''):
+        """Returns the View by id or name. Views are cached for VIEW_CACHE_TTL seconds, the
+        cache is cleared when views are created, updated or deleted through this service."""
+        key = (view_id, view_name)
+        view_obj, read_at = self._view_cache.get(key, (None, 0))
+        if view_obj is not None and time.time() - read_at <= self.VIEW_CACHE_TTL:
+            return view_obj
+
+        if view_id:
+            view_obj = self.clients.resource_registry.read(view_id)
+        else:
+            view_obj = self.ds_discovery.get_builtin_view(view_name)
+            if not view_obj:
+                view_objs, _ = self.clients.resource_registry.find_resources(restype=RT.View, name=view_name)
+                if not view_objs:
+                    raise NotFound("View with name '%s' not found" % view_name)
+                view_obj = view_objs[0]
+        self._view_cache[key] = view_obj, time.time()
+        return view_obj
+
     def _discovery_request(self, query=None, id_only=True, search_args=None, query_params=None):
         search_args = search_args or {}
         if not query:
@@ -170,7 +188,15 @@ class DiscoveryService(BaseDiscoveryService):
             raise BadRequest("Illegal argument type: attribute_filter")
 
         if not id_only and attr_filter:
-            filtered_res = [dict(__noion__=True, **{k: v for k, v in obj.__dict__.iteritems() if k in attr_filter or k in {"_id", "type_"}}) for obj in query_results]
+            # Only the kept attributes are looked up rather than every attribute of every object
+            keep = set(attr_filter)
+            keep.update(("_id", "type_"))
+            filtered_res = []
+            for obj in query_results:
+                attrs = obj.__dict__
+                filtered = {k: attrs[k] for k in keep if k in attrs}
+                filtered["__noion__"] = True
+                filtered_res.append(filtered)
             return filtered_res
         return query_results
 
@@ -188,6 +214,7 @@ class DiscoveryService(BaseDiscoveryService):
         #     raise BadRequest("View with name '%s' already exists" % view.name)
 
         view_id, _ = self.clients.resource_registry.create(view)
+        self._view_cache.clear() # A view found by name may be shadowed
         return view_id
 
     def read_view(self, view_id=''):
@@ -200,10 +227,12 @@ class DiscoveryService(BaseDiscoveryService):
         if view is None or not isinstance(view, View):
             raise BadRequest("Illegal argument: view")
         self.clients.resource_registry.update(view)
+        self._view_cache.clear()
         return True
 
     def delete_view(self, view_id=''):
         self.clients.resource_registry.delete(view_id)
+        self._view_cache.clear()
         return True
 
 
@@ -233,18 +262,17 @@ class DiscoveryService(BaseDiscoveryService):
 
         fields = set(fields) # Convert fields to a set for aggregation across the catalogs
         #======================================================================================================
-        # Priorty Queue Index Matching
+        # Index Matching, the matching catalog with the fewest indexes is used
         #======================================================================================================
 
-        pq = [] # Priority queue for matching
         catalog_id = None
         catalogs, _ = self.clients.resource_registry.find_resources(restype=RT.Catalog, id_only=False)
-        for catalog in catalogs:
-            if set(catalog.catalog_fields).issubset(fields):
-                index_num = len(self.clients.catalog_management.list_indexes(catalog._id))
-                heapq.heappush(pq, (index_num,catalog))
-        if pq:
-            weight, catalog = heapq.heappop(pq)
+        catalogs = [catalog for catalog in catalogs if set(catalog.catalog_fields).issubset(fields)]
+        if catalogs:
+            # The index listings are independent requests, they're made concurrently
+            pool = Pool(self.POOL_SIZE)
+            index_nums = pool.map(lambda catalog: len(self.clients.catalog_management.list_indexes(catalog._id)), catalogs)
+            weight, catalog = min(zip(index_nums, catalogs), key=lambda entry: entry[0])
             if weight < 4:
                 catalog_id = catalog._id
 
@@ -5,8 +5,11 @@
 __author__ = 'Michael Meisinger'
 
 import calendar
+import collections
+import copy
 import dateutil
 import dateutil.parser
+import json
 import pprint
 
 from pyon.datastore.datastore import DataStore
@@ -43,10 +46,15 @@ COL_MAP = {"_all": DQ.RA_NAME,
 
 
 class DatastoreDiscovery(object):
+    MAX_CACHED_QUERIES = CFG.get_safe('service.discovery.max_cached_queries', 256)
+
     def __init__(self, process):
         self.process = process
         self.container = self.process.container
 
+        # Built datastore queries, (discovery query, id_only) -> (ds_query, ds_name)
+        self._query_cache = collections.OrderedDict()
+
         # Query matchers
         self._qmatchers = [self._qmatcher_andor,
                            self._qmatcher_allmatch,
@@ -63,7 +71,7 @@ class DatastoreDiscovery(object):
                 ds_query, ds_name = discovery_query, discovery_query["query_args"].get("datastore", DataStore.DS_RESOURCES)
             else:
                 log.info("DatastoreDiscovery.execute_query(): discovery_query=\n%s", pprint.pformat(discovery_query))
-                ds_query, ds_name = self._build_ds_query(discovery_query, id_only=id_only)
+                ds_query, ds_name = self._get_ds_query(discovery_query, id_only=id_only)
 
             current_actor_id=get_ion_actor_id(self.process)
             ds_query.setdefault("query_params", {})
@@ -90,6 +98,23 @@ class DatastoreDiscovery(object):
         return []
 
 
+    def _get_ds_query(self, discovery_query, id_only=True):
+        """Returns the datastore query for a discovery query, building it once for each distinct
+        query. Callers get their own copy since queries are annotated when they are executed."""
+        try:
+            key = (json.dumps(discovery_query, sort_keys=True), id_only)
+        except (TypeError, ValueError):
+            return self._build_ds_query(discovery_query, id_only=id_only)
+
+        if key in self._query_cache:
+            ds_query, ds_name = self._query_cache.pop(key)
+        else:
+            ds_query, ds_name = self._build_ds_query(discovery_query, id_only=id_only)
+            while len(self._query_cache) >= self.MAX_CACHED_QUERIES:
+                self._query_cache.popitem(last=False)
+        self._query_cache[key] = ds_query, ds_name
+        return copy.deepcopy(ds_query), ds_name
+
     def _build_ds_query(self, discovery_query, id_only=True):
         query_exp = discovery_query["query"] or {}
         index = query_exp.get("index", "resources_index")
@@ -175,6 +175,50 @@ class DiscoveryUnitTest(IonUnitTestCase):
         retval = self.discovery._discovery_request(query)
         self.assertEquals(retval, ["FOO"])
 
+    def test_query_cache(self):
+        self.ds_mock.find_by_query = Mock(return_value=["FOO"])
+        ds_discovery = self.discovery.ds_discovery
+        ds_discovery._build_ds_query = Mock(side_effect=ds_discovery._build_ds_query)
+
+        query = {'query':{'field': 'name', 'value': 'foo'}, 'and':[{'field': 'lcstate', 'value': 'foo2'}]}
+        self.assertEquals(self.discovery._discovery_request(query), ["FOO"])
+        self.assertEquals(self.discovery._discovery_request(query), ["FOO"])
+        self.assertEquals(ds_discovery._build_ds_query.call_count, 1)
+
+        # Each execution gets its own copy of the query
+        first, second = [call[0][0] for call in self.ds_mock.find_by_query.call_args_list]
+        self.assertEquals(first, second)
+        self.assertIsNot(first, second)
+
+        self.discovery._discovery_request(query, id_only=False)
+        self.assertEquals(ds_discovery._build_ds_query.call_count, 2)
+
+    def test_query_view_cache(self):
+        self.ds_mock.find_by_query = Mock(return_value=["FOO"])
+        view_obj = View(name='fake_view', view_definition=ResourceQuery().get_query())
+        self.rr_read.return_value = view_obj
+
+        ext_query = ResourceQuery()
+        ext_query.set_filter(ext_query.filter_type(RT.DataProduct))
+        self.assertEquals(self.discovery.query_view(view_id='view_id', ext_query=ext_query.get_query()), ["FOO"])
+        self.assertEquals(self.discovery.query_view(view_id='view_id'), ["FOO"])
+        self.assertEquals(self.rr_read.call_count, 1)
+        # The extended query isn't merged into the cached view
+        self.assertEquals(view_obj.view_definition, ResourceQuery().get_query())
+
+        self.discovery.update_view(view_obj)
+        self.discovery.query_view(view_id='view_id')
+        self.assertEquals(self.rr_read.call_count, 2)
+
+    def test_attribute_filter(self):
+        devices = [InstrumentDevice(name='sonobuoy%s' % i, firmware_version='A%s' % i) for i in xrange(3)]
+        for i, device in enumerate(devices):
+            device._id = 'device%s' % i
+
+        result = self.discovery._strip_query_results(devices, id_only=False, search_args=dict(attribute_filter=['firmware_version', 'unknown']))
+        self.assertEquals(result[1], {'__noion__': True, '_id': 'device1', 'type_': 'InstrumentDevice', 'firmware_version': 'A1'})
+        self.assertIs(self.discovery._strip_query_results(devices, id_only=True, search_args=dict(attribute_filter=['name'])), devices)
+
 
 @attr('INT', group='dm')
 class DiscoveryQueryTest(IonIntegrationTestCase):
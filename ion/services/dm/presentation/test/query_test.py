@@ -11,6 +11,7 @@ from pyon.util.containers import DotDict
 from pyon.core.exception import BadRequest
 from pyon.util.unit_test import PyonTestCase
 from nose.plugins.attrib import attr
+from mock import patch
 from ion.services.dm.presentation.discovery_service import QueryLanguage
 
 
@@ -196,3 +197,61 @@ class QueryLanguageUnitTest(PyonTestCase):
         test_string = "search 'geospatial_bounds' vertical from 0.5 to 10.2 from 'index'"
         retval = self.parser.parse(test_string)
         self.assertEquals(retval, {'and':[], 'or':[], 'query':{'field':'geospatial_bounds', 'vertical_bounds':{'from':0.5, 'to':10.2}, 'index':'index'}})
+
+    def test_compiled_match(self):
+        event = DotDict(origin='abc123', value=5, ts_created='1325462400000', location={'lat':10.0, 'lon':20.0}, depth=[2.0, 8.0])
+        event.instrument = DotDict(model='SBE37')
+
+        def match(test_string):
+            return QueryLanguage.compile_query(self.parser.parse(test_string)['query'])(event)
+
+        self.assertTrue(match("search 'origin' is 'abc123' from 'index'"))
+        self.assertTrue(match("search 'origin' is 'AB*' from 'index'"))
+        self.assertFalse(match("search 'origin' is 'x*' from 'index'"))
+        self.assertTrue(match("search 'instrument.model' is 'SBE37' from 'index'"))
+        self.assertFalse(match("search 'instrument.family' is 'SBE37' from 'index'"))
+        self.assertTrue(match("search 'value' values from 1 to 5 from 'index'"))
+        self.assertFalse(match("search 'value' values from 6 from 'index'"))
+        self.assertTrue(match("search 'ts_created' timebounds from '2012-01-01' to '2012-01-03' from 'index'"))
+        self.assertFalse(match("search 'ts_created' time from '2012-01-03' from 'index'"))
+        self.assertTrue(match("search 'depth' vertical from 7 to 10 from 'index'"))
+        self.assertFalse(match("search 'value' vertical from 7 to 10 from 'index'"))
+
+        self.assertTrue(match("search 'location' geo box top-left lat 40 lon 0 bottom-right lat 0 lon 40 from 'index'"))
+        self.assertFalse(match("search 'location' geo box top-left lat 40 lon 30 bottom-right lat 0 lon 40 from 'index'"))
+        # A degree of latitude is about 111.2 km
+        self.assertTrue(match("search 'location' geo distance 112 km from lat 11 lon 20 from 'index'"))
+        self.assertFalse(match("search 'location' geo distance 110 km from lat 11 lon 20 from 'index'"))
+        self.assertTrue(match("search 'location' geo distance 70 mi from lat 11 lon 20 from 'index'"))
+
+        with self.assertRaises(BadRequest):
+            QueryLanguage.compile_query(self.parser.parse("belongs to 'rsn'")['query'])
+
+    def test_evaluate_condition(self):
+        event = DotDict(origin='abc123', value=5)
+
+        query_dict = self.parser.parse("search 'origin' is 'zzz' from 'index' or search 'value' values from 5 to 5 from 'index'")
+        self.assertTrue(QueryLanguage.evaluate_condition(event, query_dict))
+
+        query_dict = self.parser.parse("search 'origin' is 'abc123' from 'index' and search 'value' values from 6 to 9 from 'index'")
+        self.assertFalse(QueryLanguage.evaluate_condition(event, query_dict))
+
+        # A compiled condition gives the same results
+        condition = QueryLanguage.compile_condition(query_dict)
+        self.assertFalse(QueryLanguage.evaluate_condition(event, condition))
+        event.value = 7
+        self.assertTrue(QueryLanguage.evaluate_condition(event, condition))
+
+    def test_evaluate_condition_cached(self):
+        event = DotDict(origin='abc123', value=5)
+        QueryLanguage._conditions.clear()
+        with patch.object(QueryLanguage, 'compile_condition', wraps=QueryLanguage.compile_condition) as compile_condition:
+            query = "search 'ts_created' time from '2012-01-01' to '2012-01-03' from 'index' or search 'value' values from 5 to 5 from 'index'"
+            self.assertTrue(QueryLanguage.evaluate_condition(event, self.parser.parse(query)))
+            self.assertTrue(QueryLanguage.evaluate_condition(event, self.parser.parse(query)))
+            self.assertEquals(compile_condition.call_count, 1)
+
+            # Another dict is compiled for itself
+            query = "search 'value' values from 6 to 9 from 'index'"
+            self.assertFalse(QueryLanguage.evaluate_condition(event, self.parser.parse(query)))
+            self.assertEquals(compile_condition.call_count, 2)
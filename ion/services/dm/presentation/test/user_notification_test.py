@@ -603,17 +603,17 @@ class UserNotificationIntTest(IonIntegrationTestCase):
         self.assertEquals(proc1.user_info[user_id_2]['user_contact'].email, 'user_2@gmail.com' )
         self.assertEquals(proc1.user_info[user_id_2]['notifications'], [notification_request_2_chk])
 
-        self.assertEquals(proc1.reverse_user_info['event_origin']['instrument_1'], [user_id_1])
-        self.assertEquals(proc1.reverse_user_info['event_origin']['instrument_2'], [user_id_2])
+        self.assertEquals(proc1.reverse_user_info['event_origin']['instrument_1'], frozenset([user_id_1]))
+        self.assertEquals(proc1.reverse_user_info['event_origin']['instrument_2'], frozenset([user_id_2]))
 
-        self.assertEquals(proc1.reverse_user_info['event_type']['ResourceLifecycleEvent'], [user_id_1])
-        self.assertEquals(proc1.reverse_user_info['event_type']['DetectionEvent'], [user_id_2])
+        self.assertEquals(proc1.reverse_user_info['event_type']['ResourceLifecycleEvent'], frozenset([user_id_1]))
+        self.assertEquals(proc1.reverse_user_info['event_type']['DetectionEvent'], frozenset([user_id_2]))
 
-        self.assertEquals(proc1.reverse_user_info['event_subtype']['subtype_1'], [user_id_1])
-        self.assertEquals(proc1.reverse_user_info['event_subtype']['subtype_2'], [user_id_2])
+        self.assertEquals(proc1.reverse_user_info['event_subtype']['subtype_1'], frozenset([user_id_1]))
+        self.assertEquals(proc1.reverse_user_info['event_subtype']['subtype_2'], frozenset([user_id_2]))
 
-        self.assertEquals(proc1.reverse_user_info['event_origin_type']['type_1'], [user_id_1])
-        self.assertEquals(proc1.reverse_user_info['event_origin_type']['type_2'], [user_id_2])
+        self.assertEquals(proc1.reverse_user_info['event_origin_type']['type_1'], frozenset([user_id_1]))
+        self.assertEquals(proc1.reverse_user_info['event_origin_type']['type_2'], frozenset([user_id_2]))
 
         log.debug("The event processor received the notification topics after a create_notification() for two users")
         log.debug("Verified that the event processor correctly updated its user info dictionaries")
@@ -633,16 +633,16 @@ class UserNotificationIntTest(IonIntegrationTestCase):
         # Check in UNS ------------>
         self.assertEquals(reloaded_user_info[user_id_1]['user_contact'].email, 'user_1@gmail.com' )
 
-        self.assertEquals(reloaded_reverse_user_info['event_origin']['instrument_1'], [user_id_1])
+        self.assertEquals(reloaded_reverse_user_info['event_origin']['instrument_1'], frozenset([user_id_1]))
         self.assertEquals(set(reloaded_reverse_user_info['event_origin']['instrument_2']), set([user_id_2, user_id_1]))
 
-        self.assertEquals(reloaded_reverse_user_info['event_type']['ResourceLifecycleEvent'], [user_id_1])
+        self.assertEquals(reloaded_reverse_user_info['event_type']['ResourceLifecycleEvent'], frozenset([user_id_1]))
         self.assertEquals(set(reloaded_reverse_user_info['event_type']['DetectionEvent']), set([user_id_2, user_id_1]))
 
-        self.assertEquals(reloaded_reverse_user_info['event_subtype']['subtype_1'], [user_id_1])
+        self.assertEquals(reloaded_reverse_user_info['event_subtype']['subtype_1'], frozenset([user_id_1]))
         self.assertEquals(set(reloaded_reverse_user_info['event_subtype']['subtype_2']), set([user_id_2, user_id_1]))
 
-        self.assertEquals(reloaded_reverse_user_info['event_origin_type']['type_1'], [user_id_1])
+        self.assertEquals(reloaded_reverse_user_info['event_origin_type']['type_1'], frozenset([user_id_1]))
         self.assertEquals(set(reloaded_reverse_user_info['event_origin_type']['type_2']), set([user_id_2, user_id_1]))
 
 
@@ -8,7 +8,7 @@ from pyon.public import RT, PRED, get_sys_name, OT, IonObject, get_ion_ts, log,
 from pyon.core.governance import ORG_MEMBER_ROLE, ORG_MANAGER_ROLE, INSTRUMENT_OPERATOR, DATA_OPERATOR, OBSERVATORY_OPERATOR, GovernanceHeaderValues, has_org_role
 
 from ion.services.dm.utility.uns_utility_methods import setting_up_smtp_client, convert_events_to_email_message, \
-    get_event_computed_attributes, calculate_reverse_user_info
+    get_event_computed_attributes, update_reverse_user_info
 from ion.util.datastore.resources import ResourceRegistryUtil
 
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
@@ -88,12 +88,16 @@ class UserNotificationService(BaseUserNotificationService):
             notification_id =  event_msg.notification_id
             log.debug("(UNS instance) received a ReloadNotificationEvent. The relevant notification_id is %s" % notification_id)
 
+            old_user_info = self.user_info
             try:
                 self.user_info = self.load_user_info()
             except NotFound:
                 log.warning("ElasticSearch has not yet loaded the user_index.")
 
-            self.reverse_user_info =  calculate_reverse_user_info(self.user_info)
+            # only the entries of users whose notifications changed are recomputed
+            changed_user_ids = [user_id for user_id in set(old_user_info) | set(self.user_info)
+                                if old_user_info.get(user_id) != self.user_info.get(user_id)]
+            self.reverse_user_info = update_reverse_user_info(self.reverse_user_info, self.user_info, changed_user_ids)
 
             log.debug("(UNS instance) After a reload, the user_info: %s" % self.user_info)
             log.debug("(UNS instance) The recalculated reverse_user_info: %s" % self.reverse_user_info)
@@ -733,7 +737,8 @@ class UserNotificationService(BaseUserNotificationService):
         if event_id in self.event_id_to_nr_map:
             self.event_id_to_nr_map[event_id].extend(nr_obj_list)
         else:
-            self.event_id_to_nr_map[event_id]= nr_obj_list
+            # copied, extending the list must not grow the reference maps it came from
+            self.event_id_to_nr_map[event_id] = list(nr_obj_list)
 
 
 
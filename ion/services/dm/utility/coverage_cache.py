@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/coverage_cache.py
+@description Container level cache of open coverage handles shared by
+ingestion, retrieval and replay
+'''
+
+from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+
+from pyon.container.cc import Container
+from pyon.ion.event import EventSubscriber
+from pyon.public import log, CFG, OT
+
+from gevent.coros import RLock
+
+from contextlib import contextmanager
+
+import collections
+import os
+import time
+
+
+class CoverageCache(object):
+    '''
+    An LRU cache of open coverage instances keyed by dataset, mode and loader.
+
+    The cache is bounded both by the number of handles and by an estimate of
+    the memory each handle holds (the size of the coverage's master files).
+    Read handles are ejected whenever the dataset is modified so readers see
+    new data, append handles are left alone since they belong to the writer.
+
+    Handles are owned by the cache, callers must not close them. Each get()
+    must be paired with a release() (or use hold()), handles that leave the
+    cache while in use are closed when their last user releases them.
+    '''
+    MAX_HANDLES   = CFG.get_safe('container.coverage_cache.max_handles', 32)
+    MAX_BYTES     = CFG.get_safe('container.coverage_cache.max_bytes', 256 * 1024 * 1024)
+    HANDLE_SIZE   = 64 * 1024 # Base cost of a coverage handle in bytes
+    _instance     = None      # Used when there is no container
+
+    loaders = {
+        'coverage' : DatasetManagementService._get_coverage,
+        'nonview'  : DatasetManagementService._get_nonview_coverage,
+        'simplex'  : DatasetManagementService._get_simplex_coverage,
+    }
+
+    def __init__(self, max_handles=None, max_bytes=None):
+        self.max_handles = max_handles or self.MAX_HANDLES
+        self.max_bytes   = max_bytes or self.MAX_BYTES
+        # (dataset_id, mode, loader) -> (coverage, size, opened)
+        self._cache      = collections.OrderedDict()
+        self._lock       = RLock()
+        self._size       = 0
+        # id(coverage) -> number of users holding the handle
+        self._users      = {}
+        # id(coverage) -> (key, coverage) for handles that left the cache while in use
+        self._retired    = {}
+        self._event_subscriber = None
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.ejections = 0
+
+    @classmethod
+    def get_instance(cls, container=None):
+        '''
+        Returns the coverage cache for the container, creating it (and the
+        DatasetModified subscriber that keeps it fresh) on first use.
+        '''
+        container = container or Container.instance
+        if container is None:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+        cache = getattr(container, 'coverage_cache', None)
+        if cache is None:
+            cache = cls()
+            container.coverage_cache = cache
+            cache.start_event_monitor()
+        return cache
+
+    def start_event_monitor(self):
+        if self._event_subscriber is not None:
+            return
+        try:
+            self._event_subscriber = EventSubscriber(event_type=OT.DatasetModified, callback=self._on_dataset_modified, auto_delete=True)
+            self._event_subscriber.start()
+        except Exception:
+            log.exception('Coverage cache could not subscribe to DatasetModified events')
+            self._event_subscriber = None
+
+    def stop_event_monitor(self):
+        if self._event_subscriber is not None:
+            self._event_subscriber.stop()
+            self._event_subscriber = None
+
+    def _on_dataset_modified(self, event, *args, **kwargs):
+        self.eject(event.origin, mode='r')
+
+    #--------------------------------------------------------------------------------
+    # Cache access
+    #--------------------------------------------------------------------------------
+
+    def get(self, dataset_id, mode='r', loader='coverage', max_age=None):
+        '''
+        Returns an open coverage for the dataset, opening one on a miss. The
+        caller holds the handle until it calls release(coverage).
+        @param dataset_id Dataset identifier
+        @param mode       Coverage mode ('r', 'a', 'r+', ...)
+        @param loader     One of 'coverage', 'nonview' or 'simplex'
+        @param max_age    Reopen the handle if it was opened more than max_age seconds ago
+        '''
+        key = (dataset_id, mode, loader)
+        with self._lock:
+            try:
+                coverage, size, opened = self._cache.pop(key)
+                if max_age is not None and (time.time() - opened) > max_age:
+                    # Stale handle, closed once its readers release it
+                    self._size -= size
+                    self._drop(key, coverage)
+                    raise KeyError(key)
+                self.hits += 1
+            except KeyError:
+                self.misses += 1
+                coverage = self.loaders[loader](dataset_id, mode=mode)
+                if coverage is None:
+                    return None
+                size = self.estimate_size(coverage)
+                opened = time.time()
+                self._size += size
+            self._cache[key] = (coverage, size, opened)
+            self._users[id(coverage)] = self._users.get(id(coverage), 0) + 1
+            self._evict()
+        return coverage
+
+    def release(self, coverage):
+        '''
+        Releases a handle returned by get(). The last release of a handle
+        that is no longer cached closes it.
+        '''
+        with self._lock:
+            handle = id(coverage)
+            users = self._users.get(handle, 0) - 1
+            if users > 0:
+                self._users[handle] = users
+                return
+            self._users.pop(handle, None)
+            retired = self._retired.pop(handle, None)
+            if retired is not None:
+                self._close(retired[0], coverage)
+
+    def retain(self, coverage):
+        '''
+        Adds a user to a handle the caller already holds, for work that
+        outlives the caller's hold (e.g. a response read lazily). Each
+        retain() must be paired with a release().
+        '''
+        with self._lock:
+            handle = id(coverage)
+            if not self._users.get(handle):
+                raise ValueError('The coverage is not held')
+            self._users[handle] += 1
+        return coverage
+
+    @contextmanager
+    def hold(self, dataset_id, mode='r', loader='coverage', max_age=None):
+        '''
+        Context manager that gets a handle and releases it on exit.
+        '''
+        coverage = self.get(dataset_id, mode=mode, loader=loader, max_age=max_age)
+        try:
+            yield coverage
+        finally:
+            if coverage is not None:
+                self.release(coverage)
+
+    def eject(self, dataset_id, mode=None):
+        '''
+        Removes the handles for a dataset, optionally only those for one mode.
+        Handles nobody holds are closed right away (append handles are
+        flushed), the others when their last user releases them.
+        '''
+        with self._lock:
+            for key in self._cache.keys():
+                if key[0] != dataset_id or (mode is not None and key[1] != mode):
+                    continue
+                coverage, size, opened = self._cache.pop(key)
+                self._size -= size
+                self.ejections += 1
+                self._drop(key, coverage)
+
+    def clear(self):
+        with self._lock:
+            while self._cache:
+                key, (coverage, size, opened) = self._cache.popitem(0)
+                self._drop(key, coverage)
+            self._size = 0
+
+    def _evict(self):
+        '''
+        Drops the least recently used handles until the cache is within budget,
+        the most recently used handle is always kept.
+        '''
+        while len(self._cache) > 1 and (len(self._cache) > self.max_handles or self._size > self.max_bytes):
+            key, (coverage, size, opened) = self._cache.popitem(0)
+            self._size -= size
+            self.evictions += 1
+            self._drop(key, coverage)
+
+    def _drop(self, key, coverage):
+        '''
+        Closes a handle that left the cache, or defers it to the last release
+        if it is still in use.
+        '''
+        if self._users.get(id(coverage)):
+            self._retired[id(coverage)] = (key, coverage)
+        else:
+            self._close(key, coverage)
+
+    def _close(self, key, coverage):
+        try:
+            coverage.close(timeout=5)
+        except Exception:
+            log.exception('Problems closing the coverage for %s', key[0])
+
+    @classmethod
+    def estimate_size(cls, coverage):
+        '''
+        Rough estimate of the memory held by an open coverage, the master
+        files are loaded into memory when a coverage is opened.
+        '''
+        size = cls.HANDLE_SIZE
+        persistence_dir = getattr(coverage, 'persistence_dir', None)
+        if not persistence_dir or not os.path.isdir(persistence_dir):
+            return size
+        try:
+            for entry in os.listdir(persistence_dir):
+                path = os.path.join(persistence_dir, entry)
+                if os.path.isfile(path):
+                    size += os.path.getsize(path)
+        except OSError:
+            pass
+        return size
+
+    #--------------------------------------------------------------------------------
+    # Metrics
+    #--------------------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def size(self):
+        return self._size
+
+    def stats(self):
+        return {
+            'handles'   : len(self._cache),
+            'retired'   : len(self._retired),
+            'bytes'     : self._size,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+            'ejections' : self.ejections,
+        }
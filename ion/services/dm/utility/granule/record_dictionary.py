@@ -10,8 +10,9 @@
 
 from pyon.container.cc import Container
 from pyon.core.exception import BadRequest, NotFound
-from pyon.core.object import IonObjectSerializer
-from pyon.core.interceptor.encode import encode_ion
+from pyon.core.bootstrap import get_obj_registry
+from pyon.core.object import IonObjectSerializer, IonObjectDeserializer
+from pyon.core.interceptor.encode import encode_ion, decode_ion
 from pyon.util.arg_check import validate_equal
 from pyon.util.log import log
 from pyon.util.memoize import memoize_lru
@@ -29,10 +30,105 @@ from coverage_model import PythonFunction, NumexprFunction
 
 import numpy as np
 import numexpr as ne
+from numexpr.necompiler import getExprNames, getType
 from copy import copy
+import collections
 import msgpack
+import struct
 import time
 
+
+class RecordDictionaryLayout(object):
+    '''
+    The layout of the fields of a parameter dictionary, computed once and
+    shared by every record dictionary of the same stream definition: the
+    sorted name <-> ordinal table used in granules, the dtype and fill value
+    of each field and the dependency graph of the parameter functions along
+    with their imported callables and compiled numexpr expressions.
+    '''
+    def __init__(self, pdict):
+        self.names    = sorted(pdict.keys())
+        self.ordinals = dict((name, i) for i, name in enumerate(self.names))
+        self.dtypes      = {}
+        self.fill_values = {}
+        # parameter function -> fields it is computed from
+        self.inputs      = {}
+        # fields whose None values are replaced by the fill value
+        self.quantities  = set()
+        for name in self.names:
+            context = pdict.get_context(name)
+            self.fill_values[name] = context.fill_value
+            if isinstance(context.param_type, QuantityType):
+                self.quantities.add(name)
+            try:
+                self.dtypes[name] = np.dtype(context.param_type.value_encoding)
+            except (AttributeError, TypeError):
+                self.dtypes[name] = None
+            if isinstance(context.param_type, ParameterFunctionType):
+                param_map = getattr(context.param_type.function, 'param_map', None) or {}
+                self.inputs[name] = set([v for v in param_map.itervalues() if isinstance(v, basestring)])
+
+        self._dependents  = {}
+        self._callables   = {}
+        self._expressions = {}
+        self._expr_names  = {}
+
+    def to_ordinal(self, key):
+        return self.ordinals[key]
+
+    def from_ordinal(self, ordinal):
+        return self.names[ordinal]
+
+    def dependents(self, name):
+        '''
+        Returns the parameter functions computed directly or indirectly from name
+        '''
+        if name not in self._dependents:
+            dependents = set()
+            pending = [name]
+            while pending:
+                field = pending.pop()
+                for func, inputs in self.inputs.iteritems():
+                    if field in inputs and func not in dependents:
+                        dependents.add(func)
+                        pending.append(func)
+            self._dependents[name] = frozenset(dependents)
+        return self._dependents[name]
+
+    def get_callable(self, name, function):
+        '''
+        Returns the callable of a PythonFunction, imported once per layout
+        '''
+        if name not in self._callables:
+            if not hasattr(function, '_callable'):
+                function._import_func()
+            self._callables[name] = function._callable
+        return self._callables[name]
+
+    def evaluate(self, expression, local_dict):
+        '''
+        Evaluates a numexpr expression, the compiled expression is kept for
+        each combination of argument types
+        '''
+        try:
+            names = self._expr_names.get(expression)
+            if names is None:
+                names = getExprNames(expression, {})
+                if isinstance(names, tuple): # numexpr 2 also returns whether VML is used
+                    names = names[0]
+                self._expr_names[expression] = names
+            args = [np.asarray(local_dict[n]) for n in names]
+            key = (expression, tuple([a.dtype.str for a in args]))
+            compiled = self._expressions.get(key)
+            if compiled is None:
+                compiled = ne.NumExpr(expression, [(n, getType(a)) for n, a in zip(names, args)])
+                self._expressions[key] = compiled
+        except Exception:
+            # Let numexpr report whatever is wrong with the expression
+            return ne.evaluate(expression, local_dict=local_dict)
+        return compiled(*args)
+
+
 class RecordDictionaryTool(object):
     """
     A record dictionary is a key/value store which contains records for a particular dataset. The keys are specified by
@@ -61,9 +157,14 @@ class RecordDictionaryTool(object):
     _creation_timestamp = None
     _stream_config      = {}
     _definition         = None
+    _layout             = None
     connection_id       = ''
     connection_index    = ''
 
+    # Layouts by stream definition id, stream definitions don't change once created
+    _layouts            = collections.OrderedDict()
+    MAX_LAYOUTS         = 256
+
 
     def __init__(self,param_dictionary=None, stream_definition_id='', locator=None, stream_definition=None):
         """
@@ -95,6 +196,7 @@ class RecordDictionaryTool(object):
         
         self._shp = None
         self._rd = {}
+        self._pf_values = {}
         self._locator = locator
 
         self._setup_params()
@@ -234,10 +336,77 @@ class RecordDictionaryTool(object):
         return granule
 
 
+    @classmethod
+    def concatenate(cls, rdts):
+        '''
+        Returns a new record dictionary containing the records of each record
+        dictionary in rdts, in order. The record dictionaries must share the
+        same parameter dictionary and have the same fields set.
+        '''
+        if not rdts:
+            raise BadRequest('No record dictionaries to concatenate')
+        first = rdts[0]
+        if len(rdts) == 1:
+            return first
+
+        instance = copy(first)
+        instance._rd = {}
+        instance._pf_values = {}
+        for key in first._rd.iterkeys():
+            values = [rdt._rd[key] for rdt in rdts]
+            if all([v is None for v in values]):
+                instance._rd[key] = None
+                continue
+            if any([v is None for v in values]):
+                raise BadRequest('Field %s is not set in every record dictionary' % key)
+            if isinstance(first._pdict.get_context(key).param_type, (SparseConstantType, ConstantType, ConstantRangeType)):
+                # Constants aren't per-record, the caller is responsible for only merging equal constants
+                instance._rd[key] = values[0]
+                continue
+            instance._rd[key] = np.concatenate([np.atleast_1d(v) for v in values])
+
+        instance._shp = (sum([len(rdt) for rdt in rdts]),)
+        instance._dirty_shape = False
+        instance.connection_id = rdts[-1].connection_id
+        instance.connection_index = rdts[-1].connection_index
+        return instance
+
+    def clone_empty(self):
+        '''
+        Returns a record dictionary without any values for the same stream,
+        it shares the parameter dictionary and layout of this one so it's
+        cheap enough to make one for every granule from a template.
+        '''
+        instance = copy(self)
+        instance._rd = dict.fromkeys(self._rd)
+        instance._pf_values = {}
+        instance._shp = None
+        instance._dirty_shape = False
+        instance.connection_id = ''
+        instance.connection_index = ''
+        return instance
+
     def _setup_params(self):
         for param in self._pdict.keys():
             self._rd[param] = None
 
+    @property
+    def layout(self):
+        '''
+        The field layout of this record dictionary's parameter dictionary
+        '''
+        if self._layout is None:
+            stream_def_id = self._stream_def or (self._definition and getattr(self._definition, '_id', None))
+            layout = self._layouts.pop(stream_def_id, None) if stream_def_id else None
+            if layout is None:
+                layout = RecordDictionaryLayout(self._pdict)
+            if stream_def_id:
+                self._layouts[stream_def_id] = layout
+                while len(self._layouts) > self.MAX_LAYOUTS:
+                    self._layouts.popitem(0)
+            self._layout = layout
+        return self._layout
+
     @property
     def fields(self):
         if self._available_fields is not None:
@@ -254,31 +423,80 @@ class RecordDictionaryTool(object):
         return self._pdict.temporal_parameter_name
 
     def fill_value(self,name):
-        return self._pdict.get_context(name).fill_value
+        return self.layout.fill_values[name]
 
-    def _replace_hook(self, name,vals):
+    def _replace_hook(self, name, vals, trusted=False):
+        '''
+        Replaces None with the fill value for quantities and casts arrays to
+        the field's dtype. Values that are all fill are treated as not set
+        unless the values are trusted.
+        '''
         if vals is None:
             return None
-        if not isinstance(self._pdict.get_context(name).param_type, QuantityType):
+        layout = self.layout
+        if name not in layout.quantities:
             return vals
+        fill = layout.fill_values[name]
         if isinstance(vals, (list,tuple)):
-            vals = [i if i is not None else self.fill_value(name) for i in vals]
-            if all([i is None for i in vals]):
+            if not vals:
                 return None
+            if fill is None:
+                if all([i is None for i in vals]):
+                    return None
+                return vals
+            try:
+                has_none = None in vals
+            except ValueError: # Records are arrays
+                has_none = True
+            if has_none:
+                vals = [i if i is not None else fill for i in vals]
             return vals
         if isinstance(vals, np.ndarray):
-            np.place(vals,vals==np.array(None), self.fill_value(name))
-            try:
-                if (vals == np.array(self.fill_value(name))).all():
-                    return None
-            except AttributeError:
-                pass
-            return np.asanyarray(vals, dtype=self._pdict.get_context(name).param_type.value_encoding)
+            # Only object arrays can hold None
+            if vals.dtype.kind == 'O':
+                np.place(vals, vals==np.array(None), fill)
+            if not trusted and self._is_fill(vals, fill):
+                return None
+            dtype = layout.dtypes[name] or self._pdict.get_context(name).param_type.value_encoding
+            return np.asanyarray(vals, dtype=dtype)
         return np.atleast_1d(vals)
 
+    @staticmethod
+    def _is_fill(vals, fill):
+        '''
+        True if every value is the fill value, bails out on the first value
+        when it isn't.
+        '''
+        try:
+            if vals.size and not np.all(vals.flat[0] == fill):
+                return False
+            return bool((vals == np.array(fill)).all())
+        except (AttributeError, ValueError, TypeError):
+            return False
+
     def __setitem__(self, name, vals):
         return self._set(name, self._replace_hook(name,vals))
 
+    def set_trusted(self, name, vals):
+        '''
+        Sets a field from values that already have the field's type and fill
+        values in place, values read back from a coverage for instance. Skips
+        the check for values that are all fill.
+        '''
+        return self._set(name, self._replace_hook(name, vals, trusted=True))
+
+    def set_raw(self, name, vals):
+        '''
+        Sets a field to vals as they are, without fill value handling, casting
+        or shape checks. For values read back from a coverage along with the
+        temporal field, which sets the shape. Derived fields depending on the
+        field are evaluated again.
+        '''
+        if name not in self.fields:
+            raise KeyError(name)
+        self._invalidate(name)
+        self._rd[name] = vals
+
     def _set(self, name, vals):
         """
         Set a parameter
@@ -286,6 +504,7 @@ class RecordDictionaryTool(object):
         if name not in self.fields:
             raise KeyError(name)
 
+        self._invalidate(name)
         if vals is None:
             self._rd[name] = None
             return
@@ -347,11 +566,21 @@ class RecordDictionaryTool(object):
         if isinstance(ptype, ParameterFunctionType):
             if self._rd[name] is not None:
                 return np.atleast_1d(self._rd[name]) # It was already set
-            
+
+            # Evaluated at most once until one of its inputs is set
+            if name in self._pf_values:
+                return self._pf_values[name]
             try:
-                return self._get_param_func(name)
+                value = self._get_param_func(name)
+                if isinstance(value, np.ndarray):
+                    # Shared by every read, so it can't be modified in place
+                    value = value.view()
+                    value.flags.writeable = False
+                self._pf_values[name] = value
+                return value
             except ParameterFunctionException:
                 log.debug('failed to get parameter function field: %s (%s)', name, self._pdict.keys(), exc_info=True)
+                self._pf_values[name] = None
 
         if self._rd[name] is not None:
             return np.atleast_1d(self._rd[name])
@@ -367,10 +596,7 @@ class RecordDictionaryTool(object):
             if args is None:
                 return None
 
-            if not hasattr(ptype.function,'_callable'):
-                ptype.function._import_func()
-
-            retval = ptype.function._callable(*args)
+            retval = self.layout.get_callable(name, ptype.function)(*args)
             return retval
 
         elif isinstance(ptype.function, NumexprFunction):
@@ -379,7 +605,7 @@ class RecordDictionaryTool(object):
             # For missing parameter inputs, return None
             if args is None:
                 return None
-            retval = ne.evaluate(ptype.function.expression, local_dict=args)
+            retval = self.layout.evaluate(ptype.function.expression, args)
             return retval
 
         else:
@@ -436,8 +662,17 @@ class RecordDictionaryTool(object):
 
     def __delitem__(self, y):
         """ x.__delitem__(y) <==> del x[y] """
+        self._invalidate(y)
         self._rd[y] = None
 
+    def _invalidate(self, name):
+        '''
+        Drops the evaluated parameter functions that depend on name
+        '''
+        if self._pf_values:
+            for dependent in self.layout.dependents(name):
+                self._pf_values.pop(dependent, None)
+
     def __iter__(self):
         """ x.__iter__() <==> iter(x) """
         for k in self._rd.iterkeys():
@@ -474,28 +709,131 @@ class RecordDictionaryTool(object):
 
     def size(self):
         '''
-        Truly poor way to calculate the size of a granule...
-        returns the size in bytes.
+        Estimates the size in bytes of the granule for this record dictionary
+        from the sizes of the values that are set, without serializing it.
+        Numeric arrays are counted exactly, other values are estimated.
         '''
-        granule = self.to_granule()
-        serializer = IonObjectSerializer()
-        flat = serializer.serialize(granule)
-        byte_stream = msgpack.packb(flat, default=encode_ion)
-        return len(byte_stream)
+        size = self.GRANULE_OVERHEAD
+        for key, val in self._rd.iteritems():
+            size += self.ORDINAL_OVERHEAD
+            if val is None:
+                continue
+            if isinstance(val, np.ndarray):
+                if val.dtype.kind in 'biufc':
+                    size += val.nbytes
+                else:
+                    size += val.size * self.OBJECT_ITEM_SIZE
+            elif isinstance(val, (list, tuple)):
+                size += len(val) * self.OBJECT_ITEM_SIZE
+            else:
+                size += self.OBJECT_ITEM_SIZE
+        return size
+
+    # Size estimates for size(), in bytes
+    GRANULE_OVERHEAD = 512 # Granule attributes and stream definition id
+    ORDINAL_OVERHEAD = 64  # Ordinal key and the array header of a value
+    OBJECT_ITEM_SIZE = 16  # A record of a non-numeric field
 
-    
     def to_ordinal(self, key):
-        params = copy(self._rd.keys())
-        params.sort()
         try:
-            return params.index(key)
-        except ValueError:
+            return self.layout.to_ordinal(key)
+        except KeyError:
             raise KeyError(key)
-        
+
     def from_ordinal(self, ordinal):
-        params = copy(self._rd.keys())
-        params.sort()
-        return params[ordinal]
+        return self.layout.from_ordinal(ordinal)
+
+    #--------------------------------------------------------------------------------
+    # Columnar encoding
+    #--------------------------------------------------------------------------------
+
+    COLUMNAR_MAGIC   = 'RDC1'
+    COLUMNAR_ALIGN   = 8
+
+    def to_columnar(self, connection_id='', connection_index=''):
+        '''
+        Encodes the record dictionary as a single binary string. Numeric
+        arrays are written as contiguous buffers (aligned to 8 bytes) after a
+        msgpack header, anything else is msgpacked.
+
+        The layout is:
+            'RDC1' | uint32 header length | header | padding | column buffers
+        '''
+        columns = []
+        buffers = []
+        offset = 0
+        for key, val in self._rd.iteritems():
+            ordinal = self.to_ordinal(key)
+            if val is None:
+                continue
+            if isinstance(val, np.ndarray) and val.dtype.kind in 'biufc':
+                data = np.ascontiguousarray(val).tostring()
+                columns.append((ordinal, 'a', val.dtype.str, val.shape, offset, len(data)))
+            else:
+                data = msgpack.packb(val, default=encode_ion)
+                columns.append((ordinal, 'o', None, None, offset, len(data)))
+            padding = -len(data) % self.COLUMNAR_ALIGN
+            buffers.append(data + '\0' * padding)
+            offset += len(data) + padding
+
+        header = {
+            'columns'              : columns,
+            'domain'               : self._shp,
+            'stream_definition_id' : self._stream_def or '',
+            'stream_definition'    : IonObjectSerializer().serialize(self._definition) if self._definition else None,
+            'param_dictionary'     : None if (self._stream_def or self._definition) else self._pdict.dump(),
+            'locator'              : self._locator,
+            'creation_timestamp'   : time.time(),
+            'connection_id'        : connection_id,
+            'connection_index'     : connection_index,
+        }
+        header = msgpack.packb(header, default=encode_ion)
+        prefix = self.COLUMNAR_MAGIC + struct.pack('<I', len(header)) + header
+        prefix += '\0' * (-len(prefix) % self.COLUMNAR_ALIGN)
+        return prefix + ''.join(buffers)
+
+    @classmethod
+    def from_columnar(cls, buf, stream_definition=None):
+        '''
+        Decodes a string made by to_columnar. Numeric fields are read only
+        views of buf (np.frombuffer), they aren't copied.
+        @param stream_definition A StreamDefinition to use instead of reading the one referenced by buf
+        '''
+        if buf[:4] != cls.COLUMNAR_MAGIC:
+            raise BadRequest('Not a columnar record dictionary')
+        header_length, = struct.unpack('<I', buf[4:8])
+        header = msgpack.unpackb(buf[8:8 + header_length], object_hook=decode_ion)
+        data_start = 8 + header_length
+        data_start += -data_start % cls.COLUMNAR_ALIGN
+
+        if stream_definition is None and header['stream_definition']:
+            stream_definition = IonObjectDeserializer(obj_registry=get_obj_registry()).deserialize(header['stream_definition'])
+        if stream_definition is not None:
+            instance = cls(stream_definition=stream_definition, stream_definition_id=header['stream_definition_id'], locator=header['locator'])
+        elif header['stream_definition_id']:
+            instance = cls(stream_definition_id=header['stream_definition_id'], locator=header['locator'])
+        else:
+            instance = cls(param_dictionary=header['param_dictionary'], locator=header['locator'])
+
+        if header['domain']:
+            instance._shp = tuple(header['domain'])
+        instance._creation_timestamp = header['creation_timestamp']
+        instance.connection_id = header['connection_id']
+        instance.connection_index = header['connection_index']
+
+        for ordinal, kind, dtype, shape, offset, length in header['columns']:
+            key = instance.from_ordinal(ordinal)
+            start = data_start + offset
+            if kind == 'a':
+                dtype = np.dtype(dtype)
+                if not length:
+                    instance._rd[key] = np.empty(shape, dtype=dtype)
+                    continue
+                val = np.frombuffer(buf, dtype=dtype, count=length // dtype.itemsize, offset=start)
+                instance._rd[key] = val.reshape(shape)
+            else:
+                instance._rd[key] = msgpack.unpackb(buf[start:start + length], object_hook=decode_ion)
+        return instance
 
 
     @staticmethod
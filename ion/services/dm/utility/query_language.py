@@ -7,6 +7,10 @@
 '''
 from pyparsing import ParseException, Regex, quotedString, CaselessLiteral, MatchFirst, removeQuotes, Optional
 from pyon.core.exception import BadRequest
+import dateutil.parser
+import calendar
+import math
+import re
 
 
 class QueryLanguage(object):
@@ -424,60 +428,257 @@ class QueryLanguage(object):
             return True
         return False
 
-    @classmethod
-    def match(cls, event = None, query = None):
 
-        field_val = getattr(event,query['field'])
+    #=========================================
+    # Compiled predicates for matching events
+    #=========================================
+    EARTH_RADIUS = {'km' : 6371.0, 'mi' : 3958.8}
+    MILLISECOND_FIELDS = ('ts_created', 'ts_updated')
+
+    @classmethod
+    def compile_query(cls, query=None):
+        '''
+        Compiles a single query of a parsed query dict into a predicate that
+        takes an event and returns True when the event matches the query.
+        The query is classified and its bounds are converted once here instead
+        of on every event.
+        '''
+        if not (query and isinstance(query, dict) and query.get('field')):
+            raise BadRequest("Missing parameters value and range for query: %s" % query)
+        getter = cls._field_getter(query['field'])
 
         if cls.query_is_term_search(query):
-            # This is a term search - always a string
+            test = cls._compile_term(query['value'])
+        elif cls.query_is_range_search(query):
+            test = cls._compile_bounds(query['range'], float)
+        elif cls.query_is_time_bounds_search(query):
+            test = cls._compile_bounds(cls._time_bounds(query['field'], query['time_bounds']), cls._to_time)
+        elif cls.query_is_time_search(query):
+            test = cls._compile_bounds(cls._time_bounds(query['field'], query['time']), cls._to_time)
+        elif cls.query_is_vertical_bounds_search(query):
+            test = cls._compile_vertical(query['vertical_bounds'])
+        elif cls.query_is_geo_distance_search(query):
+            test = cls._compile_geo_distance(query)
+        elif cls.query_is_geo_bbox_search(query):
+            test = cls._compile_geo_bbox(query['top_left'], query['bottom_right'])
+        else:
+            raise BadRequest("Missing parameters value and range for query: %s" % query)
 
-            #@todo implement using regex to mimic lucene...
+        missing = cls._missing
+        def predicate(event):
+            value = getter(event)
+            if value is missing or value is None:
+                return False
+            try:
+                return test(value)
+            except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+                return False
+        return predicate
 
-            if str(field_val) == query['value']:
-                return True
+    @classmethod
+    def compile_condition(cls, query_dict=None):
+        '''
+        Compiles a parsed query dict, with its and/or lists, into a predicate
+        that takes an event. The predicate gives the same result as
+        evaluate_condition on the dict.
+        '''
+        query = cls.compile_query(query_dict['query'])
+        or_queries = [cls.compile_query(q) for q in query_dict.get('or') or []]
+        and_queries = [cls.compile_query(q) for q in query_dict.get('and') or []]
 
-        elif cls.query_is_range_search(query):
-            # always a numeric value - float or int
-            if (field_val >=  query['range']['from']) and (field_val <= query['range']['to']):
-                return True
-            else:
-                return False
+        def condition(event):
+            # if any of the queries in the list of 'or queries' gives a match, publish an event
+            for or_query in or_queries:
+                if or_query(event):
+                    return True
+            # every one of the 'and queries' has to match
+            for and_query in and_queries:
+                if not and_query(event):
+                    return False
+            return query(event)
+        return condition
 
-        elif cls.query_is_geo_distance_search(query):
-            #@todo - wait on this one...
-            pass
+    @classmethod
+    def match(cls, event = None, query = None):
+        return cls.compile_query(query)(event)
 
-        elif cls.query_is_geo_bbox_search(query):
-            #@todo implement this now.
+    @classmethod
+    def evaluate_condition(cls, event = None, query_dict = {} ):
+        '''
+        Returns True when the event matches the query dict. query_dict may be
+        a condition returned by compile_condition. The conditions compiled
+        for dicts are kept, so a dict evaluated for many events is compiled
+        once.
+        '''
+        if callable(query_dict):
+            return query_dict(event)
+        key = repr(cls._freeze(query_dict))
+        condition = cls._conditions.get(key)
+        if condition is None:
+            if len(cls._conditions) >= cls.CONDITION_CACHE_SIZE:
+                cls._conditions.clear()
+            condition = cls._conditions[key] = cls.compile_condition(query_dict)
+        return condition(event)
 
-#            self.assertTrue(retval == {'and':[], 'or':[], 'query':{'field':'location', 'top_left':[0.0, 40.0],
-#                                                                       'bottom_right': [40.0, 0.0], 'index':'index'}})
+    #=========================================
+    # Helpers for the compiled predicates
+    #=========================================
+    _missing = object()
+    _conditions = {}
+    CONDITION_CACHE_SIZE = 256
 
-#            if field_val
+    @classmethod
+    def _freeze(cls, value):
+        '''
+        Returns the value with its dicts as sorted tuples of items and its
+        lists as tuples, so equal query dicts have the same repr
+        '''
+        if isinstance(value, dict):
+            return tuple(sorted((k, cls._freeze(v)) for k, v in value.iteritems()))
+        if isinstance(value, (list, tuple)):
+            return tuple(cls._freeze(v) for v in value)
+        return value
 
-            pass
-        else:
-            raise BadRequest("Missing parameters value and range for query: %s" % query)
+    @classmethod
+    def _field_getter(cls, field):
+        '''
+        Returns a function reading the (dotted) field from an event, the event
+        and its nested values may be objects or dicts
+        '''
+        missing = cls._missing
+        def lookup(obj, name):
+            if isinstance(obj, dict):
+                return obj.get(name, missing)
+            return getattr(obj, name, missing)
+
+        names = field.split('.')
+        if len(names) == 1:
+            return lambda event: lookup(event, field)
+
+        def getter(event):
+            value = event
+            for name in names:
+                value = lookup(value, name)
+                if value is missing or value is None:
+                    return missing
+            return value
+        return getter
 
     @classmethod
-    def evaluate_condition(cls, event = None, query_dict = {} ):
+    def _compile_term(cls, term):
+        '''
+        Terms are compared to the string of the value, '*' in a term matches
+        any characters like it does for the datastore queries
+        '''
+        term = str(term)
+        if '*' not in term:
+            return lambda value: str(value) == term
+        pattern = re.compile('^%s$' % '.*'.join(re.escape(part) for part in term.split('*')), re.IGNORECASE | re.DOTALL)
+        return lambda value: pattern.match(str(value)) is not None
 
-        query = query_dict['query']
-        or_queries= query_dict['or']
-        and_queries = query_dict['and']
+    @classmethod
+    def _compile_bounds(cls, bounds, convert):
+        '''
+        Bounds are inclusive and either of them may be left open
+        '''
+        lower = bounds.get('from')
+        upper = bounds.get('to')
+        if lower is not None and upper is not None:
+            return lambda value: lower <= convert(value) <= upper
+        elif lower is not None:
+            return lambda value: convert(value) >= lower
+        elif upper is not None:
+            return lambda value: convert(value) <= upper
+        return lambda value: True
 
-        # if any of the queries in the list of 'or queries' gives a match, publish an event
-        if or_queries:
-            for or_query in or_queries:
-                if cls.match(event, or_query):
-                    return True
+    @classmethod
+    def _time_bounds(cls, field, bounds):
+        '''
+        Converts the dates of time bounds to seconds since the epoch, or
+        milliseconds for the resource timestamps
+        '''
+        scale = 1000 if field.split('.')[-1] in cls.MILLISECOND_FIELDS else 1
+        converted = {}
+        for key in ('from', 'to'):
+            if bounds.get(key):
+                converted[key] = cls._to_time(bounds[key]) * scale
+        return converted
 
-        # if an 'and query' or a list of 'and queries' is provided, return if the match returns false for
-        # any one of them
-        if and_queries:
-            for and_query in and_queries:
-                if not cls.match(event, and_query):
-                    return False
-        return cls.match(event, query)
+    @classmethod
+    def _to_time(cls, value):
+        try:
+            return float(value)
+        except ValueError:
+            return float(calendar.timegm(dateutil.parser.parse(value).timetuple()))
+
+    @classmethod
+    def _compile_vertical(cls, bounds):
+        '''
+        A value matches when it's within the bounds, or for a range of values
+        (from, to) when the range overlaps them
+        '''
+        lower = float(bounds.get('from', 0))
+        upper = float(bounds.get('to', 0))
+        def test(value):
+            if isinstance(value, (list, tuple)):
+                return float(min(value)) <= upper and float(max(value)) >= lower
+            return lower <= float(value) <= upper
+        return test
+
+    @classmethod
+    def _coords(cls, value):
+        '''
+        Returns the (lon, lat) of a location given as a [lon, lat] pair, like
+        the query coordinates, or as an object or dict with lat and lon or
+        latitude and longitude
+        '''
+        if isinstance(value, (list, tuple)):
+            return float(value[0]), float(value[1])
+        if isinstance(value, dict):
+            lat = value['lat'] if 'lat' in value else value['latitude']
+            lon = value['lon'] if 'lon' in value else value['longitude']
+        else:
+            lat = value.lat if hasattr(value, 'lat') else value.latitude
+            lon = value.lon if hasattr(value, 'lon') else value.longitude
+        return float(lon), float(lat)
 
+    @classmethod
+    def _compile_geo_bbox(cls, top_left, bottom_right):
+        west, north = float(top_left[0]), float(top_left[1])
+        east, south = float(bottom_right[0]), float(bottom_right[1])
+        south, north = min(south, north), max(south, north)
+        coords = cls._coords
+        if west <= east:
+            def test(value):
+                lon, lat = coords(value)
+                return south <= lat <= north and west <= lon <= east
+        else:
+            # The box crosses the antimeridian
+            def test(value):
+                lon, lat = coords(value)
+                return south <= lat <= north and (lon >= west or lon <= east)
+        return test
+
+    @classmethod
+    def _compile_geo_distance(cls, query):
+        '''
+        Matches locations within the great circle (haversine) distance of the
+        query coordinates
+        '''
+        radius = cls.EARTH_RADIUS.get(str(query['units']).lower())
+        if radius is None:
+            raise BadRequest('Unsupported distance units: %s' % query['units'])
+        # Compare the haversine of the central angle rather than the distance
+        limit = min(float(query['dist']) / radius, math.pi)
+        max_h = math.sin(limit / 2) ** 2
+        lat0 = math.radians(float(query['lat']))
+        lon0 = math.radians(float(query['lon']))
+        cos_lat0 = math.cos(lat0)
+        coords = cls._coords
+
+        def test(value):
+            lon, lat = coords(value)
+            lat, lon = math.radians(lat), math.radians(lon)
+            h = math.sin((lat - lat0) / 2) ** 2 + cos_lat0 * math.cos(lat) * math.sin((lon - lon0) / 2) ** 2
+            return h <= max_h
+        return test
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_coverage_cache.py
+@brief Unit tests for the container coverage cache
+'''
+
+from ion.services.dm.utility.coverage_cache import CoverageCache
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock
+
+
+@attr('UNIT', group='dm')
+class TestCoverageCache(PyonTestCase):
+    def setUp(self):
+        self.opened = []
+        self.cache = CoverageCache(max_handles=3, max_bytes=10 * CoverageCache.HANDLE_SIZE)
+        self.cache.loaders = {'coverage' : self.open_coverage}
+
+    def open_coverage(self, dataset_id, mode='r'):
+        coverage = Mock()
+        coverage.persistence_dir = None
+        coverage.dataset_id = dataset_id
+        coverage.mode = mode
+        self.opened.append(coverage)
+        return coverage
+
+    def test_hits_and_misses(self):
+        cov = self.cache.get('ds1')
+        self.assertIs(self.cache.get('ds1'), cov)
+        self.assertIsNot(self.cache.get('ds1', mode='a'), cov)
+
+        stats = self.cache.stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['handles'], 2)
+        self.assertEquals(stats['bytes'], 2 * CoverageCache.HANDLE_SIZE)
+
+    def test_lru_eviction(self):
+        append_cov = self.cache.get('ds1', mode='a')
+        self.cache.release(append_cov)
+        self.cache.get('ds2')
+        self.cache.get('ds3')
+        self.cache.get('ds2') # ds1 is now the least recently used
+        self.cache.get('ds4')
+
+        self.assertEquals(len(self.cache), 3)
+        self.assertEquals(self.cache.evictions, 1)
+        # Evicted append handles are closed so their data is flushed
+        append_cov.close.assert_called_once_with(timeout=5)
+        self.cache.get('ds2')
+        self.assertEquals(self.cache.hits, 2)
+
+    def test_byte_budget(self):
+        self.cache.max_handles = 10
+        self.cache.max_bytes = 2 * CoverageCache.HANDLE_SIZE
+        for dataset_id in ('ds1', 'ds2', 'ds3'):
+            self.cache.get(dataset_id)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.size, 2 * CoverageCache.HANDLE_SIZE)
+
+    def test_eject_on_dataset_modified(self):
+        read_cov = self.cache.get('ds1')
+        append_cov = self.cache.get('ds1', mode='a')
+
+        event = Mock()
+        event.origin = 'ds1'
+        self.cache._on_dataset_modified(event)
+
+        # Only the read handle is ejected, it is closed once its reader is done
+        self.assertEquals(self.cache.ejections, 1)
+        self.assertFalse(read_cov.close.called)
+        self.assertIs(self.cache.get('ds1', mode='a'), append_cov)
+        self.assertIsNot(self.cache.get('ds1'), read_cov)
+        self.cache.release(read_cov)
+        read_cov.close.assert_called_once_with(timeout=5)
+
+        # Unused read handles are closed right away
+        with self.cache.hold('ds2') as cov:
+            pass
+        event.origin = 'ds2'
+        self.cache._on_dataset_modified(event)
+        cov.close.assert_called_once_with(timeout=5)
+        self.assertEquals(self.cache.stats()['retired'], 0)
+
+    def test_shared_handles(self):
+        # Two writers share the append handle
+        first = self.cache.get('ds1', mode='a')
+        second = self.cache.get('ds1', mode='a')
+        self.assertIs(first, second)
+
+        self.cache.eject('ds1', mode='a')
+        self.assertEquals(self.cache.stats()['retired'], 1)
+        self.cache.release(first)
+        self.assertFalse(first.close.called)
+        self.cache.release(second)
+        first.close.assert_called_once_with(timeout=5)
+        self.assertEquals(self.cache.stats()['retired'], 0)
+
+        # Evicted handles in use are closed on release too
+        self.cache.max_handles = 1
+        with self.cache.hold('ds2') as cov:
+            self.cache.get('ds3')
+            self.assertFalse(cov.close.called)
+        cov.close.assert_called_once_with(timeout=5)
+
+    def test_max_age(self):
+        cov = self.cache.get('ds1')
+        self.assertIs(self.cache.get('ds1', max_age=10), cov)
+        self.assertIsNot(self.cache.get('ds1', max_age=-1), cov)
+        self.assertEquals(len(self.cache), 1)
+        # The stale handle is closed once both of its users release it
+        self.cache.release(cov)
+        self.assertFalse(cov.close.called)
+        self.cache.release(cov)
+        cov.close.assert_called_once_with(timeout=5)
+
+    def test_retain(self):
+        with self.cache.hold('ds1') as cov:
+            self.assertIs(self.cache.retain(cov), cov)
+        # The retained handle outlives the hold
+        self.cache.eject('ds1')
+        self.assertFalse(cov.close.called)
+        self.cache.release(cov)
+        cov.close.assert_called_once_with(timeout=5)
+
+        # Only held handles can be retained
+        with self.assertRaises(ValueError):
+            self.cache.retain(cov)
@@ -6,6 +6,9 @@
 @brief Tests for granule
 '''
 
+from pyon.core.exception import BadRequest
+from pyon.core.object import IonObjectSerializer
+from pyon.core.interceptor.encode import encode_ion
 from pyon.ion.stream import StandaloneStreamPublisher, StandaloneStreamSubscriber
 from pyon.util.int_test import IonIntegrationTestCase
 
@@ -23,6 +26,7 @@ from coverage_model import ParameterContext as CoverageParameterContext, Quantit
 
 from ion.util.stored_values import StoredValueManager
 
+import msgpack
 import numpy as np
 
 @attr('INT',group='dm')
@@ -162,7 +166,102 @@ class RecordDictionaryIntegrationTest(IonIntegrationTestCase):
         self.assertEquals(rdt.fields, rdt2.fields)
         for k,v in rdt.iteritems():
             self.assertTrue(np.array_equal(rdt[k], rdt2[k]))
-        
+
+    def test_concatenate(self):
+        pdict_id = self.dataset_management.read_parameter_dictionary_by_name('ctd_parsed_param_dict', id_only=True)
+        stream_def_id = self.pubsub_management.create_stream_definition('ctd', parameter_dictionary_id=pdict_id)
+        self.addCleanup(self.pubsub_management.delete_stream_definition, stream_def_id)
+
+        rdts = []
+        for i in xrange(3):
+            rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+            rdt['time'] = np.arange(i*10, (i+1)*10)
+            rdt['temp'] = np.arange(10) + i
+            rdts.append(rdt)
+
+        merged = RecordDictionaryTool.concatenate(rdts)
+        self.assertEquals(len(merged), 30)
+        np.testing.assert_array_equal(merged['time'], np.arange(30))
+        np.testing.assert_array_equal(merged['temp'], np.concatenate([np.arange(10) + i for i in xrange(3)]))
+        self.assertTrue(merged['pressure'] is None)
+        # The inputs are left untouched
+        self.assertEquals(len(rdts[0]), 10)
+
+        rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        rdt['time'] = np.arange(10)
+        with self.assertRaises(BadRequest):
+            RecordDictionaryTool.concatenate([rdts[0], rdt])
+
+    def test_fill_values(self):
+        pdict_id = self.dataset_management.read_parameter_dictionary_by_name('ctd_parsed_param_dict', id_only=True)
+        stream_def_id = self.pubsub_management.create_stream_definition('ctd', parameter_dictionary_id=pdict_id)
+        self.addCleanup(self.pubsub_management.delete_stream_definition, stream_def_id)
+
+        rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        fill = rdt.fill_value('temp')
+        rdt['time'] = np.arange(3)
+        rdt['temp'] = np.array([1.0, None, 3.0], dtype=object)
+        np.testing.assert_array_equal(rdt['temp'], np.array([1.0, fill, 3.0]))
+        self.assertEquals(rdt['temp'].dtype, np.dtype(rdt.param_type('temp').value_encoding))
+
+        rdt['temp'] = [None, 2.0, None]
+        np.testing.assert_array_equal(rdt['temp'], np.array([fill, 2.0, fill]))
+
+        # Values that are all fill aren't set unless they're trusted
+        rdt['temp'] = np.array([fill] * 3)
+        self.assertTrue(rdt['temp'] is None)
+        rdt.set_trusted('temp', np.array([fill] * 3))
+        np.testing.assert_array_equal(rdt['temp'], np.array([fill] * 3))
+
+    def test_columnar(self):
+        pdict_id = self.dataset_management.read_parameter_dictionary_by_name('ctd_parsed_param_dict', id_only=True)
+        stream_def_id = self.pubsub_management.create_stream_definition('ctd', parameter_dictionary_id=pdict_id)
+        self.addCleanup(self.pubsub_management.delete_stream_definition, stream_def_id)
+
+        rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        rdt['time'] = np.arange(20)
+        rdt['temp'] = np.arange(20) * 0.5
+        rdt['lat'] = [40.0] * 20
+
+        # Ordinals follow the sorted field names
+        for i, name in enumerate(sorted(rdt.fields)):
+            self.assertEquals(rdt.to_ordinal(name), i)
+            self.assertEquals(rdt.from_ordinal(i), name)
+        with self.assertRaises(KeyError):
+            rdt.to_ordinal('not_a_field')
+
+        buf = rdt.to_columnar(connection_id='c1', connection_index='5')
+        rdt2 = RecordDictionaryTool.from_columnar(buf)
+        self.assertEquals(len(rdt2), 20)
+        self.assertEquals(rdt2.connection_id, 'c1')
+        for k,v in rdt.iteritems():
+            np.testing.assert_array_equal(rdt2[k], rdt[k])
+        self.assertTrue(rdt2['pressure'] is None)
+
+    def test_size(self):
+        pdict_id = self.dataset_management.read_parameter_dictionary_by_name('ctd_parsed_param_dict', id_only=True)
+        stream_def_id = self.pubsub_management.create_stream_definition('ctd', parameter_dictionary_id=pdict_id)
+        self.addCleanup(self.pubsub_management.delete_stream_definition, stream_def_id)
+
+        def encoded_size(rdt):
+            # What the messaging layer sends for a published granule
+            return len(msgpack.packb(IonObjectSerializer().serialize(rdt.to_granule()), default=encode_ion))
+
+        # Within 10% of the encoded granule for numeric data
+        rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        rdt['time'] = np.arange(100000)
+        rdt['temp'] = np.arange(100000) * 0.5
+        rdt['lat'] = np.ones(100000) * 40.0
+        encoded = encoded_size(rdt)
+        self.assertTrue(abs(rdt.size() - encoded) < 0.1 * encoded, 'estimated %s bytes, encoded %s' % (rdt.size(), encoded))
+
+        # Small granules are dominated by the per granule and per field overhead, within 2 kB
+        rdt = RecordDictionaryTool(stream_definition_id=stream_def_id)
+        rdt['time'] = np.arange(20)
+        rdt['temp'] = np.arange(20) * 0.5
+        encoded = encoded_size(rdt)
+        self.assertTrue(abs(rdt.size() - encoded) < 2048, 'estimated %s bytes, encoded %s' % (rdt.size(), encoded))
+
 
 
     def test_rdt_param_funcs(self):
@@ -306,6 +405,24 @@ class RecordDictionaryIntegrationTest(IonIntegrationTestCase):
 
         np.testing.assert_allclose(rdt['density'], np.array([1001.00543606]))
 
+        # Derived fields are evaluated once, until one of their inputs is set
+        density = rdt['density']
+        self.assertIs(rdt['density'], density)
+        rdt['lat'] = [0]
+        self.assertIsNot(rdt['density'], density)
+
+        # Values set without checks (as replay does) also drop the derived values
+        density = rdt['density']
+        rdt.set_raw('temperature_counts', np.array([560000], dtype=np.float32))
+        self.assertIsNot(rdt['density'], density)
+        self.assertFalse(np.allclose(rdt['density'], density))
+
+        # The shared value can't be modified in place
+        density = rdt['density']
+        with self.assertRaises(ValueError):
+            density[0] = 0
+        np.testing.assert_array_equal(rdt['density'], density)
+
     def test_rdt_lookup(self):
         rdt = self.create_lookup_rdt()
 
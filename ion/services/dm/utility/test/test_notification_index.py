@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_notification_index.py
+@brief Unit tests for the notification subscription index
+'''
+
+from ion.services.dm.utility.uns_utility_methods import NotificationIndex, calculate_reverse_user_info, update_reverse_user_info, check_user_notification_interest
+from ion.processes.data.transforms.notification_worker import NotificationWorker
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from interface.objects import NotificationRequest, Event
+from mock import patch
+
+import itertools
+import random
+
+
+@attr('UNIT', group='dm')
+class TestNotificationIndex(PyonTestCase):
+    def test_matches_key_combinations(self):
+        fields = [('o1', ''), ('PlatformDevice', ''), ('ResourceAgentStateEvent', ''), ('UPDATE', '')]
+        notifications = {}
+        for i, key in enumerate(itertools.product(*fields)):
+            notifications[key] = set([('notification%d' % i, 'user')])
+        notifications[('o2', '', 'ResourceAgentStateEvent', '')] = set([('other', 'user')])
+        index = NotificationIndex(notifications)
+
+        events = list(itertools.product(('o1', 'o2', ''), ('PlatformDevice', ''), ('ResourceAgentStateEvent', 'DeviceEvent'), ('UPDATE', '')))
+        for event_key in events:
+            expected = []
+            for k in set(NotificationWorker._key_combinations.im_func(None, event_key)):
+                expected.extend(notifications.get(k, []))
+            self.assertEquals(sorted(index.match(event_key)), sorted(expected))
+
+    def test_empty(self):
+        index = NotificationIndex({})
+        self.assertEquals(index.match(('o1', 'PlatformDevice', 'ResourceAgentStateEvent', 'UPDATE')), [])
+
+
+@attr('UNIT', group='dm')
+class TestReverseUserInfo(PyonTestCase):
+    def notification(self, origin, event_type, origin_type='type_1', event_subtype='subtype_1'):
+        return NotificationRequest(origin=origin, origin_type=origin_type, event_type=event_type, event_subtype=event_subtype)
+
+    def test_check_user_notification_interest(self):
+        user_info = {
+            'user_1' : {'notifications' : [self.notification('instrument_1', 'Event')]},
+            'user_2' : {'notifications' : [self.notification('instrument_2', 'Event')]},
+        }
+        reverse_user_info = calculate_reverse_user_info(user_info)
+        self.assertEquals(reverse_user_info['event_type']['Event'], frozenset(['user_1', 'user_2']))
+
+        event = Event(origin='instrument_1', origin_type='type_1', sub_type='subtype_1')
+        self.assertEquals(check_user_notification_interest(event, reverse_user_info), ['user_1'])
+        # matching doesn't change the index
+        self.assertEquals(check_user_notification_interest(event, reverse_user_info), ['user_1'])
+        self.assertEquals(reverse_user_info['event_type']['Event'], frozenset(['user_1', 'user_2']))
+
+        event.origin = 'instrument_3'
+        self.assertEquals(check_user_notification_interest(event, reverse_user_info), [])
+
+    def test_wildcard_subscriptions(self):
+        user_info = {
+            # any origin
+            'user_1' : {'notifications' : [self.notification('', 'Event')]},
+            # any event type and origin type
+            'user_2' : {'notifications' : [self.notification('instrument_1', '', origin_type='')]},
+            'user_3' : {'notifications' : [self.notification('instrument_2', 'Event')]},
+        }
+        reverse_user_info = calculate_reverse_user_info(user_info)
+        self.assertEquals(reverse_user_info['event_origin'][''], frozenset(['user_1']))
+        self.assertEquals(reverse_user_info['event_origin']['instrument_2'], frozenset(['user_1', 'user_3']))
+
+        def interested(origin, origin_type='type_1'):
+            event = Event(origin=origin, origin_type=origin_type, sub_type='subtype_1')
+            return sorted(check_user_notification_interest(event, reverse_user_info))
+
+        self.assertEquals(interested('instrument_1'), ['user_1', 'user_2'])
+        self.assertEquals(interested('instrument_2'), ['user_1', 'user_3'])
+        # origins and origin types nobody subscribed to explicitly match the wildcard subscriptions
+        self.assertEquals(interested('instrument_3'), ['user_1'])
+        self.assertEquals(interested('instrument_1', origin_type='type_2'), ['user_2'])
+
+        # dropping the only wildcard origin subscription
+        user_info['user_1'] = {'notifications' : [self.notification('instrument_1', 'Event')]}
+        reverse_user_info = update_reverse_user_info(reverse_user_info, user_info, ['user_1'])
+        self.assertEquals(reverse_user_info, calculate_reverse_user_info(user_info))
+        self.assertEquals(interested('instrument_3'), [])
+        self.assertEquals(interested('instrument_2'), ['user_3'])
+
+    def test_update_reverse_user_info(self):
+        user_info = {
+            'user_1' : {'notifications' : [self.notification('instrument_1', 'Event')]},
+            'user_2' : {'notifications' : [self.notification('instrument_2', 'Event')]},
+        }
+        reverse_user_info = calculate_reverse_user_info(user_info)
+
+        user_info['user_1'] = {'notifications' : [self.notification('instrument_2', 'Event', origin_type='type_2')]}
+        updated = update_reverse_user_info(reverse_user_info, user_info, ['user_1'])
+        self.assertEquals(updated, calculate_reverse_user_info(user_info))
+        self.assertNotIn('instrument_1', updated['event_origin'])
+        # the original index is left alone
+        self.assertEquals(reverse_user_info['event_origin']['instrument_1'], frozenset(['user_1']))
+
+        del user_info['user_2']
+        updated = update_reverse_user_info(updated, user_info, ['user_2'])
+        self.assertEquals(updated, calculate_reverse_user_info(user_info))
+
+        del user_info['user_1']
+        self.assertEquals(update_reverse_user_info(updated, user_info, ['user_1']), {})
+
+    def test_update_wildcards(self):
+        rs = random.Random(0)
+        def random_notification():
+            return self.notification(rs.choice(['', 'instrument_1', 'instrument_2']), rs.choice(['', 'Event', 'DeviceEvent']),
+                                     origin_type=rs.choice(['', 'type_1']), event_subtype=rs.choice(['', 'subtype_1']))
+        user_ids = ['user_%d' % i for i in xrange(6)]
+        user_info = dict((user_id, {'notifications' : [random_notification()]}) for user_id in user_ids)
+        reverse_user_info = calculate_reverse_user_info(user_info)
+
+        # The index is updated in place of being recomputed
+        with patch('ion.services.dm.utility.uns_utility_methods.calculate_reverse_user_info') as calculate:
+            for i in xrange(200):
+                changed = rs.sample(user_ids, rs.randint(1, 2))
+                for user_id in changed:
+                    if rs.random() < 0.2:
+                        user_info.pop(user_id, None)
+                    else:
+                        user_info[user_id] = {'notifications' : [random_notification() for j in xrange(rs.randint(1, 2))]}
+                reverse_user_info = update_reverse_user_info(reverse_user_info, user_info, changed)
+                self.assertEquals(reverse_user_info, calculate_reverse_user_info(user_info))
+            self.assertFalse(calculate.called)
@@ -253,12 +253,10 @@ def check_user_notification_interest(event, reverse_user_info):
     Returns the list of users interested in the notification
 
     @param event                Event
-    @param reverse_user_info    dict
+    @param reverse_user_info    dict, as returned by calculate_reverse_user_info
 
     @retval user_ids list
     """
-#    log.debug("Checking for interested users. Event type: %s, reverse_user_info: %s", event.type_, reverse_user_info)
-
     if not isinstance(event, Event):
         raise BadRequest("The input parameter should have been an Event.")
 
@@ -270,62 +268,101 @@ def check_user_notification_interest(event, reverse_user_info):
     else:
         raise BadRequest("Missing keys in reverse_user_info. Reverse_user_info not properly set up.")
 
-
-    if not event or not reverse_user_info:
-        raise BadRequest("Missing input parameters for method, check_user_notification_interest().")
-
-    users = set()
-
     """
     Prioritize... First check event type. If that matches proceed to check origin if that attribute of the event obj is filled,
     If that matches too, check for sub_type if that attribute is filled for the event object...
     If this matches too, check for origin_type if that attribute of the event object is not empty.
+
+    The index values are frozensets that already include the users subscribed with a wildcard (''), and values
+    nobody subscribed to explicitly fall back to the wildcard users, so a miss returns before anything is allocated
+    and a hit costs at most three intersections.
     """
 
-    if event.type_: # for an incoming event with origin type specified
-        if reverse_user_info['event_type'].has_key(event.type_):
-            user_list_1 = reverse_user_info['event_type'][event.type_]
-            if reverse_user_info['event_type'].has_key(''): # for users who subscribe to any event types
-                user_list_1.extend(reverse_user_info['event_type'][''])
-            users = set(user_list_1)
-#            log.debug("For event_type = %s, UNS got interested users here  %s", event.type_, users)
-        else:
-#            log.debug("After checking event_type = %s, UNS got no interested users here", event.type_)
-            return []
+    # no user can match an event without a type
+    if not event.type_:
+        return []
+
+    type_index = reverse_user_info['event_type']
+    users = type_index.get(event.type_, type_index.get(''))
+    if not users:
+        return []
 
     if event.origin: # for an incoming event that has origin specified (this should be true for almost all events)
-        if reverse_user_info['event_origin'].has_key(event.origin):
-            user_list_2 = set(reverse_user_info['event_origin'][event.origin])
-            if reverse_user_info['event_origin'].has_key(''): # for users who subscribe to any event origins
-                user_list_2.extend(reverse_user_info['event_origin'][''])
-            users = set.intersection(users, user_list_2)
-#            log.debug("For event origin = %s too, UNS got interested users here  %s", event.origin, users)
-        else:
-#            log.debug("After checking  event origin = %s, UNS got no interested users here", event.origin)
+        origin_index = reverse_user_info['event_origin']
+        origin_users = origin_index.get(event.origin, origin_index.get(''))
+        if not origin_users:
             return []
+        users = users & origin_users
 
-    if event.sub_type:  # for an incoming event with the sub type specified
-        if reverse_user_info['event_subtype'].has_key(event.sub_type):
-            user_list_3 = reverse_user_info['event_subtype'][event.sub_type]
-            if reverse_user_info['event_subtype'].has_key(''): # for users who subscribe to any event subtypes
-                user_list_3.extend(reverse_user_info['event_subtype'][''])
-            users = set.intersection(users, user_list_3)
-#        else:
-#            log.debug("After checking event_subtype = %s, UNS got no interested users here", event.sub_type)
-#            return []
-
-    if event.origin_type:  # for an incoming event with origin type specified
-        if reverse_user_info['event_origin_type'].has_key(event.origin_type):
-            user_list_4 = reverse_user_info['event_origin_type'][event.origin_type]
-            if reverse_user_info['event_origin_type'].has_key(''): # for users who subscribe to any event origin types
-                user_list_4.extend(reverse_user_info['event_origin_type'][''])
-            users = set.intersection(users, user_list_4)
-        else:
-#            log.debug("After checking event_origin_type = %s, UNS got no interested users here", event.origin_type)
+    if event.sub_type: # for an incoming event with the sub type specified, an unknown sub type does not filter
+        subtype_users = reverse_user_info['event_subtype'].get(event.sub_type)
+        if subtype_users is not None:
+            users = users & subtype_users
+
+    if event.origin_type: # for an incoming event with origin type specified
+        origin_type_index = reverse_user_info['event_origin_type']
+        origin_type_users = origin_type_index.get(event.origin_type, origin_type_index.get(''))
+        if not origin_type_users:
             return []
+        users = users & origin_type_users
+
+    return list(users)
+
+# reverse_user_info key -> NotificationRequest attribute
+REVERSE_USER_INFO_FIELDS = {
+    'event_type'        : 'event_type',
+    'event_subtype'     : 'event_subtype',
+    'event_origin'      : 'origin',
+    'event_origin_type' : 'origin_type',
+}
+
+def _reverse_user_info_keys(value):
+    """
+    Yields the (reverse_user_info key, value) pairs a user is indexed under, value being the user's user_info entry.
+    Notification fields left empty are yielded as the wildcard ('') value.
+    """
+    notifications = value['notifications']
+
+    notifications_disabled = value.get('notifications_disabled', False)
+    notifications_daily_digest = value.get('notifications_daily_digest', False)
+
+    # Ignore users who do NOT want REALTIME notifications or who have disabled the delivery switch
+    # However, if notification preferences have not been set at all for the user, do not bother
+    if notifications_disabled or notifications_daily_digest or not notifications:
+        return
+
+    for notification in notifications:
+
+        # If the notification has expired, do not keep it in the reverse user info that the notification
+        # workers use
+        if notification.temporal_bounds.end_datetime:
+            continue
 
-#    log.debug("The interested users found here are: %s, for event: %s", list(users), event)
-    return list( users)
+        if not isinstance(notification, NotificationRequest):
+            continue
+
+        for field, attr in REVERSE_USER_INFO_FIELDS.iteritems():
+            yield field, getattr(notification, attr) or ''
+
+def _has_reverse_user_info_key(value, field, key):
+    """
+    Returns True if one of the notifications in a user info value is indexed under key for field
+    """
+    return bool(value) and any(k == key for f, k in _reverse_user_info_keys(value) if f == field)
+
+def _freeze_reverse_user_info(index):
+    """
+    Converts the sets of users in index (field -> key -> set) into frozensets holding the union with the wildcard ('')
+    users of the same field
+    """
+    frozen = {}
+    for field, users_by_key in index.iteritems():
+        wildcard = users_by_key.get('', frozenset())
+        frozen_field = {}
+        for key, users in users_by_key.iteritems():
+            frozen_field[key] = frozenset(users) if key == '' else frozenset(users).union(wildcard)
+        frozen[field] = frozen_field
+    return frozen
 
 def calculate_reverse_user_info(user_info=None):
     """
@@ -336,88 +373,95 @@ def calculate_reverse_user_info(user_info=None):
 
     The reverse_user_info dictionary has the following form:
 
-    reverse_user_info = {'event_type' : { <event_type_1> : ['user_1', 'user_2'..],
-                                             <event_type_2> : ['user_3'],... },
+    reverse_user_info = {'event_type' : { <event_type_1> : frozenset(['user_1', 'user_2'..]),
+                                             <event_type_2> : frozenset(['user_3']),... },
+
+                        'event_subtype' : { <event_subtype_1> : frozenset(['user_1', 'user_2'..]),
+                                               <event_subtype_2> : frozenset(['user_3']),... },
 
-                        'event_subtype' : { <event_subtype_1> : ['user_1', 'user_2'..],
-                                               <event_subtype_2> : ['user_3'],... },
+                        'event_origin' : { <event_origin_1> : frozenset(['user_1', 'user_2'..]),
+                                              <event_origin_2> : frozenset(['user_3']),... },
 
-                        'event_origin' : { <event_origin_1> : ['user_1', 'user_2'..],
-                                              <event_origin_2> : ['user_3'],... },
+                        'event_origin_type' : { <event_origin_type_1> : frozenset(['user_1', 'user_2'..]),
+                                                   <event_origin_type_2> : frozenset(['user_3']),... },
 
-                        'event_origin_type' : { <event_origin_type_1> : ['user_1', 'user_2'..],
-                                                   <event_origin_type_2> : ['user_3'],... },
+    Users whose notification leaves a field empty are indexed under '' for that field, and are also part of every
+    other entry of the field.
+    The index is never modified once built, use update_reverse_user_info to get an index reflecting changed users.
     """
 
     if not user_info:
         return {}
 
-    reverse_user_info = {}
-
-    dict_1 = {}
-    dict_2 = {}
-    dict_3 = {}
-    dict_4 = {}
-
+    index = dict((field, {}) for field in REVERSE_USER_INFO_FIELDS)
+    indexed = False
     for user_id, value in user_info.iteritems():
+        for field, key in _reverse_user_info_keys(value):
+            index[field].setdefault(key, set()).add(user_id)
+            indexed = True
 
-        notifications = value['notifications']
-
-        notifications_disabled = value.get('notifications_disabled', False)
-        notifications_daily_digest = value.get('notifications_daily_digest', False)
-
-        # Ignore users who do NOT want REALTIME notifications or who have disabled the delivery switch
-        # However, if notification preferences have not been set at all for the user, do not bother
-
-        if notifications_disabled or not not notifications_daily_digest:
-            continue
-
-        if notifications:
+    if not indexed:
+        return {}
 
-            for notification in notifications:
+    return _freeze_reverse_user_info(index)
 
-                # If the notification has expired, do not keep it in the reverse user info that the notification
-                # workers use
-                if notification.temporal_bounds.end_datetime:
-                    continue
+def update_reverse_user_info(reverse_user_info, user_info, user_ids):
+    """
+    Returns a reverse user info with the entries of the given users recomputed from user_info, the entries of all
+    other users are shared with reverse_user_info which is left unchanged. Wildcard ('') users that change are added
+    to or removed from the other entries of their field.
 
-                if not isinstance(notification, NotificationRequest):
-                    continue
+    @param reverse_user_info    dict, as returned by calculate_reverse_user_info
+    @param user_info            dict, the updated user info
+    @param user_ids             ids of the users whose notifications changed (or who were removed from user_info)
+    @retval reverse_user_info   dict
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return reverse_user_info
+
+    reverse_user_info = reverse_user_info or dict((field, {}) for field in REVERSE_USER_INFO_FIELDS)
+
+    # the (field, key) entries the users are indexed under now
+    new_keys = {}
+    for user_id in user_ids:
+        if user_id in user_info:
+            for field, key in _reverse_user_info_keys(user_info[user_id]):
+                new_keys.setdefault((field, key), set()).add(user_id)
+
+    updated = {}
+    for field, users_by_key in reverse_user_info.iteritems():
+        new_users = dict((key, users) for (new_field, key), users in new_keys.iteritems() if new_field == field)
+        old_wildcard = users_by_key.get('', frozenset())
+        wildcard = frozenset(old_wildcard - user_ids).union(new_users.get('', ()))
+
+        # every entry carries the wildcard users, entries only change when wildcard users are added or when
+        # they hold or get one of the users
+        if wildcard - old_wildcard:
+            keys = set(users_by_key)
+        else:
+            keys = set(key for key, users in users_by_key.iteritems() if not users.isdisjoint(user_ids))
+        keys.update(new_users)
+        keys.discard('')
+
+        field_index = dict(users_by_key)
+        for key in keys:
+            users = set(users_by_key.get(key, ())) - user_ids
+            users.update(new_users.get(key, ()))
+            # an entry is kept while somebody subscribed to its key explicitly
+            if users <= wildcard and not any(_has_reverse_user_info_key(user_info.get(user_id), field, key) for user_id in users):
+                field_index.pop(key, None)
+            else:
+                field_index[key] = frozenset(users).union(wildcard)
+        if wildcard:
+            field_index[''] = wildcard
+        else:
+            field_index.pop('', None)
+        updated[field] = field_index
 
-                if dict_1.has_key(notification.event_type) and notification.event_type != '':
-                    dict_1[notification.event_type].append(user_id)
-                    # to remove duplicate user names
-                    dict_1[notification.event_type] = list(set(dict_1[notification.event_type]))
-                elif notification.event_type != '':
-                    dict_1[notification.event_type] = [user_id]
-
-                if dict_2.has_key(notification.event_subtype) and notification.event_subtype != '':
-                    dict_2[notification.event_subtype].append(user_id)
-                    # to remove duplicate user names
-                    dict_2[notification.event_subtype] = list(set(dict_2[notification.event_subtype]))
-                elif notification.event_subtype != '':
-                    dict_2[notification.event_subtype] = [user_id]
-
-                if dict_3.has_key(notification.origin) and notification.origin != '':
-                    dict_3[notification.origin].append(user_id)
-                    # to remove duplicate user names
-                    dict_3[notification.origin] = list(set(dict_3[notification.origin]))
-                elif notification.origin != '':
-                    dict_3[notification.origin] = [user_id]
-
-                if dict_4.has_key(notification.origin_type) and notification.origin_type != '':
-                    dict_4[notification.origin_type].append(user_id)
-                    # to remove duplicate user names
-                    dict_4[notification.origin_type] = list(set(dict_4[notification.origin_type]))
-                elif notification.origin_type != '':
-                    dict_4[notification.origin_type] = [user_id]
-
-                reverse_user_info['event_type'] = dict_1
-                reverse_user_info['event_subtype'] = dict_2
-                reverse_user_info['event_origin'] = dict_3
-                reverse_user_info['event_origin_type'] = dict_4
-
-    return reverse_user_info
+    if not any(updated.itervalues()):
+        return {}
+    return updated
 
 def get_event_computed_attributes(event, include_event=False, include_special=False, include_formatted=False):
     """
@@ -613,3 +657,50 @@ def load_notifications(container=None):
 
     return notifications
 
+
+
+class NotificationIndex(object):
+    """
+    Subscription index built from the dict returned by load_notifications
+
+    Keys are bucketed by which of (origin,origin_type,event_type,event_subtype) they set, an event is matched with
+    one hashed lookup per bucket instead of trying every combination of its fields. A key only matches events whose
+    fields are equal in the positions it sets, same as matching against NotificationWorker._key_combinations.
+    """
+    def __init__(self, notifications=None):
+        self.notifications = notifications or {}
+        # mask (tuple of bools, True where the key is set) -> {key: tuple((notification,user),...)}
+        self._buckets = {}
+        # key matching any event with at least one empty field
+        self._wildcard = ()
+        for key, values in self.notifications.iteritems():
+            mask = tuple(bool(k) for k in key)
+            if not any(mask):
+                self._wildcard = tuple(values)
+                continue
+            self._buckets.setdefault(mask, {})[key] = tuple(values)
+        # lookups only need the masks, precompute which event fields each one keeps
+        self._masks = [(mask, bucket, [i for i, m in enumerate(mask) if m]) for mask, bucket in self._buckets.iteritems()]
+
+    def __len__(self):
+        return len(self.notifications)
+
+    def match(self, key):
+        """
+        returns a list of (notification,user) triggered by an event with key (origin,origin_type,event_type,event_subtype)
+        """
+        matches = []
+        n = len(key)
+        for mask, bucket, positions in self._masks:
+            combination = [''] * n
+            for i in positions:
+                combination[i] = key[i]
+            values = bucket.get(tuple(combination))
+            if values:
+                matches.extend(values)
+        if self._wildcard and '' in key:
+            matches.extend(self._wildcard)
+        return matches
+
+    def match_event(self, event):
+        return self.match((event.origin, event.origin_type, event.type_, event.sub_type))
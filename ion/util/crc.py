@@ -2,30 +2,76 @@
 
 # From:
 # https://github.com/bernardpaulus/scriptim/blob/master/crcISO.py
+#
+# The bitwise loop has been replaced by lookup tables. The reflected
+# ISO 14443 polynomial 0x8408 is the bit reversed CRC-CCITT polynomial 0x1021,
+# so for it the CRC is computed by binascii.crc_hqx on bit reversed bytes.
 
-from binascii import hexlify, unhexlify
+from binascii import crc_hqx
+
+ISO14443_POLYNOMIAL = 0x8408
+
+# Each byte value with its bits in reverse order, as a str.translate table
+_REVERSED_BITS = ''.join(chr(int('{:08b}'.format(i)[::-1], 2)) for i in xrange(256))
+
+_crc16_tables = {}
+
+def _reverse16(value):
+    """returns the 16 bit value with its bits in reverse order"""
+    return (ord(_REVERSED_BITS[value & 0xff]) << 8) | ord(_REVERSED_BITS[value >> 8])
+
+def crc16_table(polynomial):
+    """returns the 256 entry lookup table of the reflected CRC16 for polynomial"""
+    table = _crc16_tables.get(polynomial)
+    if table is None:
+        table = []
+        for byte in xrange(256):
+            crc = byte
+            for bit in range(8):
+                if crc & 0x0001:
+                    crc= (crc >> 1) ^ polynomial
+                else:
+                    crc= crc >> 1
+            table.append(crc)
+        _crc16_tables[polynomial] = table
+    return table
 
 def crc16_iso14443a(data):
     """takes a data string and returns [crclow, crchigh] bytes"""
     crc= 0x6363
-    return crc16_iso14443ab(data, crc, 0x8408, False)
+    return crc16_iso14443ab(data, crc, ISO14443_POLYNOMIAL, False)
 
 def crc16_iso14443b(data):
     crc= 0xffff
-    return crc16_iso14443ab(data, crc, 0x8408, True)
+    return crc16_iso14443ab(data, crc, ISO14443_POLYNOMIAL, True)
 
 def crc16_iso14443ab(data, crc, polynomial, invert):
-    for byte in [int(hexlify(c), 16) for c in data]:
-        crc= crc ^ byte
-        for bit in range(8):
-            if crc & 0x0001:
-                crc= (crc >> 1) ^ polynomial
-            else:
-                crc= crc >> 1
-    crclow= crc & 0xff
-    crchigh= (crc >> 8) & 0xff
+    if polynomial == ISO14443_POLYNOMIAL:
+        crc= _reverse16(crc_hqx(data.translate(_REVERSED_BITS), _reverse16(crc)))
+    else:
+        table = crc16_table(polynomial)
+        for byte in bytearray(data):
+            crc= (crc >> 8) ^ table[(crc ^ byte) & 0xff]
     if invert:
-        crclow= 256 + ~crclow
-        crchigh= 256 + ~crchigh
+        crc= crc ^ 0xffff
 #    return [crclow, crchigh]
-    return crclow + 256*crchigh
+    return crc
+
+def crc16_iso14443a_blocks(blocks):
+    """takes a sequence of data strings and returns the list of their CRCs"""
+    return crc16_iso14443ab_blocks(blocks, 0x6363, ISO14443_POLYNOMIAL, False)
+
+def crc16_iso14443b_blocks(blocks):
+    """takes a sequence of data strings and returns the list of their CRCs"""
+    return crc16_iso14443ab_blocks(blocks, 0xffff, ISO14443_POLYNOMIAL, True)
+
+def crc16_iso14443ab_blocks(blocks, crc, polynomial, invert):
+    if polynomial != ISO14443_POLYNOMIAL:
+        return [crc16_iso14443ab(block, crc, polynomial, invert) for block in blocks]
+    init = _reverse16(crc)
+    mask = 0xffff if invert else 0
+    return [_reverse16(crc_hqx(block.translate(_REVERSED_BITS), init)) ^ mask for block in blocks]
+
+def check_crc16_iso14443b(blocks, crcs):
+    """takes sequences of data strings and expected CRCs and returns a list of bools, True where they match"""
+    return [actual == expected for (actual, expected) in zip(crc16_iso14443b_blocks(blocks), crcs)]
@@ -8,8 +8,10 @@
 """
 
 import os
+import mmap
 import yaml
 import requests
+import warnings
 import numpy as np
 from StringIO import StringIO
 
@@ -33,6 +35,20 @@ def warn_user(msg):
     sys.stderr.write(msg + '\n')
 
 
+def find_nearest_indices(times, values):
+    '''
+    Returns the index of the nearest time for each value, like
+    coverage_model.utils.find_nearest_index but for many values at once
+    '''
+    times = np.asarray(times)
+    values = np.asarray(values)
+    if times.size < 2 or np.any(np.diff(times) < 0):
+        return np.array([utils.find_nearest_index(times, v) for v in values], dtype=np.int64)
+    right = np.clip(np.searchsorted(times, values), 1, times.size - 1)
+    left = right - 1
+    return np.where(np.abs(values - times[left]) <= np.abs(times[right] - values), left, right)
+
+
 class DirectCoverageAccess(object):
     def __init__(self):
         self.ingestion_management = IngestionManagementServiceClient()
@@ -157,32 +173,35 @@ class DirectCoverageAccess(object):
     def get_parser(cls, data_file_path, config_path=None):
         return SimpleDelimitedParser.get_parser(data_file_path, config_path=config_path)
 
-    def manual_upload(self, dataset_id, data_file_path, config_path=None):
-        # First, ensure we can get a parser and parse the data file
+    def manual_upload(self, dataset_id, data_file_path, config_path=None, block_size=None):
+        # First, ensure we can get a parser and parse the whole data file, a
+        # malformed row raises here rather than after the blocks before it are written
         parser = self.get_parser(data_file_path, config_path)
-        dat = parser.parse()
+        if not sum(1 for dat in parser.iter_blocks(block_size)):
+            return
+        blocks = parser.iter_blocks(block_size)
+        dat = next(blocks)
 
         # Get the coverage
         with self.get_editable_coverage(dataset_id) as cov:
-            # Find the indices for the times in the data file
-            try:
-                time_dat = dat[cov.temporal_parameter_name]
-            except ValueError, ve:
-                if ve.message == 'field named %s not found.' % cov.temporal_parameter_name:
-                    raise ValueError('Temporal parameter name {0} not in upload data'.format(cov.temporal_parameter_name))
-                else:
-                    raise
+            if cov.temporal_parameter_name not in dat.dtype.names:
+                raise ValueError('Temporal parameter name {0} not in upload data'.format(cov.temporal_parameter_name))
             cov_times = cov.get_time_values()
-            tinds = [utils.find_nearest_index(cov_times, ti) for ti in time_dat]
-
-            sl = (tinds,)
             cparams = cov.list_parameters()
             for n in dat.dtype.names:
-                if n != cov.temporal_parameter_name:
-                    if n in cparams:
+                if n != cov.temporal_parameter_name and n not in cparams:
+                    warn_user('Skipping column \'%s\': matching parameter not found in coverage!' % n)
+
+            # The file is parsed again a block at a time as it's written
+            while dat is not None:
+                # Find the indices for the times in the data file
+                tinds = find_nearest_indices(cov_times, dat[cov.temporal_parameter_name]).tolist()
+
+                sl = (tinds,)
+                for n in dat.dtype.names:
+                    if n != cov.temporal_parameter_name and n in cparams:
                         cov.set_parameter_values(n, dat[n], sl)
-                    else:
-                        warn_user('Skipping column \'%s\': matching parameter not found in coverage!' % n)
+                dat = next(blocks, None)
 
     def upload_calibration_coefficients(self, dataset_id, data_file_path, config_path=None):
         # First, ensure we can get a parser and parse the data file
@@ -275,13 +294,15 @@ class DirectCoverageAccess(object):
 
 
 class SimpleDelimitedParser(object):
+    BLOCK_SIZE = 100000 # Rows parsed at a time by iter_blocks
 
     def __init__(self, data_url, num_columns=None, column_map=None, header_size=0, delimiter=',',
                  use_column_names=True, dtype='float32', fill_val=-999):
         if column_map is not None and not isinstance(column_map, dict):
             raise ValueError('If specified, \'column_map\' must be type<dict>')
 
-        self._dat_buffer = self._get_sbuffer(data_url)
+        if not data_url.startswith('http://') and not os.path.exists(data_url):
+            raise ValueError('Data file \'{0}\' not found'.format(data_url))
         self.data_url = data_url
         self.num_columns = num_columns
         self.column_map = column_map
@@ -306,17 +327,54 @@ class SimpleDelimitedParser(object):
 
         @return: A structured numpy array; field names can be listed with ret.dtype.names
         """
+        blocks = list(self.iter_blocks())
+        if not blocks:
+            return np.array([])
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks)
+
+    def iter_blocks(self, block_size=None):
+        """
+        Parse the file located at self.data_url a block of rows at a time,
+        local files are memory mapped rather than read into memory
 
-        # If not specified, sort out how many columns
-        if self.num_columns is None:
-            # Ensure we start at the beginning
-            self._dat_buffer.seek(0)
+        @param block_size: The maximum number of rows in a block, defaults to BLOCK_SIZE
+        @return: An iterator of structured numpy arrays with the same fields as parse()
+        """
+        block_size = block_size or self.BLOCK_SIZE
+        buf = self._get_sbuffer(self.data_url)
+        try:
             # Skip all the header lines
             for l in xrange(self.header_size):
-                self._dat_buffer.readline()
-            # Get the length of the next line split by the delimiter
-            self.num_columns = len(self._dat_buffer.readline().split(self.delimiter))
-
+                buf.readline()
+            names_line = buf.readline() if self.use_column_names else None
+            lines = self._read_lines(buf, block_size)
+
+            # If not specified, sort out how many columns
+            if self.num_columns is None:
+                # Get the length of the next line split by the delimiter
+                first_line = names_line if names_line is not None else ''.join(lines[:1])
+                self.num_columns = len(first_line.split(self.delimiter))
+            if not lines:
+                return
+
+            names, dtypes, fill_vals = self._column_properties()
+
+            # The record type comes from the first row so the names are validated just as genfromtxt does
+            sample = [names_line, lines[0]] if names_line is not None else lines[:1]
+            dtype = np.atleast_1d(np.genfromtxt(sample, delimiter=self.delimiter, names=names, dtype=dtypes, filling_values=fill_vals)).dtype
+
+            while lines:
+                yield self._parse_block(lines, dtype, fill_vals)
+                lines = self._read_lines(buf, block_size)
+        finally:
+            buf.close()
+
+    def _column_properties(self):
+        """
+        @return: The names (True to read them from the file), dtypes and fill values of the columns
+        """
         fill_vals = [self.fill_val] * self.num_columns
         dtypes = [self.dtype] * self.num_columns
         if self.use_column_names:
@@ -337,16 +395,61 @@ class SimpleDelimitedParser(object):
                 if 'fill_val' in d:
                     fill_vals[i] = d['fill_val']
 
-        dtypes = ','.join(dtypes)
+        return names, ','.join(dtypes), fill_vals
 
-        self._dat_buffer.seek(0)
-        dat = np.genfromtxt(fname=self._dat_buffer,
-                            skip_header=self.header_size,
-                            delimiter=self.delimiter,
-                            names=names,
-                            dtype=dtypes,
-                            filling_values=fill_vals)
+    def _read_lines(self, buf, count):
+        lines = []
+        for i in xrange(count):
+            line = buf.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
 
+    def _parse_block(self, lines, dtype, fill_vals):
+        """
+        Parses rows into a structured array. Rows of plain numbers are
+        parsed in a single pass, anything else (missing values, comments,
+        text columns) is left to genfromtxt.
+        """
+        dat = self._parse_numeric(lines, dtype)
+        if dat is None:
+            dat = np.atleast_1d(np.genfromtxt(lines, delimiter=self.delimiter, dtype=dtype, filling_values=fill_vals))
+        return dat
+
+    def _parse_numeric(self, lines, dtype):
+        """
+        @return: The rows as a structured array or None if they aren't all plain numbers
+        """
+        ncols = len(dtype)
+        if len(self.delimiter) != 1 or any(dtype[i].kind not in 'biuf' for i in xrange(ncols)):
+            return None
+        if any(line.count(self.delimiter) != ncols - 1 for line in lines):
+            return None
+
+        text = ''.join(lines).replace('\r\n', '\n').rstrip().replace('\n', self.delimiter)
+        with warnings.catch_warnings():
+            # numpy warns (or raises in later versions) when the text can't be parsed to the end
+            warnings.simplefilter('ignore')
+            try:
+                values = np.fromstring(text, sep=self.delimiter)
+            except ValueError:
+                return None
+        if values.size != len(lines) * ncols:
+            return None
+        values = values.reshape(len(lines), ncols)
+
+        dat = np.empty(len(lines), dtype=dtype)
+        for i, name in enumerate(dtype.names):
+            col = values[:, i]
+            kind = dtype[i].kind
+            if kind == 'b' and not np.all((col == 0) | (col == 1)):
+                return None
+            if kind in 'iu':
+                info = np.iinfo(dtype[i])
+                if not np.all(np.mod(col, 1) == 0) or col.min() < max(info.min, -2 ** 53) or col.max() > min(info.max, 2 ** 53):
+                    return None
+            dat[name] = col
         return dat
 
     def _get_sbuffer(self, url):
@@ -357,7 +460,10 @@ class SimpleDelimitedParser(object):
             response = requests.get(url)
             buf = StringIO(response.content)
         elif os.path.exists(url):
-            buf = StringIO(open(url).read())
+            with open(url, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return StringIO('')
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         else:
             raise ValueError('Data file \'{0}\' not found'.format(url))
 
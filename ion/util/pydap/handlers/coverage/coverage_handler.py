@@ -8,18 +8,19 @@ from email.utils import formatdate
 from stat import ST_MTIME
 
 from coverage_model.coverage import AbstractCoverage
-from coverage_model.parameter_types import QuantityType,ConstantRangeType,ArrayType, ConstantType, RecordType 
-from coverage_model.parameter_types import CategoryType, BooleanType, ParameterFunctionType, SparseConstantType
+from coverage_model.parameter_types import ConstantRangeType, ArrayType, RecordType, CategoryType
 from coverage_model.parameter_functions import ParameterFunctionException
 from pyon.container.cc import Container
-from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
-from pydap.model import DatasetType,BaseType, GridType, SequenceType
+from ion.services.dm.utility.coverage_cache import CoverageCache
+from ion.util.pydap.handlers.coverage.dap_strings import to_strings, to_object, join_rows, join_pairs
+from pydap.model import DatasetType,BaseType, GridType, SequenceType, SequenceData
 from pydap.handlers.lib import BaseHandler
 from pyon.public import CFG, PRED
 import time
 import simplejson as json
-import collections
 import functools
+import itertools
+import math
 
 numpy_boolean = '?'
 numpy_integer_types = 'bhilqp'
@@ -53,24 +54,24 @@ def request_profile(enabled=False):
 
 
 class Handler(BaseHandler):
-    CACHE_LIMIT = CFG.get_safe('server.pydap.cache_limit', 5)
     CACHE_EXPIRATION = CFG.get_safe('server.pydap.cache_expiration', 5)
     REQUEST_LIMIT = CFG.get_safe('server.pydap.request_limit', 200) # MB
-    _coverages = collections.OrderedDict() # Cache has to be a class var because each handler is initialized per request
+    CHUNK_SIZE = CFG.get_safe('server.pydap.chunk_size', 100000) # Approximate number of records read at once
+    STREAM = CFG.get_safe('server.pydap.stream', True) # Stream responses of more than one chunk as sequence records
+    _datasets = {} # Data product to dataset, a class var because each handler is initialized per request
 
     extensions = re.compile(r'^.*[0-9A-Za-z\-]{32}',re.IGNORECASE)
 
     def __init__(self, filepath):
         self.filepath = filepath
 
-    def calculate_bytes(self, bitmask, parameter_num):
-        timesteps = np.sum(bitmask)
+    def calculate_bytes(self, timesteps, parameter_num):
         # Assume 8 bytes per variable per timestep
         count = 8 * parameter_num * timesteps
         return count
 
-    def is_too_large(self, bitmask, parameter_num):
-        requested = self.calculate_bytes(bitmask, parameter_num)
+    def is_too_large(self, timesteps, parameter_num):
+        requested = self.calculate_bytes(timesteps, parameter_num)
         return requested > (self.REQUEST_LIMIT * 1024**2)
 
     def get_numpy_type(self, data):
@@ -100,33 +101,34 @@ class Handler(BaseHandler):
     @classmethod
     def get_coverage(cls, data_product_id):
         '''
-        Memoization (LRU) of _get_coverage
+        Returns the coverage for a data product, see get_coverage_and_dataset
+        '''
+        return cls.get_coverage_and_dataset(data_product_id)[0]
+
+    @classmethod
+    def get_coverage_and_dataset(cls, data_product_id):
+        '''
+        Returns the coverage and dataset id for a data product. The coverage
+        is held in the container's coverage cache until release_coverage.
         '''
         if not data_product_id:
-            return
-        try:
-            result, ts = cls._coverages.pop(data_product_id)
-            if (time.time() - ts) > cls.CACHE_EXPIRATION:
-                result.close()
-                raise KeyError(data_product_id)
-        except KeyError:
-            if data_product_id is None:
-                return None
+            return None, None
+        dataset_id = cls._datasets.get(data_product_id)
+        if dataset_id is None:
             resource_registry = Container.instance.resource_registry
             dataset_ids, _ = resource_registry.find_objects(data_product_id, PRED.hasDataset, id_only=True)
-            if not dataset_ids: return None
-            dataset_id = dataset_ids[0]
-            result = DatasetManagementService._get_coverage(dataset_id, mode='r')
-            result.value_caching = False
-            ts = time.time()
-            if result is None:
-                return None
-            if len(cls._coverages) >= cls.CACHE_LIMIT:
-                key, value = cls._coverages.popitem(0)
-                coverage, ts = value
-                coverage.close(timeout=5)
-        cls._coverages[dataset_id] = result, ts
-        return result
+            if not dataset_ids: return None, None
+            dataset_id = cls._datasets[data_product_id] = dataset_ids[0]
+        result = CoverageCache.get_instance().get(dataset_id, mode='r', max_age=cls.CACHE_EXPIRATION)
+        if result is None:
+            return None, None
+        result.value_caching = False
+        return result, dataset_id
+
+    @classmethod
+    def release_coverage(cls, coverage):
+        if coverage is not None:
+            CoverageCache.get_instance().release(coverage)
 
     def get_attrs(self, cov, name):
         pc = cov.get_parameter_context(name)
@@ -138,22 +140,6 @@ class Handler(BaseHandler):
             attrs['long_name'] = pc.display_name
         return attrs
 
-    def get_data(self,cov, name, bitmask):
-        #pc = cov.get_parameter_context(name)
-        try:
-            data = self.get_values(cov, name)
-            data[bitmask]
-            #data = cov._range_value[name][:][bitmask]
-        except ParameterFunctionException:
-            data = np.empty(cov.num_timesteps(), dtype='object')
-        data = np.asanyarray(data) 
-        if not data.shape:
-            data.shape = (1,)
-        return data
-    
-    def get_time_data(self, cov, slice_):
-        return self.get_data(cov, cov.temporal_parameter_name, slice_)
-
     def make_series(self, response, name, data, attrs, ttype):
         base_type = BaseType(name=name, data=data, type=ttype, attributes=attrs)
         #grid[dims[0]] = BaseType(name=dims[0], data=time_data, type=time_data.dtype.char, attributes=time_attrs, dimensions=dims, shape=time_data.shape)
@@ -181,120 +167,259 @@ class Handler(BaseHandler):
         retval = np.empty(data.shape[0], dtype='O')
         try:
             if len(data.shape)>1:
-                for i in xrange(data.shape[0]):
-                    retval[i] = ','.join(map(lambda x : str(x), data[i].tolist()))
-                return retval
+                return join_rows(data)
         except:
             retval = np.asanyarray(['None' for d in data])
         return retval
 
 
     def stringify(self, data):
-        retval = np.empty(data.shape, dtype='O')
         try:
-            for i,obj in enumerate(data):
-                retval[i] = str(obj)
+            retval = to_object(to_strings(data))
         except:
             retval = np.asanyarray(['None' for d in data])
         return retval
 
     def stringify_inplace(self, data):
         try:
-            for i,obj in enumerate(data):
-                data[i] = str(obj)
+            data[...] = to_strings(data)
         except:
             data = np.asanyarray(['None' for d in data])
         return data
 
-    def get_bitmask(self, cov, fields, slices, selectors):
-        '''
-        returns a bitmask appropriate to the values
-        '''
-        bitmask = np.ones(cov.num_timesteps(), dtype=np.bool)
-        for selector in selectors:
-            field, operator, value = self.parse_selectors(selector)
-            if operator is None:
-                continue
-            values = self.get_values(cov, field)
-            expression = ' '.join(['values', operator, value])
-            bitmask = bitmask & ne.evaluate(expression)
-
-        return bitmask
-
     def get_values(self, cov, field):
         data_dict = cov.get_parameter_values(param_names=[field], fill_empty_params=True, as_record_array=False).get_data()
         data = data_dict[field]
         return data
 
-    def get_dataset(self, cov, fields, slices, selectors, dataset, response):
+    def get_dataset(self, cov, fields, slices, selectors, dataset, response, dataset_id=None):
+        '''
+        Builds the data sequence for the requested fields. Selectors on the
+        time parameter bound the time segment that is read, the coverage is
+        then read a chunk of records at a time and only the records that pass
+        every selector are kept. Responses of more than one chunk are streamed.
+        '''
         seq = SequenceType('data')
-        bitmask = self.get_bitmask(cov, fields, slices, selectors)
-        if self.is_too_large(bitmask, len(fields)):
-            log.error('Client request too large. \nFields: %s\nSelectors: %s', fields, selectors)
-            return
+        names = []
         for name in fields:
             # Strip the data. from the field
             if name.startswith('data.'):
                 name = name[5:]
-            pc = cov.get_parameter_context(name)
             if re.match(r'.*_[a-z0-9]{32}', name):
                 continue # Let's not do this
+            names.append(name)
+
+        selectors = [self.parse_selectors(selector) for selector in selectors]
+        selectors = [selector for selector in selectors if selector[1] is not None]
+        segment = self.get_time_segment(cov, selectors)
+        bounds = self.get_time_bounds(cov, dataset_id)
+
+        # Checked before anything is read
+        if self.is_too_large(self.estimate_timesteps(cov, segment, bounds), len(names)):
+            log.error('Client request too large. \nFields: %s\nSelectors: %s', fields, selectors)
+            return
+
+        chunks = self.format_chunks(cov, names, self.read_chunks(cov, names, segment, bounds, selectors))
+        first = next(chunks, None)
+        if first is None:
+            # Nothing matched, the sequence is still described
+            first = dict((name, (np.array([], dtype=self.dap_type(cov.get_parameter_context(name))), self.dap_type(cov.get_parameter_context(name)))) for name in names if self.has_parameter(cov, name))
+            chunks = iter([])
+
+        columns = [name for name in names if name in first]
+        second = next(chunks, None)
+        if second is not None and not self.STREAM:
+            # Everything in memory
+            rest = [first, second] + list(chunks)
+            first = dict((name, (np.concatenate([chunk[name][0] for chunk in rest]), first[name][1])) for name in columns)
+
+        for name in columns:
+            data, dtype = first[name]
+            seq[name] = self.make_series(response, name, data, self.get_attrs(cov, name), dtype)
+
+        if second is not None and self.STREAM:
+            seq.data = StreamedRecords(cov, columns, first, itertools.chain([second], chunks))
+
+        dataset['data'] = seq
+        return dataset
+
+    def has_parameter(self, cov, name):
+        try:
+            cov.get_parameter_context(name)
+            return True
+        except Exception:
+            return False
+
+    def get_time_segment(self, cov, selectors):
+        '''
+        Returns the (start, end) time segment the selectors on the time
+        parameter allow, either end is None when it's open
+        '''
+        start = end = None
+        for field, operator, value in selectors:
+            if field != cov.temporal_parameter_name:
+                continue
             try:
-                data = self.get_data(cov, name, bitmask)
-                attrs  = self.get_attrs(cov, name)
-                if isinstance(pc.param_type, QuantityType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type, ConstantType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type, ConstantRangeType):
-                    #start = time.time()
-                    #convert to string
-                    try:
-                        #scalar case
-                        if data.shape == (2,):
-                            data = np.atleast_1d('_'.join([str(data[0]), str(data[1])]))
-                        else:
-                            for i,d in enumerate(data):
-                                f = [str(d[0]),str(d[1])]
-                                data[i] = '_'.join(f)
-                    except Exception, e:
-                        data = np.asanyarray(['None' for d in data])
-                    seq[name] = self.make_series(response, name, data, attrs, 'S')
-                elif isinstance(pc.param_type,BooleanType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type,CategoryType):
-                    data, dtype = self.filter_data(data)
-                    #start = time.time()
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                elif isinstance(pc.param_type,ArrayType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type,RecordType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type, ParameterFunctionType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-
-                elif isinstance(pc.param_type, SparseConstantType):
-                    data, dtype = self.filter_data(data)
-                    seq[name] = self.make_series(response, name, data, attrs, dtype)
-                #dataset[name] = self.make_series(response, name, data, attrs, dtype)
-#                elif param.is_coordinate and cov.temporal_parameter_name == name:
-#                        dataset[name] = BaseType(name=name, data=data, type=data.dtype.char, attributes=attrs, shape=data.shape)
-#                    else:
-#                        log.error("Unhandled parameter for parameter (%s) type: %s", name, pc.param_type.__class__.__name__)
-                    
-            except Exception, e:
-                log.exception('Problem reading cov %s %s', cov.name, e.__class__.__name__)
+                value = float(value)
+            except ValueError:
                 continue
-            dataset['data'] = seq
-        return dataset
+            if operator in ('>', '>=', '=='):
+                start = value if start is None else max(start, value)
+            if operator in ('<', '<=', '=='):
+                end = value if end is None else min(end, value)
+        return start, end
+
+    def get_time_bounds(self, cov, dataset_id):
+        '''
+        Returns the (min, max) time values from the dataset's metadata
+        document, None if it isn't available
+        '''
+        if not dataset_id:
+            return None
+        try:
+            doc = Container.instance.object_store.read_doc(dataset_id)
+            bounds = doc['bounds'][cov.temporal_parameter_name]
+            return float(bounds[0]), float(bounds[1])
+        except Exception:
+            return None
+
+    def estimate_timesteps(self, cov, segment, bounds):
+        '''
+        Estimates the number of records in the time segment from the number
+        of timesteps and the time bounds, assuming regular sampling
+        '''
+        total = cov.num_timesteps()
+        start, end = segment
+        if (start is None and end is None) or bounds is None:
+            return total
+        lower, upper = bounds
+        start = lower if start is None else max(start, lower)
+        end = upper if end is None else min(end, upper)
+        if end < start:
+            return 0
+        if upper <= lower:
+            return total
+        return min(total, int(math.ceil(total * (end - start) / (upper - lower))) + 1)
+
+    def time_chunks(self, cov, segment, bounds):
+        '''
+        Splits the time segment into chunks of about CHUNK_SIZE records
+        '''
+        start, end = segment
+        if bounds is None:
+            yield segment
+            return
+        lower, upper = bounds
+        start = lower if start is None else max(start, lower)
+        end = upper if end is None else min(end, upper)
+        if end < start:
+            return
+        total = cov.num_timesteps()
+        if not total or upper <= lower or total <= self.CHUNK_SIZE:
+            yield start, end
+            return
+        span = (upper - lower) * self.CHUNK_SIZE / total
+        while start + span < end:
+            yield start, start + span
+            start += span
+        yield start, end
+
+    def read_chunks(self, cov, names, segment, bounds, selectors):
+        '''
+        Reads the fields a chunk at a time, yields the values of each field
+        for the records that pass the selectors
+        '''
+        tname = cov.temporal_parameter_name
+        params = set(names)
+        params.update([field for field, operator, value in selectors])
+        params.add(tname)
+        params = [param for param in params if self.has_parameter(cov, param)]
+
+        last_time = None
+        for t0, t1 in self.time_chunks(cov, segment, bounds):
+            time_segment = None if t0 is None and t1 is None else (t0, t1)
+            data = self.get_values_mult(cov, params, time_segment)
+            times = data.get(tname)
+            if times is None or not len(times):
+                continue
+            mask = np.ones(len(times), dtype=np.bool)
+            if last_time is not None:
+                # Chunks share their bounds, those records were in the previous chunk
+                mask &= times > last_time
+            last_time = np.max(times)
+            for field, operator, value in selectors:
+                if field not in data:
+                    continue
+                values = data[field]
+                expression = ' '.join(['values', operator, value])
+                mask &= ne.evaluate(expression)
+            if not mask.any():
+                continue
+            yield dict((name, np.asanyarray(data[name])[mask]) for name in names if name in data)
+
+    def get_values_mult(self, cov, params, time_segment):
+        '''
+        Reads the parameters for the time segment, a parameter function that
+        can't be evaluated is left empty
+        '''
+        try:
+            return cov.get_parameter_values(param_names=params, time_segment=time_segment, fill_empty_params=True, as_record_array=False).get_data()
+        except ParameterFunctionException:
+            pass
+        data = {}
+        tname = cov.temporal_parameter_name
+        data[tname] = cov.get_parameter_values(param_names=[tname], time_segment=time_segment, fill_empty_params=True, as_record_array=False).get_data()[tname]
+        for param in params:
+            if param == tname:
+                continue
+            try:
+                data[param] = cov.get_parameter_values(param_names=[param], time_segment=time_segment, fill_empty_params=True, as_record_array=False).get_data()[param]
+            except ParameterFunctionException:
+                data[param] = np.empty(len(data[tname]), dtype='object')
+        return data
+
+    def format_chunks(self, cov, names, chunks):
+        '''
+        Converts each chunk's values to DAP types, yields dicts of field
+        name to (data, dap type). Fields that fail on the first chunk are left
+        out of the response, on later chunks they're filled.
+        '''
+        dtypes = None
+        for chunk in chunks:
+            formatted = {}
+            for name in names:
+                if name not in chunk or (dtypes is not None and name not in dtypes):
+                    continue
+                try:
+                    data = np.asanyarray(chunk[name])
+                    if not data.shape:
+                        data.shape = (1,)
+                    formatted[name] = self.format_data(cov.get_parameter_context(name), data)
+                except Exception, e:
+                    log.exception('Problem reading cov %s %s', cov.name, e.__class__.__name__)
+                    if dtypes is not None:
+                        formatted[name] = self.fill_column(dtypes[name], len(chunk[name]))
+            if dtypes is None:
+                dtypes = dict((name, dtype) for name, (data, dtype) in formatted.iteritems())
+            yield formatted
+
+    def fill_column(self, dtype, size):
+        if dtype == 'S':
+            return np.array(['None'] * size, dtype='O'), dtype
+        return np.zeros(size, dtype=dtype), dtype
+
+    def format_data(self, pc, data):
+        '''
+        Returns the data converted for DAP and its DAP type
+        '''
+        if isinstance(pc.param_type, ConstantRangeType):
+            #convert to string
+            try:
+                data = join_pairs(data)
+            except Exception, e:
+                data = np.asanyarray(['None' for d in data])
+            return data, 'S'
+        return self.filter_data(data)
 
     def value_encoding_to_dap_type(self, value_encoding):
         if value_encoding is None:
@@ -395,8 +520,14 @@ class Handler(BaseHandler):
     @exception_wrapper
     def parse_constraints(self, environ):
         base, data_product_id = os.path.split(self.filepath)
-        coverage = self.get_coverage(data_product_id)
+        coverage, dataset_id = self.get_coverage_and_dataset(data_product_id)
+        try:
+            return self.build_dataset(environ, coverage, dataset_id)
+        finally:
+            # Streamed records hold the coverage themselves
+            self.release_coverage(coverage)
 
+    def build_dataset(self, environ, coverage, dataset_id):
         last_modified = formatdate(time.mktime(time.localtime(os.stat(self.filepath)[ST_MTIME])))
         environ['pydap.headers'].append(('Last-modified', last_modified))
 
@@ -418,7 +549,7 @@ class Handler(BaseHandler):
         if not fields:
             fields = all_vars
         if response == "dods":
-            dataset = self.get_dataset(coverage, fields, slices, selectors, dataset, response)
+            dataset = self.get_dataset(coverage, fields, slices, selectors, dataset, response, dataset_id)
 
         elif response in ('dds', 'das'):
             self.handle_dds(coverage, dataset, fields)
@@ -475,5 +606,59 @@ class Handler(BaseHandler):
         
         return slice_
 
+
+class StreamedRecords(SequenceData):
+    '''
+    Sequence data read from the coverage a chunk at a time while the response
+    is written. The coverage is held in the coverage cache until the records
+    have been read or close is called, so the cache can't close it mid-response.
+    '''
+    def __init__(self, coverage, columns, first, chunks):
+        SequenceData.__init__(self, None, tuple(columns))
+        self.coverage = CoverageCache.get_instance().retain(coverage)
+        self.first = first
+        self.chunks = chunks
+
+    def __getitem__(self, key):
+        # Pydap sets each variable's data from its column, the first chunk describes it
+        if isinstance(key, basestring):
+            return self.first[key][0]
+        raise TypeError('Streamed records can only be iterated')
+
+    def __len__(self):
+        raise TypeError('Streamed records have no length')
+
+    def __copy__(self):
+        # Pydap copies the data before iterating, the records can only be read once
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __iter__(self):
+        chunks, self.chunks = self.chunks, None
+        if chunks is None:
+            return iter([])
+        return self.iter_records(itertools.chain([self.first], chunks))
+
+    def iter_records(self, chunks):
+        '''
+        Yields the sequence records chunk by chunk
+        '''
+        try:
+            for chunk in chunks:
+                for record in itertools.izip(*[chunk[name][0] for name in self.keys]):
+                    yield record
+        finally:
+            self.close()
+
+    def close(self):
+        coverage, self.coverage = self.coverage, None
+        if coverage is not None:
+            CoverageCache.get_instance().release(coverage)
+
+    def __del__(self):
+        self.close()
+
 class TypeNotSupportedError(Exception):
     pass
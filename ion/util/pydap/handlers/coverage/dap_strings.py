@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+@file ion/util/pydap/handlers/coverage/dap_strings.py
+@description Vectorized conversion of coverage values to DAP string columns.
+
+The values are formatted the way str() formats them, but with numpy string
+routines over whole arrays instead of a str() call per element.
+'''
+
+import numpy as np
+
+_to_str = np.frompyfunc(str, 1, 1)
+
+
+def to_strings(data):
+    '''
+    Returns an array of the same shape as data holding str() of each value
+    '''
+    data = np.asanyarray(data)
+    kind = data.dtype.kind
+    if kind == 'f':
+        strings = np.char.mod('%.12g', data)
+        # str() keeps a trailing .0 on integral values
+        integral = (np.char.find(strings, '.') < 0) & (np.char.find(strings, 'e') < 0) & (np.char.find(strings, 'n') < 0)
+        if integral.any():
+            strings = np.where(integral, np.char.add(strings, '.0'), strings)
+        return strings
+    if kind in 'iu':
+        return np.char.mod('%d', data)
+    if kind == 'b':
+        return np.where(data, 'True', 'False')
+    if kind == 'S':
+        return data
+    # Objects, complex numbers and anything else
+    return np.asarray(_to_str(data), dtype='O')
+
+def to_object(strings):
+    '''
+    Returns the strings as an object array, which is what DAP string columns hold
+    '''
+    retval = np.empty(strings.shape, dtype='O')
+    retval[...] = strings.tolist() if strings.ndim else strings.item()
+    return retval
+
+def join_rows(data, sep=','):
+    '''
+    Returns a 1-d object array with the values of each row of a 2-d array
+    joined by sep
+    '''
+    data = np.asanyarray(data)
+    retval = np.empty(data.shape[0], dtype='O')
+    if data.ndim != 2:
+        # Nested rows are formatted as lists
+        for i in xrange(data.shape[0]):
+            retval[i] = sep.join(map(str, data[i].tolist()))
+        return retval
+    for i, row in enumerate(to_strings(data).tolist()):
+        retval[i] = sep.join(row)
+    return retval
+
+def join_pairs(data, sep='_'):
+    '''
+    Returns a 1-d object array with the two values of each pair joined by sep,
+    data is either a (2,) pair, an (n,2) array or an array of pairs.
+    '''
+    data = np.asanyarray(data)
+    if data.shape == (2,):
+        data = data.reshape(1, 2)
+    if data.ndim == 2 and data.shape[1] == 2:
+        strings = to_strings(data)
+        return to_object(np.char.add(np.char.add(strings[:,0].astype('S'), sep), strings[:,1].astype('S')))
+    retval = np.empty(data.shape[0], dtype='O')
+    for i, pair in enumerate(data):
+        retval[i] = sep.join([str(pair[0]), str(pair[1])])
+    return retval
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+@file ion/util/pydap/handlers/coverage/test/test_coverage_handler.py
+@brief Unit tests for the OPeNDAP coverage handler
+'''
+
+from ion.util.pydap.handlers.coverage.coverage_handler import Handler
+from ion.services.dm.utility.coverage_cache import CoverageCache
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import numpy as np
+import tempfile
+import os
+
+
+@attr('UNIT', group='dm')
+class TestCoverageHandler(PyonTestCase):
+    def setUp(self):
+        self.handler = Handler('/tmp/data_product_id')
+        self.times = np.arange(1000, dtype=np.float64)
+        self.temps = np.arange(1000, dtype=np.float32) * 0.5
+        self.reads = []
+
+        self.cov = Mock()
+        self.cov.temporal_parameter_name = 'time'
+        self.cov.num_timesteps.return_value = 1000
+        self.cov.get_parameter_values.side_effect = self.get_parameter_values
+
+    def get_parameter_values(self, param_names, time_segment=None, fill_empty_params=False, as_record_array=False):
+        self.reads.append(time_segment)
+        mask = np.ones(len(self.times), dtype=np.bool)
+        if time_segment:
+            t0, t1 = time_segment
+            if t0 is not None:
+                mask &= self.times >= t0
+            if t1 is not None:
+                mask &= self.times <= t1
+        data = {'time' : self.times[mask], 'temp' : self.temps[mask]}
+        values = Mock()
+        values.get_data.return_value = dict((name, data[name]) for name in param_names)
+        return values
+
+    def test_time_segment(self):
+        selectors = [('time', '>', '10'), ('time', '<=', '20'), ('temp', '>', '1')]
+        self.assertEquals(self.handler.get_time_segment(self.cov, selectors), (10., 20.))
+        self.assertEquals(self.handler.get_time_segment(self.cov, [('temp', '>', '1')]), (None, None))
+
+    def test_estimate_timesteps(self):
+        bounds = (0., 999.)
+        self.assertEquals(self.handler.estimate_timesteps(self.cov, (None, None), bounds), 1000)
+        self.assertTrue(self.handler.estimate_timesteps(self.cov, (100., 199.), bounds) <= 102)
+        self.assertEquals(self.handler.estimate_timesteps(self.cov, (2000., None), bounds), 0)
+        # Without metadata the whole coverage is assumed
+        self.assertEquals(self.handler.estimate_timesteps(self.cov, (100., 199.), None), 1000)
+
+    def test_read_chunks(self):
+        self.handler.CHUNK_SIZE = 100
+        selectors = [('time', '>=', '150'), ('time', '<', '450'), ('temp', '>', '100')]
+        segment = self.handler.get_time_segment(self.cov, selectors)
+        chunks = list(self.handler.read_chunks(self.cov, ['time', 'temp'], segment, (0., 999.), selectors))
+
+        # Only the segment is read, in chunks
+        self.assertTrue(len(self.reads) > 1)
+        for t0, t1 in self.reads:
+            self.assertTrue(t0 >= 150 and t1 <= 450)
+
+        times = np.concatenate([chunk['time'] for chunk in chunks])
+        expected = self.times[(self.times >= 150) & (self.times < 450) & (self.temps > 100)]
+        np.testing.assert_array_equal(times, expected)
+
+    @patch('ion.util.pydap.handlers.coverage.coverage_handler.Container')
+    def test_streamed_records(self, container):
+        cache = CoverageCache()
+        cache.loaders = {'coverage' : Mock(return_value=self.cov)}
+        get_instance = patch.object(CoverageCache, 'get_instance', return_value=cache)
+        get_instance.start()
+        self.addCleanup(get_instance.stop)
+        container.instance.resource_registry.find_objects.return_value = (['dataset_id'], [])
+        container.instance.object_store.read_doc.return_value = {'bounds' : {'time' : (0., 999.)}}
+
+        self.cov.name = 'coverage'
+        self.cov.persistence_dir = None
+        self.cov.list_parameters.return_value = ['time', 'temp']
+        self.cov.get_parameter_context.return_value = Mock(uom='1', display_name='name')
+        self.handler.CHUNK_SIZE = 100
+        self.handler.filepath = tempfile.NamedTemporaryFile().name
+        open(self.handler.filepath, 'w').close()
+        self.addCleanup(os.remove, self.handler.filepath)
+
+        environ = {'pydap.headers' : [], 'pydap.response' : 'dods', 'QUERY_STRING' : 'time,temp&time>=100'}
+        dataset = self.handler.parse_constraints(environ)
+        self.assertEquals(len(self.reads), 2) # The first two chunks
+
+        # The cache closes the coverage while the response is still being read
+        cache.eject('dataset_id')
+        records = iter(dataset['data'])
+        for i in xrange(250):
+            record = next(records)
+            self.assertEquals((record['time'].data, record['temp'].data), (100. + i, (100. + i) * 0.5))
+        self.assertTrue(len(self.reads) > 2)
+        self.assertFalse(self.cov.close.called)
+
+        # Once the records are read the coverage is closed
+        times = [record['time'].data for record in records]
+        np.testing.assert_array_equal(times, self.times[350:])
+        self.cov.close.assert_called_once_with(timeout=5)
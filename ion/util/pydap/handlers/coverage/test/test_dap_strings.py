@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+@file ion/util/pydap/handlers/coverage/test/test_dap_strings.py
+@brief Tests for the vectorized DAP string conversions
+'''
+
+from ion.util.pydap.handlers.coverage.dap_strings import to_strings, join_rows, join_pairs
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+from nose.plugins.attrib import attr
+
+import numpy as np
+import time
+
+
+def legacy_join_rows(data):
+    retval = np.empty(data.shape[0], dtype='O')
+    for i in xrange(data.shape[0]):
+        retval[i] = ','.join(map(lambda x : str(x), data[i].tolist()))
+    return retval
+
+def legacy_stringify(data):
+    retval = np.empty(data.shape, dtype='O')
+    for i,obj in enumerate(data):
+        retval[i] = str(obj)
+    return retval
+
+
+@attr('UNIT', group='dm')
+class TestDapStrings(PyonTestCase):
+    def test_to_strings(self):
+        values = [
+            np.array([0., 1., -0., 0.1, 1/3., 1e16, 1e-7, 123456789012345., np.nan, np.inf, -np.inf]),
+            np.array([0.1, 2.5, 1e20], dtype=np.float32),
+            np.arange(-5, 5, dtype=np.int16),
+            np.arange(5, dtype=np.uint64),
+            np.array([True, False]),
+            np.array([1+2j, -1.5j]),
+            np.array(['a', 'bc']),
+            np.array([None, [1, 2], 'x', 1.5], dtype='O'),
+        ]
+        for data in values:
+            # As formatted by ndim_stringify, which converts the values with tolist()
+            self.assertEquals(list(to_strings(data)), [str(x) for x in data.tolist()])
+
+    def test_join_rows(self):
+        for data in (np.arange(12, dtype=np.float64).reshape(3,4) / 7., np.arange(12).reshape(4,3), np.arange(24).reshape(2,3,4)):
+            self.assertEquals(list(join_rows(data)), list(legacy_join_rows(data)))
+
+    def test_join_pairs(self):
+        self.assertEquals(list(join_pairs(np.array([1, 2]))), ['1_2'])
+        self.assertEquals(list(join_pairs(np.array([[1., 2.], [3.5, 4.]]))), ['1.0_2.0', '3.5_4.0'])
+        pairs = np.empty(2, dtype='O')
+        pairs[0] = (1, 2)
+        pairs[1] = (3, 4)
+        self.assertEquals(list(join_pairs(pairs)), ['1_2', '3_4'])
+
+
+@attr('UTIL', group='dm')
+class BenchmarkDapStrings(PyonTestCase):
+    def benchmark(self, name, vectorized, legacy, data, repeat=3):
+        def best(func):
+            times = []
+            for i in xrange(repeat):
+                t0 = time.time()
+                func(data)
+                times.append(time.time() - t0)
+            return min(times)
+        vectorized_time = best(vectorized)
+        legacy_time = best(legacy)
+        log.info('%s %s: vectorized %.3fs, per element %.3fs (%.1fx)', name, data.shape, vectorized_time, legacy_time, legacy_time / max(vectorized_time, 1e-9))
+        return vectorized_time, legacy_time
+
+    def test_benchmark_spectra(self):
+        # e.g. 10000 spectra of 256 bins
+        data = np.random.random((10000, 256))
+        self.benchmark('join_rows', join_rows, legacy_join_rows, data)
+
+    def test_benchmark_columns(self):
+        for data in (np.random.random(1000000), np.arange(1000000), np.random.random(100000) + 1j):
+            self.benchmark('to_strings', to_strings, legacy_stringify, data)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_crc.py
+@brief Tests for the table driven CRC16
+'''
+
+from ion.util.crc import crc16_iso14443a, crc16_iso14443b, crc16_iso14443ab, crc16_iso14443a_blocks, crc16_iso14443b_blocks, crc16_iso14443ab_blocks, check_crc16_iso14443b
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+from nose.plugins.attrib import attr
+
+from binascii import hexlify
+import random
+import time
+
+
+def legacy_crc16_iso14443ab(data, crc, polynomial, invert):
+    for byte in [int(hexlify(c), 16) for c in data]:
+        crc= crc ^ byte
+        for bit in range(8):
+            if crc & 0x0001:
+                crc= (crc >> 1) ^ polynomial
+            else:
+                crc= crc >> 1
+    crclow= crc & 0xff
+    crchigh= (crc >> 8) & 0xff
+    if invert:
+        crclow= 256 + ~crclow
+        crchigh= 256 + ~crchigh
+    return crclow + 256*crchigh
+
+def random_blocks(rs, count, max_length):
+    return [''.join(chr(rs.randint(0, 255)) for i in xrange(rs.randint(0, max_length))) for j in xrange(count)]
+
+
+@attr('UNIT', group='eoi')
+class TestCRC(PyonTestCase):
+    def test_known_values(self):
+        # ISO/IEC 14443-3 examples
+        self.assertEquals(crc16_iso14443a('\x00\x00'), 0x1ea0)
+        self.assertEquals(crc16_iso14443b('\x00\x00\x00'), 0xc6cc)
+        self.assertEquals(crc16_iso14443b(''), 0)
+        self.assertEquals(crc16_iso14443b(bytearray('\x00\x00\x00')), 0xc6cc)
+
+    def test_legacy_equivalence(self):
+        rs = random.Random(0)
+        blocks = random_blocks(rs, 200, 300) + ['\x00' * 10, '\xff' * 10]
+        for (crc, polynomial, invert) in [(0x6363, 0x8408, False), (0xffff, 0x8408, True), (0x0000, 0x8408, False),
+                                          (0x1234, 0xa001, False), (0xffff, 0xa001, True)]:
+            expected = [legacy_crc16_iso14443ab(block, crc, polynomial, invert) for block in blocks]
+            self.assertEquals([crc16_iso14443ab(block, crc, polynomial, invert) for block in blocks], expected)
+            self.assertEquals(crc16_iso14443ab_blocks(blocks, crc, polynomial, invert), expected)
+
+        self.assertEquals(crc16_iso14443a_blocks(blocks), [legacy_crc16_iso14443ab(block, 0x6363, 0x8408, False) for block in blocks])
+        self.assertEquals(crc16_iso14443b_blocks(blocks), [crc16_iso14443b(block) for block in blocks])
+
+    def test_check(self):
+        blocks = random_blocks(random.Random(1), 10, 50)
+        crcs = crc16_iso14443b_blocks(blocks)
+        crcs[3] ^= 1
+        self.assertEquals(check_crc16_iso14443b(blocks, crcs), [i != 3 for i in xrange(10)])
+
+
+@attr('UTIL', group='eoi')
+class BenchmarkCRC(PyonTestCase):
+    def benchmark(self, name, func, legacy, blocks, repeat=3):
+        def best(f):
+            times = []
+            for i in xrange(repeat):
+                t0 = time.time()
+                f(blocks)
+                times.append(time.time() - t0)
+            return min(times)
+        table_time = best(func)
+        legacy_time = best(legacy)
+        size = sum(len(block) for block in blocks)
+        log.info('%s %d bytes: table %.3fs, bitwise %.3fs (%.1fx)', name, size, table_time, legacy_time, legacy_time / max(table_time, 1e-9))
+        return table_time, legacy_time
+
+    def test_benchmark_blocks(self):
+        # e.g. 10000 SIO controller blocks of up to 1 kB
+        blocks = random_blocks(random.Random(2), 10000, 1024)
+        self.benchmark('crc16_iso14443b_blocks', crc16_iso14443b_blocks,
+                       lambda blocks: [legacy_crc16_iso14443ab(block, 0xffff, 0x8408, True) for block in blocks], blocks)
+        self.benchmark('crc16_iso14443ab_blocks', lambda blocks: crc16_iso14443ab_blocks(blocks, 0xffff, 0xa001, True),
+                       lambda blocks: [legacy_crc16_iso14443ab(block, 0xffff, 0xa001, True) for block in blocks], blocks)
@@ -19,7 +19,7 @@ from collections import OrderedDict
 from coverage_model import AbstractCoverage, ParameterContext, SparseConstantType, BooleanType
 from ion.services.dm.test.dm_test_case import DMTestCase, Streamer
 from ion.services.dm.test.test_dm_end_2_end import DatasetMonitor
-from ion.util.direct_coverage_utils import DirectCoverageAccess, SimpleDelimitedParser
+from ion.util.direct_coverage_utils import DirectCoverageAccess, SimpleDelimitedParser, find_nearest_indices
 from pyon.ion.resource import PRED
 from pyon.util.unit_test import PyonTestCase
 
@@ -276,6 +276,73 @@ class TestSimpleDelimitedParser(PyonTestCase):
         for x in dat.dtype.names:
             np.testing.assert_array_equal(dat[x], want_vals[x])
 
+    def test_iter_blocks(self):
+        parser = SimpleDelimitedParser.get_parser('test_data/testmanualupload.csv', 'test_data/testmanualupload.yml')
+        blocks = list(parser.iter_blocks(block_size=3))
+        self.assertEqual([len(b) for b in blocks], [3, 3, 3, 1])
+
+        dat = np.concatenate(blocks)
+        self.assertEqual(dat.dtype, parser.parse().dtype)
+        np.testing.assert_array_equal(dat['time'], np.arange(10, dtype='int64'))
+        np.testing.assert_array_equal(dat['cond_hitl_qc'], np.array([1, 0, 1, 0, 0, 0, 1, 1, 0, 0], dtype=bool))
+
+    def test_iter_blocks_missing_values(self):
+        import shutil
+        import tempfile
+        tdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdir, ignore_errors=True)
+        outpth = os.path.join(tdir, 'missing.csv')
+        with open(outpth, 'w') as f:
+            f.write('time,temp,cond\n')
+            for i in xrange(100):
+                f.write('%d,%s,%s\n' % (i, i * 0.5, '' if i % 7 == 0 else i))
+
+        parser = SimpleDelimitedParser.get_parser(outpth)
+        dat = np.concatenate(list(parser.iter_blocks(block_size=8)))
+        want = np.genfromtxt(outpth, delimiter=',', names=True, dtype='float32', filling_values=-999)
+        self.assertEqual(dat.dtype, want.dtype)
+        np.testing.assert_array_equal(dat, want)
+        self.assertEqual(dat['cond'][7], -999)
+
+    @mock.patch.multiple('ion.util.direct_coverage_utils', IngestionManagementServiceClient=mock.DEFAULT, ResourceRegistryServiceClient=mock.DEFAULT,
+                         DataProductManagementServiceClient=mock.DEFAULT, DatasetManagementServiceClient=mock.DEFAULT)
+    def test_manual_upload_malformed_row(self, **clients):
+        import shutil
+        import tempfile
+        tdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdir, ignore_errors=True)
+        outpth = os.path.join(tdir, 'malformed.csv')
+        with open(outpth, 'w') as f:
+            f.write('time,temp\n')
+            for i in xrange(100):
+                f.write('%d,%s\n' % (i, i * 0.5))
+            f.write('100,50.0,1\n')
+
+        dca = DirectCoverageAccess()
+        cov = mock.MagicMock()
+        cov.__enter__.return_value = cov
+        cov.temporal_parameter_name = 'time'
+        cov.get_time_values.return_value = np.arange(101, dtype='float64')
+        cov.list_parameters.return_value = ['time', 'temp']
+        dca.get_editable_coverage = mock.Mock(return_value=cov)
+
+        # Nothing is written when a later block is malformed
+        with self.assertRaises(ValueError):
+            dca.manual_upload('dataset_id', outpth, block_size=8)
+        self.assertFalse(cov.set_parameter_values.called)
+
+    def test_find_nearest_indices(self):
+        times = np.arange(0, 100, 2, dtype='float64')
+        values = np.array([-5, 0, 1.2, 2.9, 3.1, 50, 98, 1000])
+        from coverage_model import utils
+        want = [utils.find_nearest_index(times, v) for v in values]
+        np.testing.assert_array_equal(find_nearest_indices(times, values), want)
+
+        # Unsorted times are searched one value at a time
+        times = times[::-1]
+        want = [utils.find_nearest_index(times, v) for v in values]
+        np.testing.assert_array_equal(find_nearest_indices(times, values), want)
+
     def test_write_default_config(self):
         import tempfile
         tdir = tempfile.mkdtemp()